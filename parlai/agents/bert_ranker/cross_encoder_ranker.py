@@ -4,7 +4,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 from parlai.utils.distributed import is_distributed
-from parlai.utils.torch import concat_without_padding
+from parlai.utils.torch import concat_candidates_without_padding
 from parlai.core.torch_ranker_agent import TorchRankerAgent
 from parlai.zoo.bert.build import download
 
@@ -73,21 +73,15 @@ class CrossEncoderRankerAgent(TorchRankerAgent):
     def score_candidates(self, batch, cand_vecs, cand_encs=None):
         # concatenate text and candidates (not so easy)
         # unpad and break
-        nb_cands = cand_vecs.size()[1]
-        size_batch = cand_vecs.size()[0]
-        text_vec = batch.text_vec
-
-        tokens_context = (
-            text_vec.unsqueeze(1)
-            .expand(-1, nb_cands, -1)
-            .contiguous()
-            .view(nb_cands * size_batch, -1)
-        )
-
-        # remove the start token ["CLS"] from candidates
-        tokens_cands = cand_vecs.view(nb_cands * size_batch, -1)
-        all_tokens, all_segments = concat_without_padding(
-            tokens_context, tokens_cands, self.use_cuda, self.NULL_IDX
+        size_batch = batch.text_vec.size(0)
+        cand_vecs = cand_vecs.to(batch.text_vec.device)
+        if cand_vecs.dim() == 2:
+            # candidates shared by the whole batch
+            cand_vecs = cand_vecs.unsqueeze(0).expand(size_batch, -1, -1)
+        nb_cands = cand_vecs.size(1)
+
+        all_tokens, all_segments = concat_candidates_without_padding(
+            batch.text_vec, cand_vecs, self.NULL_IDX
         )
         all_mask = all_tokens != self.NULL_IDX
         all_tokens *= all_mask.long()
@@ -22,8 +22,12 @@ depending on whether you train on the train set first, or not.
 
 import math
 from collections.abc import Sequence
+import hashlib
 import heapq
 import json
+import os
+
+import numpy as np
 import torch
 
 from parlai.core.agents import Agent
@@ -221,6 +225,160 @@ def rank_candidates(query_rep, cands, length_penalty, dictionary=None):
         return res
 
 
+class InvertedIndex(object):
+    """
+    Inverted index from tokens to a fixed list of candidates, for fast ranking.
+
+    Ranks exactly like ``rank_candidates``, but only scores the candidates which
+    share a token with the query. The unique tokens of each candidate are numbered
+    in order of first occurrence, and the postings keep these positions, so that
+    scores are summed in the same order, and thus to the same floats, as in
+    ``score_match``.
+    """
+
+    def __init__(self, cands, dictionary, digest=None):
+        """
+        :param cands: list of candidate strings.
+        :param dictionary: dictionary used to tokenize the candidates.
+        :param digest: identifies the candidates, see ``compute_digest()``.
+        """
+        self.cands = cands
+        self.digest = digest
+        postings = {}
+        num_unique = np.zeros(len(cands), dtype=np.int32)
+        for i, c in enumerate(cands):
+            if c == '':
+                continue
+            # unique tokens, in order of first occurrence
+            words = dict.fromkeys(dictionary.tokenize(c.lower()))
+            num_unique[i] = len(words)
+            for pos, w in enumerate(words):
+                postings.setdefault(w, []).append((i, pos))
+        terms = list(postings)
+        lengths = [len(postings[t]) for t in terms]
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.array(
+            [p for t in terms for p in postings[t]], dtype=np.int32
+        ).reshape(-1, 2)
+        self._set_arrays(terms, offsets, flat[:, 0], flat[:, 1], num_unique)
+
+    def _set_arrays(self, terms, offsets, cand_ids, positions, num_unique):
+        self.terms = {t: i for i, t in enumerate(terms)}
+        self.offsets = offsets
+        self.cand_ids = cand_ids
+        self.positions = positions
+        self.num_unique = num_unique
+
+    def __len__(self):
+        return len(self.cands)
+
+    @staticmethod
+    def compute_digest(cands, opt):
+        """
+        Return a digest of the candidates and of how they are tokenized.
+        """
+        digest = hashlib.md5()
+        digest.update(opt.get('dict_tokenizer', '').encode('utf-8'))
+        digest.update(str(opt.get('dict_lower')).encode('utf-8'))
+        digest.update('\n'.join(cands).encode('utf-8'))
+        return digest.hexdigest()
+
+    def save(self, path):
+        """
+        Save the index to path.
+        """
+        terms = sorted(self.terms, key=self.terms.get)
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                digest=np.array(self.digest or ''),
+                terms=np.array(terms, dtype=str),
+                offsets=self.offsets,
+                cand_ids=self.cand_ids,
+                positions=self.positions,
+                num_unique=self.num_unique,
+            )
+
+    @classmethod
+    def load(cls, path, cands, digest=None):
+        """
+        Load an index saved with ``save()``.
+
+        :returns: the index, or None if it was built from other candidates.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if digest is not None and str(data['digest']) != digest:
+                return None
+            if len(data['num_unique']) != len(cands):
+                return None
+            index = cls.__new__(cls)
+            index.cands = cands
+            index.digest = digest
+            index._set_arrays(
+                data['terms'].tolist(),
+                data['offsets'],
+                data['cand_ids'],
+                data['positions'],
+                data['num_unique'],
+            )
+        return index
+
+    def _scores(self, query_rep, length_penalty):
+        """
+        Return the ids, in increasing order, and scores of the matched candidates.
+        """
+        ids, positions, weights = [], [], []
+        for w, weight in query_rep['words'].items():
+            t = self.terms.get(w)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            ids.append(self.cand_ids[start:end])
+            positions.append(self.positions[start:end])
+            weights.append(np.full(end - start, weight, dtype=np.float64))
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        positions = np.concatenate(positions)
+        weights = np.concatenate(weights)
+
+        # add the weights of each candidate in the order of its tokens
+        scores = np.zeros(len(ids))
+        order = np.argsort(positions, kind='stable')
+        bounds = np.flatnonzero(np.diff(positions[order])) + 1
+        for group in np.split(order, bounds):
+            # a candidate has a single token at each position
+            scores[inverse[group]] += weights[group]
+
+        num_unique = self.num_unique[ids]
+        for n in np.unique(num_unique).tolist():
+            norm = math.pow(math.sqrt(n) * query_rep['norm'], length_penalty)
+            if norm > 1:
+                mask = num_unique == n
+                scores[mask] /= norm
+        return ids, scores
+
+    def rank(self, query_rep, length_penalty, max_size=100):
+        """
+        Rank the candidates given the representation of the query.
+
+        :returns: the same list as ``rank_candidates`` on the candidates.
+        """
+        ids, scores = self._scores(query_rep, length_penalty)
+        matched = dict(zip(ids.tolist(), scores.tolist()))
+        # replay the queue of rank_candidates: the first candidates fill it
+        # whatever their score, after which only positive scores get in
+        mpq = MaxPriorityQueue(max_size)
+        num_first = min(max_size, len(self.cands))
+        for i in range(num_first):
+            mpq.add(self.cands[i], matched.get(i, 0))
+        start = np.searchsorted(ids, num_first)
+        for i, score in zip(ids[start:].tolist(), scores[start:].tolist()):
+            mpq.add(self.cands[i], score)
+        return [c for _, c in sorted(mpq.lst, reverse=True)]
+
+
 class IrBaselineAgent(Agent):
     """
     Information Retrieval baseline.
@@ -261,13 +419,44 @@ class IrBaselineAgent(Agent):
         super().__init__(opt)
         self.id = 'IRBaselineAgent'
         self.length_penalty = float(opt['length_penalty'])
-        self.dictionary = DictionaryAgent(opt)
+        self.inverted_index = None
+        if shared is None:
+            self.dictionary = DictionaryAgent(opt)
+            if opt.get('label_candidates_file'):
+                f = open(opt.get('label_candidates_file'))
+                self.label_candidates = f.read().split('\n')
+                self.inverted_index = self._build_index(opt.get('model_file'))
+        else:
+            # reuse the dictionary of the original rather than loading a copy
+            self.dictionary = DictionaryAgent(opt, shared['dictionary'])
+            if 'label_candidates' in shared:
+                self.label_candidates = shared['label_candidates']
+                self.inverted_index = shared['inverted_index']
         self.opt = opt
         self.history = []
         self.episodeDone = True
-        if opt.get('label_candidates_file'):
-            f = open(opt.get('label_candidates_file'))
-            self.label_candidates = f.read().split('\n')
+
+    def share(self):
+        """
+        Share the dictionary and candidates with copies of this agent.
+        """
+        shared = super().share()
+        shared['dictionary'] = self.dictionary.share()
+        if hasattr(self, 'label_candidates'):
+            shared['label_candidates'] = self.label_candidates
+            shared['inverted_index'] = self.inverted_index
+        return shared
+
+    def _build_index(self, path=None):
+        """
+        Index the candidates of the candidate file, loading the index if saved.
+        """
+        digest = InvertedIndex.compute_digest(self.label_candidates, self.opt)
+        if path and os.path.isfile(path + '.index'):
+            index = InvertedIndex.load(path + '.index', self.label_candidates, digest)
+            if index is not None:
+                return index
+        return InvertedIndex(self.label_candidates, self.dictionary, digest)
 
     def reset(self):
         """
@@ -313,9 +502,14 @@ class IrBaselineAgent(Agent):
             left_idx = max(0, len(self.history) - hist_sz)
             text = ' '.join(self.history[left_idx : len(self.history)])
             rep = self.build_query_representation(text)
-            reply['text_candidates'] = rank_candidates(
-                rep, cands, self.length_penalty, self.dictionary
-            )
+            if self.inverted_index is not None and cands is self.label_candidates:
+                reply['text_candidates'] = self.inverted_index.rank(
+                    rep, self.length_penalty
+                )
+            else:
+                reply['text_candidates'] = rank_candidates(
+                    rep, cands, self.length_penalty, self.dictionary
+                )
             reply['text'] = reply['text_candidates'][0]
         else:
             reply['text'] = "I don't know."
@@ -323,11 +517,13 @@ class IrBaselineAgent(Agent):
 
     def save(self, path=None):
         """
-        Save dictionary tokenizer if available.
+        Save dictionary tokenizer and candidate index if available.
         """
         path = self.opt.get('model_file', None) if path is None else path
         if path:
             self.dictionary.save(path + '.dict')
+            if self.inverted_index is not None:
+                self.inverted_index.save(path + '.index')
             data = {}
             data['opt'] = self.opt
             with open(path, 'wb') as handle:
@@ -337,9 +533,11 @@ class IrBaselineAgent(Agent):
 
     def load(self, fname):
         """
-        Load internal dictionary.
+        Load internal dictionary, and candidate index if saved.
         """
         self.dictionary.load(fname + '.dict')
+        if hasattr(self, 'label_candidates'):
+            self.inverted_index = self._build_index(fname)
 
     def build_query_representation(self, query):
         """
@@ -121,12 +121,20 @@ class MemnnAgent(TorchRankerAgent):
     def encode_candidates(self, padded_cands):
         return self.model.answer_embedder(padded_cands)
 
-    def score_candidates(self, batch, cand_vecs, cand_encs=None):
+    def encode_retrieval_queries(self, batch):
         mems = self._build_mems(batch.memory_vecs)
+        state, _ = self.model(batch.text_vec, mems, None, self._mems_pad_mask(mems))
+        return state
+
+    def _mems_pad_mask(self, mems):
         # Check for rows that have no non-null tokens
-        pad_mask = None
-        if mems is not None:
-            pad_mask = (mems != self.NULL_IDX).sum(dim=-1) == 0
+        if mems is None:
+            return None
+        return (mems != self.NULL_IDX).sum(dim=-1) == 0
+
+    def score_candidates(self, batch, cand_vecs, cand_encs=None):
+        mems = self._build_mems(batch.memory_vecs)
+        pad_mask = self._mems_pad_mask(mems)
 
         if cand_encs is not None:
             state, _ = self.model(batch.text_vec, mems, None, pad_mask)
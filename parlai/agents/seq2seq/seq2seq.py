@@ -8,7 +8,6 @@ from parlai.core.torch_generator_agent import TorchGeneratorAgent
 from parlai.utils.misc import warn_once
 from .modules import Seq2seq, opt_to_kwargs
 
-import torch
 import torch.nn as nn
 
 
@@ -235,9 +234,7 @@ class Seq2seqAgent(TorchGeneratorAgent):
         """
         Return opt and model states.
         """
-        states = torch.load(path, map_location=lambda cpu, _: cpu)
-        # set loaded states if applicable
-        self.model.load_state_dict(states['model'])
+        states = super().load(path)
         if 'longest_label' in states:
             self.model.longest_label = states['longest_label']
         return states
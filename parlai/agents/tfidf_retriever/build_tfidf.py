@@ -13,8 +13,11 @@ import torch
 import numpy as np
 import scipy.sparse as sp
 import argparse
+import json
 import os
 import math
+import shutil
+import zlib
 
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
@@ -24,6 +27,7 @@ from collections import Counter
 from . import utils
 from .doc_db import DocDB
 from . import tokenizers
+from parlai.utils.checkpoint import atomic_write
 from parlai.utils.logging import logger
 
 fmt = '%(asctime)s: [ %(message)s ]'
@@ -240,6 +244,218 @@ def get_count_matrix(args, db_opts):
     return count_matrix
 
 
+# ------------------------------------------------------------------------------
+# Streaming, sharded build.
+#
+# Documents are counted in shards of --shard-size documents, and each shard's
+# count matrix is written to disk. The shards are then merged out-of-core, into
+# memory-mapped arrays, directly into the tfidf matrix. Shards are kept next to
+# the tfidf matrix, so that new documents can be appended without recounting
+# the old ones.
+# ------------------------------------------------------------------------------
+
+DEFAULT_SHARD_SIZE = 100000
+MANIFEST = 'manifest.json'
+
+
+def get_shard_dir(tfidf_path):
+    """
+    Return the directory holding the count shards of the tfidf matrix.
+    """
+    return tfidf_path + '.counts'
+
+
+def _checksum(text):
+    if text is None:
+        return None
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def _file_checksum(path):
+    checksum = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            checksum = zlib.crc32(block, checksum)
+    return checksum
+
+
+def _valid_shard(shard, shard_dir, doc_db):
+    """
+    Return whether a shard is intact, and its last document unchanged in the db.
+    """
+    if not isinstance(shard, dict):
+        # manifest of an older version
+        return False
+    path = os.path.join(shard_dir, shard['name'])
+    if not os.path.isfile(path) or _file_checksum(path) != shard['checksum']:
+        return False
+    last_text = doc_db.get_doc_text(shard['max_doc_id'])
+    return _checksum(last_text) == shard['last_doc_checksum']
+
+
+def count_shard(workers, args, doc_ids, path):
+    """
+    Count the documents in doc_ids, and save their count matrix to path.
+
+    The shard is a CSR [hash_size, max(doc_ids) + 1] matrix, with one column per
+    document id.
+    """
+    rows, cols, data = [], [], []
+    _count = partial(count, args.ngram, args.hash_size)
+    for b_row, b_col, b_data in workers.imap_unordered(_count, doc_ids):
+        rows.append(np.array(b_row, dtype=np.int64))
+        cols.append(np.array(b_col, dtype=np.int64))
+        data.append(np.array(b_data, dtype=np.int32))
+    count_matrix = sp.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(args.hash_size, max(doc_ids) + 1),
+    )
+    count_matrix.sum_duplicates()
+    sp.save_npz(path, count_matrix, compressed=False)
+
+
+def build_count_shards(args, db_opts, shard_dir):
+    """
+    Count the documents of the database in shards, saved in shard_dir.
+
+    If shard_dir already holds shards built with the same settings, only the
+    documents with ids larger than the ones already counted are counted, as new
+    shards. Otherwise, all documents are counted again.
+
+    :return:
+        the manifest of the shards.
+    """
+    settings = {
+        'ngram': args.ngram,
+        'hash_size': args.hash_size,
+        'tokenizer': args.tokenizer,
+    }
+    manifest = None
+    manifest_path = os.path.join(shard_dir, MANIFEST)
+    with DocDB(**db_opts) as doc_db:
+        doc_ids = sorted(doc_db.get_doc_ids())
+        if getattr(args, 'append', False) and os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            # every shard must be intact, and its last document still in the
+            # db, unchanged
+            if any(manifest.get(k) != v for k, v in settings.items()) or not all(
+                _valid_shard(shard, shard_dir, doc_db)
+                for shard in manifest.get('shards', [])
+            ):
+                logger.info('Existing count shards do not match the db, rebuilding.')
+                manifest = None
+        new_ids = [i for i in doc_ids if manifest is None or i > manifest['max_doc_id']]
+
+    if manifest is None:
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+        manifest = dict(settings, max_doc_id=-1, shards=[])
+
+    manifest['num_docs'] = len(doc_ids)
+    if not new_ids:
+        return manifest
+
+    shard_size = getattr(args, 'shard_size', None) or DEFAULT_SHARD_SIZE
+    tok_class = tokenizers.get_class(args.tokenizer)
+    workers = ProcessPool(
+        args.num_workers, initializer=init, initargs=(tok_class, db_opts)
+    )
+    num_shards = (len(new_ids) + shard_size - 1) // shard_size
+    for i in range(num_shards):
+        logger.info('-' * 25 + 'Shard %d/%d' % (i + 1, num_shards) + '-' * 25)
+        shard_ids = new_ids[i * shard_size : (i + 1) * shard_size]
+        name = 'shard-{:05d}.npz'.format(len(manifest['shards']))
+        path = os.path.join(shard_dir, name)
+        count_shard(workers, args, shard_ids, path)
+        with DocDB(**db_opts) as doc_db:
+            last_text = doc_db.get_doc_text(shard_ids[-1])
+        manifest['shards'].append(
+            {
+                'name': name,
+                'checksum': _file_checksum(path),
+                'num_docs': len(shard_ids),
+                'max_doc_id': shard_ids[-1],
+                'last_doc_checksum': _checksum(last_text),
+            }
+        )
+        manifest['max_doc_id'] = shard_ids[-1]
+        # record progress after every shard, so an interrupted build resumes
+        atomic_write(manifest_path, lambda f: json.dump(manifest, f), mode='w')
+    workers.close()
+    workers.join()
+    return manifest
+
+
+def merge_count_shards(manifest, shard_dir):
+    """
+    Merge the count shards into the tfidf matrix, out-of-core.
+
+    The first pass over the shards computes the document frequency of every
+    ngram, and so the idf weights and the size of each row of the tfidf matrix.
+    The second pass copies the rows of every shard into memory-mapped arrays,
+    weighted by their tfidf. Shards hold increasing document ids, so the columns
+    of each row stay sorted.
+
+    :return: (tfidf, doc_freqs)
+        the tfidf matrix, backed by memory-mapped files in shard_dir, and the
+        document frequencies.
+    """
+    hash_size = manifest['hash_size']
+    num_cols = max(manifest['num_docs'], manifest['max_doc_id']) + 1
+    paths = [os.path.join(shard_dir, shard['name']) for shard in manifest['shards']]
+
+    doc_freqs = np.zeros(hash_size, dtype=np.int64)
+    for path in paths:
+        doc_freqs += np.diff(sp.load_npz(path).indptr)
+
+    # same weights as get_tfidf_matrix
+    idfs = np.log((num_cols - doc_freqs + 0.5) / (doc_freqs + 0.5))
+    idfs[idfs < 0] = 0
+    # entries of ngrams with an idf of 0 are 0, and dropped from the matrix
+    row_nnz = np.where(idfs > 0, doc_freqs, 0)
+    indptr = np.zeros(hash_size + 1, dtype=np.int64)
+    np.cumsum(row_nnz, out=indptr[1:])
+    nnz = int(indptr[-1])
+    index_dtype = np.int32 if max(nnz, num_cols) < 2 ** 31 else np.int64
+    indptr = indptr.astype(index_dtype)
+
+    data = np.lib.format.open_memmap(
+        os.path.join(shard_dir, 'merged.data.npy'),
+        mode='w+',
+        dtype=np.float64,
+        shape=(nnz,),
+    )
+    indices = np.lib.format.open_memmap(
+        os.path.join(shard_dir, 'merged.indices.npy'),
+        mode='w+',
+        dtype=index_dtype,
+        shape=(nnz,),
+    )
+    filled = np.zeros(hash_size, dtype=np.int64)
+    for path in paths:
+        shard = sp.load_npz(path)
+        shard_nnz = np.diff(shard.indptr)
+        keep = np.repeat(idfs > 0, shard_nnz)
+        shard_nnz[idfs == 0] = 0
+        # destination of each kept entry: its row start, plus the entries of the
+        # row already copied from earlier shards, plus its offset in the shard row
+        row_starts = np.repeat(indptr[:-1] + filled, shard_nnz)
+        offsets = np.arange(len(row_starts)) - np.repeat(
+            np.cumsum(shard_nnz) - shard_nnz, shard_nnz
+        )
+        dest = row_starts + offsets
+        rows = np.repeat(np.arange(hash_size), shard_nnz)
+        data[dest] = np.log1p(shard.data[keep]) * idfs[rows]
+        indices[dest] = shard.indices[keep]
+        filled += shard_nnz
+        del shard
+
+    tfidf = sp.csr_matrix((data, indices, indptr), shape=(hash_size, num_cols))
+    return tfidf, doc_freqs
+
+
 # ------------------------------------------------------------------------------
 # Transform count matrix to different forms.
 # ------------------------------------------------------------------------------
@@ -310,25 +526,32 @@ def get_doc_freqs(cnts):
 def run(args):
     # ParlAI version of run method, modified slightly
     logger.info('Counting words...')
-    count_matrix = get_count_matrix(args, {'db_path': args.db_path})
-
-    logger.info('Making tfidf vectors...')
-    tfidf = get_tfidf_matrix(count_matrix)
-
-    logger.info('Getting word-doc frequencies...')
-    freqs = get_doc_freqs(count_matrix)
-
-    filename = args.out_dir
-
-    logger.info('Saving to %s' % filename)
-    metadata = {
-        'doc_freqs': freqs,
-        'tokenizer': args.tokenizer,
-        'hash_size': args.hash_size,
-        'ngram': args.ngram,
-    }
-
-    utils.save_sparse_csr(filename, tfidf, metadata)
+    shard_dir = get_shard_dir(args.out_dir)
+    manifest = build_count_shards(args, {'db_path': args.db_path}, shard_dir)
+
+    logger.info('Merging count shards into tfidf vectors...')
+    try:
+        tfidf, freqs = merge_count_shards(manifest, shard_dir)
+
+        filename = args.out_dir
+
+        logger.info('Saving to %s' % filename)
+        metadata = {
+            'doc_freqs': freqs,
+            'tokenizer': args.tokenizer,
+            'hash_size': args.hash_size,
+            'ngram': args.ngram,
+        }
+
+        utils.save_sparse_csr(filename, tfidf, metadata)
+        del tfidf
+    finally:
+        # the merged arrays are only needed until they are saved, and are left
+        # half written by a failed merge
+        for name in ['merged.data.npy', 'merged.indices.npy']:
+            path = os.path.join(shard_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
 
 
 if __name__ == '__main__':
@@ -12,6 +12,9 @@ Adapted from Adam Fisch's work at github.com/facebookresearch/DrQA/
 import sqlite3
 from . import utils
 
+# the default maximum number of parameters of a sqlite query
+MAX_VARIABLES = 999
+
 
 class DocDB(object):
     """
@@ -76,6 +79,40 @@ class DocDB(object):
         cursor.close()
         return result if result is None else result[0]
 
+    def get_doc_texts(self, doc_ids):
+        """
+        Fetch the raw texts of many docs at once, in the order of 'doc_ids'.
+        """
+        return self._get_many('text', doc_ids)
+
+    def get_doc_values(self, doc_ids):
+        """
+        Fetch the values of many docs at once, in the order of 'doc_ids'.
+        """
+        return self._get_many('value', doc_ids)
+
+    def _get_many(self, column, doc_ids):
+        """
+        Fetch a column for many docs, with a single query per chunk of ids.
+
+        Missing docs are returned as None.
+        """
+        doc_ids = [utils.normalize(doc_id) for doc_id in doc_ids]
+        found = {}
+        cursor = self.connection.cursor()
+        unique_ids = list(dict.fromkeys(doc_ids))
+        for start in range(0, len(unique_ids), MAX_VARIABLES):
+            chunk = unique_ids[start : start + MAX_VARIABLES]
+            cursor.execute(
+                "SELECT id, {} FROM documents WHERE id IN ({})".format(
+                    column, ','.join('?' * len(chunk))
+                ),
+                chunk,
+            )
+            found.update(cursor.fetchall())
+        cursor.close()
+        return [found.get(doc_id) for doc_id in doc_ids]
+
     def add(self, triples):
         cursor = self.connection.cursor()
         cursor.executemany('INSERT OR IGNORE INTO documents VALUES (?,?,?)', triples)
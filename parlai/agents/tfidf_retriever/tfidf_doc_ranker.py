@@ -11,13 +11,15 @@ Adapted from Adam Fisch's work at github.com/facebookresearch/DrQA/
 
 import numpy as np
 import scipy.sparse as sp
+import threading
 
+from collections import OrderedDict
 from multiprocessing.pool import ThreadPool
-from functools import partial
 
 from . import utils
 from . import tokenizers
 from parlai.utils.logging import logger
+from parlai.utils.thread import SharedArrays
 
 
 class TfidfDocRanker(object):
@@ -27,11 +29,12 @@ class TfidfDocRanker(object):
     Scores new queries by taking sparse dot products.
     """
 
-    def __init__(self, tfidf_path=None, strict=True):
+    def __init__(self, tfidf_path=None, strict=True, cache_size=0):
         """
         Args:
             tfidf_path: path to saved model file
             strict: fail on empty queries or continue (and return empty result)
+            cache_size: number of recent query results to keep (0 to disable)
         """
         # Load from disk
         logger.info('Loading %s' % tfidf_path)
@@ -44,6 +47,50 @@ class TfidfDocRanker(object):
         self.doc_dict = metadata.get('doc_dict', None)
         self.num_docs = self.doc_mat.shape[1] - 1
         self.strict = strict
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.shared_arrays = None
+
+    def share_memory(self):
+        """
+        Move the document matrix to shared memory, for hogwild processes.
+        """
+        if self.shared_arrays is not None:
+            return
+        arrays = SharedArrays()
+        self.doc_mat = sp.csr_matrix(
+            (
+                arrays.register('data', self.doc_mat.data),
+                arrays.register('indices', self.doc_mat.indices),
+                arrays.register('indptr', self.doc_mat.indptr),
+            ),
+            shape=self.doc_mat.shape,
+            copy=False,
+        )
+        self.doc_freqs = arrays.register('doc_freqs', self.doc_freqs)
+        self.shared_arrays = arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_cache_lock']
+        if self.shared_arrays is not None:
+            # rebuilt from the shared arrays instead of copied
+            state['_shape'] = state.pop('doc_mat').shape
+            del state['doc_freqs']
+        return state
+
+    def __setstate__(self, state):
+        arrays = state['shared_arrays']
+        if arrays is not None:
+            state['doc_mat'] = sp.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=state.pop('_shape'),
+                copy=False,
+            )
+            state['doc_freqs'] = arrays['doc_freqs']
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
 
     def get_doc_index(self, doc_id):
         """
@@ -64,30 +111,84 @@ class TfidfDocRanker(object):
 
         matrix arg can be provided to be used instead of internal doc matrix.
         """
-        spvec = self.text2spvec(query)
-        res = spvec * matrix if matrix is not None else spvec * self.doc_mat
-
-        if len(res.data) <= k:
-            o_sort = np.argsort(-res.data)
-        else:
-            o = np.argpartition(-res.data, k)[0:k]
-            o_sort = o[np.argsort(-res.data[o])]
-
-        doc_scores = res.data[o_sort]
-        doc_ids = res.indices[o_sort]
-        return doc_ids, doc_scores
+        if matrix is None:
+            return self.batch_closest_docs([query], k=k)[0]
+        res = self.text2spvec(query) * matrix
+        return self._topk(res.data, res.indices, k)
 
     def batch_closest_docs(self, queries, k=1, num_workers=None):
         """
-        Process a batch of closest_docs requests multithreaded.
+        Process a batch of closest_docs requests.
+
+        The queries are stacked into a single sparse matrix, and scored against the
+        documents with one sparse product, split into num_workers chunks of rows
+        which are multiplied in parallel.
 
         Note: we can use plain threads here as scipy is outside of the GIL.
         """
-        with ThreadPool(num_workers) as threads:
-            closest_docs = partial(self.closest_docs, k=k)
-            results = threads.map(closest_docs, queries)
+        results = [None] * len(queries)
+        missing = OrderedDict()
+        for i, query in enumerate(queries):
+            cached = self._cache_get((query, k))
+            if cached is not None:
+                results[i] = cached
+            else:
+                missing.setdefault(query, []).append(i)
+        if not missing:
+            return results
+
+        unique_queries = list(missing)
+        spvecs = self.batch_text2spvec(unique_queries)
+        num_chunks = min(num_workers or 1, len(unique_queries))
+        if num_chunks > 1:
+            bounds = np.linspace(0, len(unique_queries), num_chunks + 1).astype(int)
+            chunks = [spvecs[s:e] for s, e in zip(bounds[:-1], bounds[1:])]
+            with ThreadPool(num_chunks) as threads:
+                products = threads.map(lambda chunk: chunk * self.doc_mat, chunks)
+            res = sp.vstack(products, 'csr')
+        else:
+            res = spvecs * self.doc_mat
+
+        for row, query in enumerate(unique_queries):
+            start, end = res.indptr[row], res.indptr[row + 1]
+            result = self._topk(res.data[start:end], res.indices[start:end], k)
+            self._cache_put((query, k), result)
+            for i in missing[query]:
+                results[i] = result
         return results
 
+    @staticmethod
+    def _topk(scores, doc_ids, k):
+        """
+        Select the k best (doc_ids, scores) of a sparse row of scores.
+        """
+        if len(scores) <= k:
+            o_sort = np.argsort(-scores)
+        else:
+            o = np.argpartition(-scores, k)[0:k]
+            o_sort = o[np.argsort(-scores[o])]
+        return doc_ids[o_sort], scores[o_sort]
+
+    def _cache_get(self, key):
+        if self.cache_size <= 0:
+            return None
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+            return result
+
+    def _cache_put(self, key, result):
+        if self.cache_size <= 0:
+            return
+        # callers get the cached arrays themselves, don't let them change
+        for arr in result:
+            arr.setflags(write=False)
+        with self._cache_lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
     def parse(self, query):
         """
         Parse the query into tokens (either ngrams or tokens).
@@ -95,9 +196,9 @@ class TfidfDocRanker(object):
         tokens = self.tokenizer.tokenize(query)
         return tokens.ngrams(n=self.ngrams, uncased=True, filter_fn=utils.filter_ngram)
 
-    def text2spvec(self, query):
+    def _query_weights(self, query):
         """
-        Create a sparse tfidf-weighted word vector from query.
+        Return the hashed ngram ids of the query and their tfidf weights.
 
         tfidf = log(tf + 1) * log((N - Nt + 0.5) / (Nt + 0.5))
         """
@@ -110,7 +211,7 @@ class TfidfDocRanker(object):
                 raise RuntimeError('No valid word in: %s' % query)
             else:
                 logger.warning('No valid word in: %s' % query)
-                return sp.csr_matrix((1, self.hash_size))
+                return np.array([], dtype=int), np.array([])
 
         # Count TF
         wids_unique, wids_counts = np.unique(wids, return_counts=True)
@@ -122,10 +223,26 @@ class TfidfDocRanker(object):
         idfs[idfs < 0] = 0
 
         # TF-IDF
-        data = np.multiply(tfs, idfs)
+        return wids_unique, np.multiply(tfs, idfs)
 
-        # One row, sparse csr matrix
-        indptr = np.array([0, len(wids_unique)])
-        spvec = sp.csr_matrix((data, wids_unique, indptr), shape=(1, self.hash_size))
+    def text2spvec(self, query):
+        """
+        Create a sparse tfidf-weighted word vector from query.
+        """
+        return self.batch_text2spvec([query])
 
-        return spvec
+    def batch_text2spvec(self, queries):
+        """
+        Create a sparse matrix with the tfidf-weighted word vector of each query.
+        """
+        weights = [self._query_weights(query) for query in queries]
+        indptr = np.cumsum([0] + [len(wids) for wids, _ in weights])
+        if len(queries) > 0 and indptr[-1] > 0:
+            indices = np.concatenate([wids for wids, _ in weights])
+            data = np.concatenate([data for _, data in weights])
+        else:
+            indices = np.array([], dtype=int)
+            data = np.array([])
+        return sp.csr_matrix(
+            (data, indices, indptr), shape=(len(queries), self.hash_size)
+        )
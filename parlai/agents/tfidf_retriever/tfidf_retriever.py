@@ -21,7 +21,6 @@ from parlai.utils.misc import AttrDict
 from .doc_db import DocDB
 from .tfidf_doc_ranker import TfidfDocRanker
 from .build_tfidf import run as build_tfidf
-from .build_tfidf import live_count_matrix, get_tfidf_matrix
 from numpy.random import choice
 from collections import deque
 import math
@@ -72,6 +71,14 @@ class TfidfRetrieverAgent(Agent):
             default=int(math.pow(2, 24)),
             help='Number of buckets to use for hashing ngrams',
         )
+        parser.add_argument(
+            '--retriever-shard-size',
+            type=int,
+            default=100000,
+            help='Number of documents counted at a time when building the tfidf '
+            'matrix. Counts are saved per shard, so only new documents are '
+            'counted when the matrix is rebuilt.',
+        )
         parser.add_argument(
             '--retriever-tokenizer',
             type=str,
@@ -90,6 +97,13 @@ class TfidfRetrieverAgent(Agent):
             default='values',
             help='Whether to retrieve the stored key or the stored value.',
         )
+        parser.add_argument(
+            '--retriever-cache-size',
+            type=int,
+            default=1024,
+            help='Number of recent queries whose retrieved docs are cached. '
+            'Set to 0 to disable the cache.',
+        )
         parser.add_argument(
             '--remove-title',
             type='bool',
@@ -150,6 +164,9 @@ class TfidfRetrieverAgent(Agent):
                 'hash_size': opt['retriever_hashsize'],
                 'tokenizer': opt['retriever_tokenizer'],
                 'num_workers': opt['retriever_numworkers'],
+                'shard_size': opt.get('retriever_shard_size', 100000),
+                # only count the documents added since the last build
+                'append': True,
             }
         )
 
@@ -165,13 +182,10 @@ class TfidfRetrieverAgent(Agent):
         self.db = DocDB(db_path=opt['retriever_dbpath'])
         if os.path.exists(self.tfidf_path + '.npz'):
             if shared is None:
-                self.ranker = TfidfDocRanker(
-                    tfidf_path=opt['retriever_tfidfpath'], strict=False
-                )
+                self.ranker = self._build_ranker()
             else:
                 self.ranker = shared['doc_ranker']
         self.ret_mode = opt['retriever_mode']
-        self.cands_hash = {}  # cache for candidates
         self.triples_to_add = []  # in case we want to add more entries
 
         clen = opt.get('tfidf_context_length', -1)
@@ -179,8 +193,18 @@ class TfidfRetrieverAgent(Agent):
         self.include_labels = opt.get('tfidf_include_labels', True)
         self.reset()
 
+    def _build_ranker(self):
+        return TfidfDocRanker(
+            tfidf_path=self.tfidf_path,
+            strict=False,
+            cache_size=self.opt.get('retriever_cache_size', 1024),
+        )
+
     def share(self):
         shared = super().share()
+        if self.opt.get('numthreads', 1) > 1:
+            # let all hogwild processes use the same document matrix
+            self.ranker.share_memory()
         shared['doc_ranker'] = self.ranker
         return shared
 
@@ -197,12 +221,18 @@ class TfidfRetrieverAgent(Agent):
         self.training = False
 
     def doc2txt(self, docid):
+        return self.docs2txt([docid])[0]
+
+    def docs2txt(self, docids):
+        """
+        Fetch the texts of many docs with a single database query.
+        """
         if not self.opt.get('index_by_int_id', True):
-            docid = self.ranker.get_doc_id(docid)
+            docids = [self.ranker.get_doc_id(docid) for docid in docids]
         if self.ret_mode == 'keys':
-            return self.db.get_doc_text(docid)
+            return self.db.get_doc_texts(docids)
         elif self.ret_mode == 'values':
-            return self.db.get_doc_value(docid)
+            return self.db.get_doc_values(docids)
         else:
             raise RuntimeError(
                 'Retrieve mode {} not yet supported.'.format(self.ret_mode)
@@ -214,7 +244,7 @@ class TfidfRetrieverAgent(Agent):
             self.triples_to_add.clear()
             # rebuild tfidf
             build_tfidf(self.tfidf_args)
-            self.ranker = TfidfDocRanker(tfidf_path=self.tfidf_path, strict=False)
+            self.ranker = self._build_ranker()
 
     def save(self, path=None):
         self.rebuild()
@@ -264,51 +294,48 @@ class TfidfRetrieverAgent(Agent):
         return {'id': self.getID(), 'text': obs.get('labels', ['I don\'t know'])[0]}
 
     def act(self):
-        obs = self.observation
-        reply = {}
-        reply['id'] = self.getID()
-        if 'labels' in obs:
-            return self.train_act()
-        if 'text' in obs:
-            self.rebuild()  # no-op if nothing has been queued to store
-            doc_ids, doc_scores = self.ranker.closest_docs(
-                obs['text'], self.opt.get('retriever_num_retrieved', 5)
-            )
+        return self.batch_act([self.observation])[0]
+
+    def batch_act(self, observations):
+        """
+        Retrieve docs for a whole batch of observations at once.
+
+        The queries are scored with a single sparse product, and the texts of all
+        retrieved docs are fetched with a single database query.
+        """
+        replies = [{'id': self.getID()} for _ in observations]
+        queries = []
+        for i, obs in enumerate(observations):
+            if 'labels' in obs:
+                self.observation = obs
+                replies[i] = self.train_act()
+            elif 'text' in obs:
+                queries.append(i)
+        if not queries:
+            return replies
+
+        self.rebuild()  # no-op if nothing has been queued to store
+        results = self.ranker.batch_closest_docs(
+            [observations[i]['text'] for i in queries],
+            k=self.opt.get('retriever_num_retrieved', 5),
+            num_workers=self.opt.get('retriever_numworkers'),
+        )
+        all_doc_ids = list(
+            dict.fromkeys(int(did) for doc_ids, _ in results for did in doc_ids)
+        )
+        texts = dict(zip(all_doc_ids, self.docs2txt(all_doc_ids)))
 
-            if False and obs.get('label_candidates'):  # TODO: Alex (doesn't work)
-                # these are better selection than stored facts
-                # rank these options instead
-                cands = obs['label_candidates']
-                cands_id = id(cands)
-                if cands_id not in self.cands_hash:
-                    # cache candidate set
-                    # will not update if cand set changes contents
-                    c_list = list(cands)
-                    self.cands_hash[cands_id] = (
-                        get_tfidf_matrix(live_count_matrix(self.tfidf_args, c_list)),
-                        c_list,
-                    )
-                c_ids, c_scores = self.ranker.closest_docs(
-                    obs['text'],
-                    self.opt.get('retriever_num_retrieved', 5),
-                    matrix=self.cands_hash[cands_id][0],
-                )
-                reply['text_candidates'] = [
-                    self.cands_hash[cands_id][1][cid] for cid in c_ids
-                ]
-                reply['candidate_scores'] = c_scores
-                if len(reply['text_candidates']) > 0:
-                    reply['text'] = reply['text_candidates'][0]
-                else:
-                    reply['text'] = ''
-            elif len(doc_ids) > 0:
+        for i, (doc_ids, doc_scores) in zip(queries, results):
+            obs = observations[i]
+            reply = replies[i]
+            if len(doc_ids) > 0:
                 # return stored fact
                 # total = sum(doc_scores)
                 # doc_probs = [d / total for d in doc_scores]
 
                 # returned
-                picks = [self.doc2txt(int(did)) for did in doc_ids]
-                pick = self.doc2txt(int(doc_ids[0]))  # select best response
+                picks = [texts[int(did)] for did in doc_ids]
+                pick = picks[0]  # select best response
 
                 if self.opt.get('remove_title', False):
                     picks = ['\n'.join(p.split('\n')[1:]) for p in picks]
@@ -330,4 +357,4 @@ class TfidfRetrieverAgent(Agent):
                     ]
                 )
 
-        return reply
+        return replies
@@ -8,7 +8,7 @@ from .modules import TransformerEncoder
 from .modules import get_n_positions_from_options
 from parlai.core.torch_ranker_agent import TorchRankerAgent
 from .transformer import TransformerRankerAgent
-from parlai.utils.torch import concat_without_padding
+from parlai.utils.torch import concat_candidates_without_padding
 import torch
 
 
@@ -67,17 +67,14 @@ class CrossencoderAgent(TorchRankerAgent):
             raise Exception(
                 'Candidate pre-computation is impossible on the ' 'crossencoder'
             )
+        bsz = batch.text_vec.size(0)
+        cand_vecs = cand_vecs.to(batch.text_vec.device)
+        if cand_vecs.dim() == 2:
+            # candidates shared by the whole batch
+            cand_vecs = cand_vecs.unsqueeze(0).expand(bsz, -1, -1)
         num_cands_per_sample = cand_vecs.size(1)
-        bsz = cand_vecs.size(0)
-        text_idx = (
-            batch.text_vec.unsqueeze(1)
-            .expand(-1, num_cands_per_sample, -1)
-            .contiguous()
-            .view(num_cands_per_sample * bsz, -1)
-        )
-        cand_idx = cand_vecs.view(num_cands_per_sample * bsz, -1)
-        tokens, segments = concat_without_padding(
-            text_idx, cand_idx, self.use_cuda, self.NULL_IDX
+        tokens, segments = concat_candidates_without_padding(
+            batch.text_vec, cand_vecs, self.NULL_IDX
         )
         scores = self.model(tokens, segments)
         scores = scores.view(bsz, num_cands_per_sample)
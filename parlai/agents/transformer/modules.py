@@ -710,7 +710,8 @@ class TransformerDecoder(nn.Module):
             Output from the encoder module forward pass.
         :param incr_state:
             The incremental state: a dictionary whose keys index the layers and whose
-            values contain the incremental state for each layer.
+            values contain the incremental state for each layer, or a
+            TransformerDecoderCache.
         """
         encoder_output, encoder_mask = encoder_state
 
@@ -726,6 +727,10 @@ class TransformerDecoder(nn.Module):
         else:
             incr_state = {idx: {} for idx in range(len(self.layers))}
 
+        cached = isinstance(incr_state, TransformerDecoderCache)
+        if cached:
+            incr_state.ensure_capacity(incr_state.length + input.size(1))
+
         tensor = self.embeddings(input)
         if self.embeddings_scale:
             tensor = tensor * np.sqrt(self.dim)
@@ -747,9 +752,13 @@ class TransformerDecoder(nn.Module):
                 x=tensor,
                 encoder_output=encoder_output,
                 encoder_mask=encoder_mask,
-                incr_state=incr_state[idx],
+                incr_state=incr_state.layer_state(idx) if cached else incr_state[idx],
             )
 
+        if cached:
+            # the layers wrote their keys and values in place
+            incr_state.length += input.size(1)
+            return tensor, incr_state
         return tensor, new_incr_state
 
 
@@ -875,6 +884,122 @@ class TransformerDecoderLayer(nn.Module):
         }
 
 
+class TransformerDecoderCache(object):
+    """
+    Preallocated incremental state for the TransformerDecoder.
+
+    The self-attention keys and values of every decoder layer are kept in a single
+    [n_layers, 2, bsz, n_heads, capacity, dim_per_head] buffer, which each decoding
+    step writes into in place rather than concatenating onto the previous state.
+    The encoder-attention keys and values are constant during decoding, and are kept
+    in a single [n_layers, 2, bsz, n_heads, src_len, dim_per_head] tensor. This way
+    reordering the hypotheses for beam search is one gather over all layers.
+
+    The capacity is doubled whenever the decoded sequence outgrows it.
+    """
+
+    def __init__(self, self_kv, encoder_kv, encoder_mask, length):
+        self.self_kv = self_kv
+        self.encoder_kv = encoder_kv
+        self.encoder_mask = encoder_mask
+        self.length = length
+        # reorder() gathers into this buffer and swaps it with self_kv
+        self._spare_kv = torch.empty_like(self_kv)
+
+    @classmethod
+    def from_incr_state(
+        cls, incr_state: Dict[int, dict], capacity: int = 64
+    ) -> 'TransformerDecoderCache':
+        """
+        Build a cache from the incremental state returned by the TransformerDecoder.
+
+        :param incr_state:
+            dict whose keys are layer indices and whose values are the incremental
+            state of each layer.
+        :param capacity:
+            the minimum number of decoding steps to preallocate.
+        """
+        layers = [incr_state[idx] for idx in range(len(incr_state))]
+        prev_key = layers[0]['self_attn']['prev_key']
+        bsz, n_heads, length, dim_per_head = prev_key.size()
+        capacity = max(capacity, 2 * length)
+        self_kv = prev_key.new_empty(
+            len(layers), 2, bsz, n_heads, capacity, dim_per_head
+        )
+        for idx, layer in enumerate(layers):
+            self_kv[idx, 0, :, :, :length] = layer['self_attn']['prev_key']
+            self_kv[idx, 1, :, :, :length] = layer['self_attn']['prev_value']
+        encoder_kv = torch.stack(
+            [
+                torch.stack(
+                    [
+                        layer['encoder_attn']['prev_key'],
+                        layer['encoder_attn']['prev_value'],
+                    ]
+                )
+                for layer in layers
+            ]
+        )
+        encoder_mask = layers[0]['encoder_attn']['prev_mask']
+        return cls(self_kv, encoder_kv, encoder_mask, length)
+
+    def ensure_capacity(self, length: int):
+        """
+        Make sure the cache can hold the keys and values of length decoding steps.
+        """
+        capacity = self.self_kv.size(4)
+        if length <= capacity:
+            return
+        while capacity < length:
+            capacity *= 2
+        shape = list(self.self_kv.shape)
+        shape[4] = capacity
+        grown = self.self_kv.new_empty(shape)
+        grown[:, :, :, :, : self.length] = self.self_kv[:, :, :, :, : self.length]
+        self.self_kv = grown
+        self._spare_kv = torch.empty_like(grown)
+
+    def layer_state(self, idx: int) -> Dict[str, dict]:
+        """
+        Return the incremental state of a single TransformerDecoderLayer.
+
+        The keys and values are views into the cache, so the layer updates it in
+        place.
+        """
+        return {
+            'self_attn': {
+                'key_cache': self.self_kv[idx, 0],
+                'value_cache': self.self_kv[idx, 1],
+                'cache_length': self.length,
+            },
+            'encoder_attn': {
+                'prev_key': self.encoder_kv[idx, 0],
+                'prev_value': self.encoder_kv[idx, 1],
+                'prev_mask': self.encoder_mask,
+            },
+        }
+
+    def reorder(self, inds: torch.Tensor) -> 'TransformerDecoderCache':
+        """
+        Reorder the cache along the batch dimension, and return it.
+        """
+        if inds.size(0) != self.self_kv.size(2):
+            # the batch size changed, so the spare buffer can't be reused
+            shape = list(self.self_kv.shape)
+            shape[2] = inds.size(0)
+            self._spare_kv = self.self_kv.new_empty(shape)
+        torch.index_select(
+            self.self_kv[:, :, :, :, : self.length],
+            2,
+            inds,
+            out=self._spare_kv[:, :, :, :, : self.length],
+        )
+        self.self_kv, self._spare_kv = self._spare_kv, self.self_kv
+        self.encoder_kv = torch.index_select(self.encoder_kv, 2, inds)
+        self.encoder_mask = torch.index_select(self.encoder_mask, 0, inds)
+        return self
+
+
 class TransformerGeneratorModel(TorchGeneratorModel):
     """
     Implements a full generator model, with one encoder and one decoder.
@@ -942,12 +1067,16 @@ class TransformerGeneratorModel(TorchGeneratorModel):
         See ``TorchGeneratorModel.reorder_decoder_incremental_state`` for a description.
 
         Here, incremental_state is a dict whose keys are layer indices and whose values
-        are dicts containing the incremental state for that layer.
+        are dicts containing the incremental state for that layer, as returned by the
+        first decoding step. It is then moved into a preallocated
+        TransformerDecoderCache, which is updated in place by the following steps and
+        reordered here.
         """
-        return {
-            idx: layer.reorder_incremental_state(incremental_state[idx], inds)
-            for idx, layer in enumerate(self.decoder.layers)
-        }
+        if not isinstance(incremental_state, TransformerDecoderCache):
+            incremental_state = TransformerDecoderCache.from_incr_state(
+                incremental_state
+            )
+        return incremental_state.reorder(inds)
 
     def output(self, tensor):
         """
@@ -1103,17 +1232,36 @@ class MultiHeadAttention(nn.Module):
         assert key is not None  # let mypy know we sorted this
         _, _key_len, dim = key.size()
 
+        if incr_state is None:
+            incr_state = {}
+
         q = prepare_head(self.q_lin(query))
-        k = prepare_head(self.k_lin(key))
-        v = prepare_head(self.v_lin(value))
+        if static_kv and 'prev_key' in incr_state and 'prev_value' in incr_state:
+            # the key and value were already projected at the first step
+            k = v = None
+        else:
+            k = prepare_head(self.k_lin(key))
+            v = prepare_head(self.v_lin(value))
+
+        if 'key_cache' in incr_state:
+            # Preallocated cache (see TransformerDecoderCache): write the new key and
+            # value in place, and attend over everything written so far.
+            start = incr_state['cache_length']
+            end = start + k.size(1)
+            key_cache = incr_state['key_cache']
+            value_cache = incr_state['value_cache']
+            key_cache[:, :, start:end] = k.view(batch_size, n_heads, -1, dim_per_head)
+            value_cache[:, :, start:end] = v.view(batch_size, n_heads, -1, dim_per_head)
+            k = key_cache[:, :, :end].view(batch_size * n_heads, end, dim_per_head)
+            v = value_cache[:, :, :end].view(batch_size * n_heads, end, dim_per_head)
+            # every previous position is visible to the new ones
+            mask = torch.cat([mask.new_ones(batch_size, query_len, start), mask], dim=2)
 
         # Prepend incremental states. For each of the key, value, and mask, see if
         # a previous incremental state exists, and if so, reshape it to match the shape
         # of the new state. Concatenate the previous and new states to match what the
         # full state would have been if we had not cached. (If we are using static_kv,
         # these three states are unchanging, so just re-use the cached states.)
-        if incr_state is None:
-            incr_state = {}
         if 'prev_key' in incr_state:
             prev_key = incr_state['prev_key'].view(
                 batch_size * n_heads, -1, dim_per_head
@@ -1140,11 +1288,14 @@ class MultiHeadAttention(nn.Module):
 
         # Save new incremental states. We reshape to allow for reordering along batch
         # dimension.
-        new_incr_state = {
-            'prev_key': k.view(batch_size, n_heads, -1, dim_per_head),
-            'prev_value': v.view(batch_size, n_heads, -1, dim_per_head),
-            'prev_mask': mask,
-        }
+        if 'key_cache' in incr_state:
+            new_incr_state = incr_state
+        else:
+            new_incr_state = {
+                'prev_key': k.view(batch_size, n_heads, -1, dim_per_head),
+                'prev_value': v.view(batch_size, n_heads, -1, dim_per_head),
+                'prev_mask': mask,
+            }
 
         full_key_len = k.size(1)
         dot_prod = q.div_(scale).bmm(k.transpose(1, 2))
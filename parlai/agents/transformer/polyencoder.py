@@ -189,7 +189,7 @@ class PolyencoderAgent(TorchRankerAgent):
         elif len(cand_vecs.shape) == 2:
             _, _, _, cand_rep = self.model(cand_tokens=cand_vecs.unsqueeze(1))
             num_cands = cand_rep.size(0)  # will be bsz if using batch cands
-            cand_rep = cand_rep.expand(num_cands, bsz, -1).transpose(0, 1).contiguous()
+            cand_rep = cand_rep.expand(num_cands, bsz, -1).transpose(0, 1)
 
         scores = self.model(
             ctxt_rep=ctxt_rep,
@@ -199,6 +199,23 @@ class PolyencoderAgent(TorchRankerAgent):
         )
         return scores
 
+    def encode_retrieval_queries(self, batch):
+        """
+        Encode the context for the first stage of retrieval.
+
+        The candidates are retrieved with the mean of the context codes, then
+        reranked with the full poly-encoder attention by score_retrieved_candidates().
+        """
+        ctxt_rep, ctxt_rep_mask, _, _ = self.model(ctxt_tokens=batch.text_vec)
+        mask = ctxt_rep_mask.unsqueeze(2).to(ctxt_rep)
+        return (ctxt_rep * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    def score_retrieved_candidates(self, batch, queries, cand_encs):
+        """
+        Rerank the retrieved candidates with the poly-encoder attention.
+        """
+        return self.score_candidates(batch, None, cand_encs=cand_encs)
+
     def load_state_dict(self, state_dict):
         """
         Override to account for codes.
@@ -270,21 +270,31 @@ class TransformerRankerAgent(TorchRankerAgent):
 
         return cands
 
-    def score_candidates(self, batch, cand_vecs, cand_encs=None):
-        """
-        Score candidates.
-        """
+    def _build_mems(self, batch):
         # convoluted check that not all memories are empty
         if (
             self.opt['use_memories']
             and batch.memory_vecs is not None
             and sum(len(m) for m in batch.memory_vecs)
         ):
-            mems = padded_3d(
+            return padded_3d(
                 batch.memory_vecs, use_cuda=self.use_cuda, pad_idx=self.NULL_IDX
             )
-        else:
-            mems = None
+        return None
+
+    def encode_retrieval_queries(self, batch):
+        """
+        Encode the context, scored against the candidates with an inner product.
+        """
+        mems = self._build_mems(batch)
+        context_h, _ = self.model(xs=batch.text_vec, mems=mems, cands=None)
+        return context_h
+
+    def score_candidates(self, batch, cand_vecs, cand_encs=None):
+        """
+        Score candidates.
+        """
+        mems = self._build_mems(batch)
 
         if cand_encs is not None:
             # we pre-encoded the candidates, do not re-encode here
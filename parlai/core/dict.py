@@ -11,14 +11,23 @@ from parlai.core.opt import Opt
 from parlai.core.build_data import modelzoo_path
 from .agents import Agent
 from .build_data import make_dir
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from .gpt2_helper import Gpt2BpeHelper
+from parlai.utils.compact_vocab import (
+    CompactFreq,
+    CompactInd2Tok,
+    CompactTok2Ind,
+    CompactVocab,
+    write_compact_vocab,
+)
 import codecs
 import copy
+import hashlib
 import numpy as np
 import os
 import json
 import re
+import threading
 
 try:
     from subword_nmt import learn_bpe, apply_bpe
@@ -94,6 +103,98 @@ def find_ngrams(token_dict, text, n):
     return saved_tokens
 
 
+class TokenizationCache(object):
+    """
+    Bounded LRU cache from text to its token ids.
+
+    The cache is bounded by the total number of token ids it holds rather than
+    by the number of entries, so a few very long texts cannot blow up memory.
+    Entries are only valid for the dictionary fingerprint they were computed
+    with: looking up with a different fingerprint clears the cache.
+
+    :param max_tokens:
+        maximum number of token ids (plus one per entry) to keep.
+    """
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._cache = OrderedDict()
+        self._num_tokens = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy in another process, e.g. an evaluation worker, starts empty
+        state = self.__dict__.copy()
+        state['_version'] = None
+        state['_cache'] = OrderedDict()
+        state['_num_tokens'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def lookup(self, version, text):
+        """
+        Return the cached token ids of ``text``, or None if not cached.
+
+        :param version:
+            fingerprint of the dictionary in use.
+        """
+        with self._lock:
+            if self._version != version:
+                self._clear()
+                self._version = version
+            vec = self._cache.get(text)
+            if vec is None:
+                self.misses += 1
+            else:
+                self._cache.move_to_end(text)
+                self.hits += 1
+            return vec
+
+    def store(self, text, vec):
+        """
+        Cache the token ids of ``text``, evicting the least recently used.
+        """
+        size = len(vec) + 1
+        if size > self.max_tokens:
+            return
+        with self._lock:
+            if text in self._cache:
+                return
+            self._cache[text] = vec
+            self._num_tokens += size
+            while self._num_tokens > self.max_tokens:
+                _, old = self._cache.popitem(last=False)
+                self._num_tokens -= len(old) + 1
+
+    def _clear(self):
+        self._cache.clear()
+        self._num_tokens = 0
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._clear()
+
+    def reset_counters(self):
+        """
+        Reset the hit and miss counters.
+        """
+        self.hits = 0
+        self.misses = 0
+
+
 class DictionaryAgent(Agent):
     """
     Builds and/or loads a dictionary.
@@ -114,6 +215,7 @@ class DictionaryAgent(Agent):
     default_tok = 're'
     default_lower = False
     default_textfields = 'text,labels'
+    default_cache_size = 0
 
     @staticmethod
     def add_cmdline_args(argparser):
@@ -210,6 +312,26 @@ class DictionaryAgent(Agent):
             hidden=True,
             help='Leave BPE tokens untouched in output. Useful for debugging.',
         )
+        dictionary.add_argument(
+            '--dict-tokenization-cache-size',
+            default=DictionaryAgent.default_cache_size,
+            type=int,
+            hidden=True,
+            help='Cache the token ids of recently vectorized texts, up to this '
+            'many token ids in total. Off (0) by default: every lookup takes a '
+            'lock, which only pays off when the same texts are vectorized '
+            'repeatedly, e.g. label candidates.',
+        )
+        dictionary.add_argument(
+            '--dict-compact',
+            default=False,
+            type='bool',
+            hidden=True,
+            help='Load the dictionary from a compact binary copy, written next to '
+            'the dict file on first load. The copy is memory-mapped, which saves '
+            'startup time and memory for large vocabularies, especially when '
+            'many processes load the same dictionary.',
+        )
         dictionary.add_argument(
             '--dict-textfields',
             default=DictionaryAgent.default_textfields,
@@ -236,6 +358,7 @@ class DictionaryAgent(Agent):
         self.tokenizer = opt.get('dict_tokenizer', DictionaryAgent.default_tok)
         self.lower = opt.get('dict_lower', DictionaryAgent.default_lower)
         self.maxtokens = opt.get('dict_maxtokens', DictionaryAgent.default_maxtokens)
+        self.compact = opt.get('dict_compact', False)
         self.textfields = opt.get(
             'dict_textfields', DictionaryAgent.default_textfields
         ).split(",")
@@ -251,10 +374,20 @@ class DictionaryAgent(Agent):
             self.freq = shared.get('freq', {})
             self.tok2ind = shared.get('tok2ind', {})
             self.ind2tok = shared.get('ind2tok', {})
+            self.tokenization_cache = shared.get('tokenization_cache')
+            self._fingerprint_memo = shared.get('fingerprint_memo', {})
         else:
             self.freq = defaultdict(int)
             self.tok2ind = {}
             self.ind2tok = {}
+            cache_size = opt.get(
+                'dict_tokenization_cache_size', DictionaryAgent.default_cache_size
+            )
+            self.tokenization_cache = (
+                TokenizationCache(cache_size) if cache_size > 0 else None
+            )
+            # shared with copies, so a change by any of them invalidates it
+            self._fingerprint_memo = {}
 
             if self.null_token:
                 self.add_token(self.null_token)
@@ -356,14 +489,26 @@ class DictionaryAgent(Agent):
             if opt.get('dict_file'):
                 self.save_path = opt['dict_file']
 
+    def _thaw(self):
+        """
+        Replace a compact vocabulary by dicts, before adding or removing tokens.
+        """
+        self._fingerprint_memo.clear()
+        if isinstance(self.tok2ind, CompactTok2Ind):
+            self.freq = defaultdict(int, self.freq.items())
+            self.tok2ind = dict(self.tok2ind.items())
+            self.ind2tok = dict(self.ind2tok.items())
+
     def add_token(self, word):
         """
         Add a single token to the dictionary.
         """
         if word not in self.tok2ind:
+            self._thaw()
             index = len(self.tok2ind)
             self.tok2ind[word] = index
             self.ind2tok[index] = word
+            self._fingerprint_memo.clear()
 
     def __contains__(self, key):
         """
@@ -412,6 +557,9 @@ class DictionaryAgent(Agent):
         key = str(key)
         if self.lower:
             key = key.lower()
+        if key not in self.tok2ind:
+            # the frequencies of known tokens can be changed in a compact vocab
+            self._thaw()
         self.freq[key] = int(value)
         self.add_token(key)
 
@@ -431,6 +579,49 @@ class DictionaryAgent(Agent):
         for k, v in vars(dictionary).items():
             setattr(self, k, v)
 
+    def fingerprint(self):
+        """
+        Return a digest identifying how this dictionary maps text to indices.
+
+        Two dictionaries with the same fingerprint produce the same ``txt2vec``
+        output, so the digest may be used to validate token ids computed ahead
+        of time (e.g. in compiled teacher data). The digest is cached until the
+        vocabulary is modified or replaced, or the tokenizer settings change.
+        """
+        bpehelper = getattr(self, 'bpehelper', None)
+        key = (
+            id(self.tok2ind),
+            len(self.tok2ind),
+            self.tokenizer,
+            self.lower,
+            self.max_ngram_size,
+            self.unk_token,
+            # bpe codecs are only loaded once learned
+            id(getattr(bpehelper, 'bpe', None)),
+        )
+        memo = self._fingerprint_memo
+        if memo.get('key') != key:
+            digest = hashlib.md5()
+            settings = [
+                type(self).__module__,
+                type(self).__qualname__,
+                self.tokenizer,
+                self.lower,
+                self.max_ngram_size,
+                self.unk_token,
+                len(self.tok2ind),
+            ]
+            digest.update(json.dumps(settings).encode('utf-8'))
+            for i in range(len(self.ind2tok)):
+                digest.update(escape(self.ind2tok.get(i, '')).encode('utf-8'))
+                digest.update(b'\n')
+            if self.tokenizer == 'bpe' and os.path.isfile(self.bpehelper.codecs):
+                with open(self.bpehelper.codecs, 'rb') as f:
+                    digest.update(f.read())
+            memo['key'] = key
+            memo['fingerprint'] = digest.hexdigest()
+        return memo['fingerprint']
+
     def max_freq(self):
         """
         Return the largest frequency of any nonspecial token.
@@ -575,6 +766,7 @@ class DictionaryAgent(Agent):
         Build dictionary from the list of provided tokens.
         """
         self.built = False
+        self._thaw()
         for token in tokens:
             self.add_token(token)
             self.freq[token] += 1
@@ -583,6 +775,7 @@ class DictionaryAgent(Agent):
         """
         Remove elements below the frequency cutoff from the dictionary.
         """
+        self._thaw()
         to_remove = []
         for token, freq in self.freq.items():
             if freq < min_freq:
@@ -598,6 +791,7 @@ class DictionaryAgent(Agent):
         """
         Set the dictionary vocab to the bpe vocab, merging counts.
         """
+        self._thaw()
         to_remove = []
         to_add = []
         for token, freq in self.freq.items():
@@ -619,6 +813,7 @@ class DictionaryAgent(Agent):
         Trims the dictionary to the maximum number of tokens.
         """
         if maxtokens >= 0 and len(self.tok2ind) > maxtokens:
+            self._thaw()
             for k in range(maxtokens, len(self.ind2tok)):
                 v = self.ind2tok[k]
                 del self.ind2tok[k]
@@ -632,7 +827,25 @@ class DictionaryAgent(Agent):
         Initialize counts from other dictionary, or 0 if they aren't included.
         """
         print('Dictionary: loading dictionary from {}'.format(filename))
+        if self.compact and isinstance(self.tok2ind, dict):
+            initial_tokens = list(self.tok2ind)
+            if self._load_compact(filename, initial_tokens) or (
+                self._save_compact(filename, initial_tokens)
+                and self._load_compact(filename, initial_tokens)
+            ):
+                print('[ num words =  %d ]' % len(self))
+                return
+
+        self._thaw()
+        for token, cnt in self._read_dict_file(filename):
+            self.freq[token] = cnt
+            self.add_token(token)
+        print('[ num words =  %d ]' % len(self))
 
+    def _read_dict_file(self, filename):
+        """
+        Iterate over the (token, count) pairs of a dictionary file.
+        """
         lower_special = self.null_token == self.null_token.lower()
         SPECIAL_TOKENS = {'__UNK__', '__NULL__', '__END__', '__START__'}
         with codecs.open(filename, 'r', encoding='utf-8', errors='ignore') as read:
@@ -642,9 +855,65 @@ class DictionaryAgent(Agent):
                 if lower_special and token in SPECIAL_TOKENS:
                     token = token.lower()
                 cnt = int(split[1]) if len(split) > 1 else 0
-                self.freq[token] = cnt
-                self.add_token(token)
-        print('[ num words =  %d ]' % len(self))
+                yield token, cnt
+
+    def _compact_metadata(self, filename, initial_tokens):
+        """
+        Identify the dictionary that loading filename after initial_tokens gives.
+        """
+        digest = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return {
+            'source_md5': digest.hexdigest(),
+            'initial_tokens': initial_tokens,
+            'lower_special': self.null_token == self.null_token.lower(),
+        }
+
+    def _load_compact(self, filename, initial_tokens):
+        """
+        Map the compact copy of a dictionary file, if it is up to date.
+
+        :returns: whether the compact copy was loaded.
+        """
+        path = filename + '.compact'
+        if not os.path.isfile(path):
+            return False
+        try:
+            vocab = CompactVocab(path)
+        except (OSError, ValueError):
+            return False
+        if vocab.metadata != self._compact_metadata(filename, initial_tokens):
+            return False
+        self.freq = CompactFreq(vocab)
+        self.tok2ind = CompactTok2Ind(vocab)
+        self.ind2tok = CompactInd2Tok(vocab)
+        return True
+
+    def _save_compact(self, filename, initial_tokens):
+        """
+        Write the compact copy of a dictionary file, as loaded after initial_tokens.
+
+        :returns: whether the copy could be written.
+        """
+        tok2ind = {t: i for i, t in enumerate(initial_tokens)}
+        tokens = list(initial_tokens)
+        freqs = [0] * len(tokens)
+        for token, cnt in self._read_dict_file(filename):
+            if token in tok2ind:
+                freqs[tok2ind[token]] = cnt
+            else:
+                tok2ind[token] = len(tokens)
+                tokens.append(token)
+                freqs.append(cnt)
+        metadata = self._compact_metadata(filename, initial_tokens)
+        try:
+            write_compact_vocab(filename + '.compact', tokens, freqs, metadata)
+        except OSError:
+            # e.g. read-only directory: keep using the text file
+            return False
+        return True
 
     def save(self, filename=None, append=False, sort=True):
         """
@@ -687,6 +956,20 @@ class DictionaryAgent(Agent):
                 cnt = self.freq[tok]
                 write.write('{tok}\t{cnt}\n'.format(tok=escape(tok), cnt=cnt))
 
+        if self.compact:
+            # the tokens a new dictionary starts with, before loading this file
+            special_tokens = [
+                t
+                for t in (
+                    self.null_token,
+                    self.start_token,
+                    self.end_token,
+                    self.unk_token,
+                )
+                if t
+            ]
+            self._save_compact(filename, list(dict.fromkeys(special_tokens)))
+
         # save opt file
         with open(filename + '.opt', 'w', encoding='utf-8') as handle:
             json.dump(self.opt, handle, indent=4)
@@ -705,6 +988,7 @@ class DictionaryAgent(Agent):
         """
         if trim and self.tokenizer == 'gpt2':
             raise RuntimeError("You should not trim the dictionary when using gpt-2.")
+        self._thaw()
         # sort first by count, then alphabetically
         if trim:
             self.remove_tail(self.minfreq)
@@ -746,11 +1030,19 @@ class DictionaryAgent(Agent):
             The type of the returned vector if the input is a string. Suggested
             ``list``, ``tuple``, ``set``, or ``np.ndarray``.
         """
-        itr = (self._word_lookup(token) for token in self.tokenize(str(text)))
+        text = str(text)
+        cache = self.tokenization_cache
+        vec = None
+        if cache is not None:
+            vec = cache.lookup(self.fingerprint(), text)
+        if vec is None:
+            vec = tuple(self._word_lookup(token) for token in self.tokenize(text))
+            if cache is not None:
+                cache.store(text, vec)
         if vec_type == list or vec_type == tuple or vec_type == set:
-            res = vec_type(itr)
+            res = vec_type(vec)
         elif vec_type == np.ndarray:
-            res = np.fromiter(itr, np.int)
+            res = np.fromiter(vec, np.int)
         else:
             raise RuntimeError('Type {} not supported by dict'.format(vec_type))
         return res
@@ -803,6 +1095,8 @@ class DictionaryAgent(Agent):
         shared['freq'] = self.freq
         shared['tok2ind'] = self.tok2ind
         shared['ind2tok'] = self.ind2tok
+        shared['tokenization_cache'] = self.tokenization_cache
+        shared['fingerprint_memo'] = self._fingerprint_memo
         return shared
 
     def shutdown(self):
@@ -13,10 +13,16 @@ processes.
 import re
 from abc import ABC, abstractmethod
 from collections import Counter
+import ctypes
+import importlib
+import math
+import os
 import queue
 import functools
+import threading
 from typing import Union, List, Optional, Tuple, Set, Any, Dict
 
+import numpy as np
 import torch
 
 from parlai.core.message import Message
@@ -339,6 +345,19 @@ class RougeMetric(AverageMetric):
 
         :return: (rouge-1, rouge-2, rouge-L)
         """
+        return RougeMetric._compute_normalized(
+            normalize_answer(guess), [normalize_answer(a) for a in answers]
+        )
+
+    @staticmethod
+    def _compute_normalized(
+        guess: str, answers: List[str]
+    ) -> Tuple[
+        Optional['RougeMetric'], Optional['RougeMetric'], Optional['RougeMetric']
+    ]:
+        """
+        Compute ROUGE scores between already normalized guess and answers.
+        """
         # possible global initialization
         global rouge
         if rouge is None:
@@ -348,12 +367,7 @@ class RougeMetric(AverageMetric):
                 metrics=['rouge-n', 'rouge-l'], max_n=2
             )
         try:
-            scores = [
-                RougeMetric._evaluator.get_scores(
-                    normalize_answer(guess), normalize_answer(a)
-                )
-                for a in answers
-            ]
+            scores = [RougeMetric._evaluator.get_scores(guess, a) for a in answers]
         except LookupError:
             warn_once(
                 'ROUGE requires nltk punkt tokenizer. Please run '
@@ -384,6 +398,138 @@ def normalize_answer(s):
     return s
 
 
+class _NormalizedTexts(object):
+    """
+    Normalize each distinct text of a batch once, and map its tokens to integer ids.
+    """
+
+    def __init__(self):
+        self._texts: Dict[str, Tuple[str, List[int]]] = {}
+        self._vocab: Dict[str, int] = {}
+
+    def get(self, text: str) -> Tuple[str, List[int]]:
+        """
+        Return the normalized text, and the ids of its whitespace-split tokens.
+        """
+        result = self._texts.get(text)
+        if result is None:
+            norm = normalize_answer(text)
+            vocab = self._vocab
+            ids = [vocab.setdefault(t, len(vocab)) for t in norm.split()]
+            result = self._texts[text] = (norm, ids)
+        return result
+
+    def bleu_ids(self, ids: List[int]) -> List[int]:
+        # BleuMetric splits on ' ', which gives [''] for an empty text
+        return ids if ids else [self._vocab.setdefault('', len(self._vocab))]
+
+
+def _ngram_counts(ids: List[int], n: int) -> Counter:
+    return Counter(zip(*[ids[i:] for i in range(n)]))
+
+
+def _bleu_scores(guess: List[int], answers: List[List[int]], ks: List[int]):
+    """
+    Compute BLEU-k for each k in ks, from a single count of the n-grams.
+
+    Gives the same floats as ``BleuMetric.compute``, i.e. as NLTK's
+    ``sentence_bleu`` with epsilon smoothing: the modified precisions are integer
+    counts, combined with the same floating point operations.
+    """
+    max_n = max(ks)
+    numerators = []
+    denominators = []
+    for n in range(1, max_n + 1):
+        numerator = 0
+        if numerators[:1] != [0] and len(guess) >= n:
+            # otherwise, all scores are 0 anyway
+            max_counts = _ngram_counts(answers[0], n)
+            for answer in answers[1:]:
+                max_counts |= _ngram_counts(answer, n)
+            clipped = _ngram_counts(guess, n) & max_counts
+            numerator = sum(clipped.values())
+        numerators.append(numerator)
+        denominators.append(max(1, len(guess) - n + 1))
+
+    hyp_len = len(guess)
+    ref_len = min((len(a) for a in answers), key=lambda r: (abs(r - hyp_len), r))
+    if hyp_len > ref_len:
+        bp = 1
+    elif hyp_len == 0:
+        bp = 0
+    else:
+        bp = math.exp(1 - ref_len / hyp_len)
+
+    scores = {}
+    for k in ks:
+        if numerators[0] == 0:
+            scores[k] = 0
+            continue
+        weight = 1 / k
+        log_precisions = [
+            weight * math.log((num + 1e-12) / den if num == 0 else num / den)
+            for num, den in zip(numerators[:k], denominators[:k])
+        ]
+        scores[k] = bp * math.exp(math.fsum(log_precisions))
+    return scores
+
+
+def compute_text_metrics(
+    guesses: List[str], answers: List[List[str]], metrics_list: Set[str]
+) -> List[Dict[str, Metric]]:
+    """
+    Compute the text-based metrics (accuracy, F1, BLEU, ROUGE) of a batch.
+
+    The results are numerically identical to those of ``ExactMatchMetric``,
+    ``F1Metric``, ``BleuMetric`` and ``RougeMetric`` on each example, but each
+    distinct text is normalized and tokenized only once per batch, and BLEU-1..4
+    share their n-gram counts.
+
+    :param guesses: the predicted text of each example.
+    :param answers: the labels of each example.
+    :param metrics_list: the metrics wanted, besides accuracy and F1.
+
+    :return: for each example, a dict from metric names to their value.
+    """
+    texts = _NormalizedTexts()
+    bleu_ks = [k for k in range(1, 5) if f'bleu-{k}' in metrics_list]
+    results = []
+    for guess, labels in zip(guesses, answers):
+        if labels is None:
+            results.append({'f1': AverageMetric(0, 0)})
+            continue
+        g_norm, g_ids = texts.get(guess)
+        normalized = [texts.get(a) for a in labels]
+        result: Dict[str, Metric] = {}
+        result['accuracy'] = ExactMatchMetric(
+            int(any(g_norm == a_norm for a_norm, _ in normalized))
+        )
+        result['f1'] = F1Metric(
+            max(
+                F1Metric._prec_recall_f1_score(g_ids, a_ids)[2]
+                for _, a_ids in normalized
+            ),
+            1,
+        )
+        if bleu_ks and nltkbleu is not None:
+            bleu = _bleu_scores(
+                texts.bleu_ids(g_ids),
+                [texts.bleu_ids(a_ids) for _, a_ids in normalized],
+                bleu_ks,
+            )
+            for k in bleu_ks:
+                result[f'bleu-{k}'] = BleuMetric(bleu[k])
+        if metrics_list & ROUGE_METRICS:
+            rouges = RougeMetric._compute_normalized(
+                g_norm, [a_norm for a_norm, _ in normalized]
+            )
+            for name, value in zip(('rouge-1', 'rouge-2', 'rouge-L'), rouges):
+                if name in metrics_list and value is not None:
+                    result[name] = value
+        results.append(result)
+    return results
+
+
 def aggregate_named_reports(named_reports: Dict[str, Dict[str, Metric]]):
     """
     Aggregate metrics from multiple reports.
@@ -411,38 +557,225 @@ def aggregate_unnamed_reports(reports: List[Dict[str, Metric]]):
     return m
 
 
+class _SharedMetricSlots(object):
+    """
+    Preallocated shared memory for the metrics of worker processes.
+
+    Each worker process owns a row of numerators, denominators and counts, with one
+    column per metric key, which it updates without locking or IPC. The reporter sums
+    the rows on demand. Only new keys take a lock, to register their name and type in
+    a shared table.
+
+    Metrics which are not a ``SumMetric`` or an ``AverageMetric`` cannot be stored as
+    a numerator and denominator, so ``add()`` refuses them, as well as keys once the
+    table is full or processes once every row is taken.
+    """
+
+    def __init__(self, num_workers, max_keys=1024, max_name_len=256):
+        self.num_workers = num_workers
+        self.max_keys = max_keys
+        self.max_name_len = max_name_len
+        size = num_workers * max_keys
+        self._numers = multiprocessing.RawArray(ctypes.c_double, size)
+        self._denoms = multiprocessing.RawArray(ctypes.c_double, size)
+        self._counts = multiprocessing.RawArray(ctypes.c_longlong, size)
+        # whether a row ever stored a float, so ints can be reported as ints
+        self._floats = multiprocessing.RawArray(ctypes.c_bool, size)
+        self._names = multiprocessing.RawArray(ctypes.c_char, max_keys * max_name_len)
+        self._num_keys = multiprocessing.RawValue(ctypes.c_int, 0)
+        self._num_rows = multiprocessing.RawValue(ctypes.c_int, 0)
+        self._lock = multiprocessing.Lock()
+        self._local = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def _get_local(self):
+        """
+        Return the state private to this process, creating it after a fork.
+        """
+        pid = os.getpid()
+        if self._local is None or self._local['pid'] != pid:
+            shape = (self.num_workers, self.max_keys)
+            self._local = {
+                'pid': pid,
+                'row': None,
+                # key -> (column, type), mirrors the shared table
+                'keys': {} if self._local is None else self._local['keys'],
+                'lock': threading.Lock(),
+                'numers': np.frombuffer(self._numers, np.float64).reshape(shape),
+                'denoms': np.frombuffer(self._denoms, np.float64).reshape(shape),
+                'counts': np.frombuffer(self._counts, np.int64).reshape(shape),
+                'floats': np.frombuffer(self._floats, np.bool_).reshape(shape),
+            }
+        return self._local
+
+    def _read_keys(self, local):
+        """
+        Update the local copy of the key table with any newly registered keys.
+        """
+        keys = local['keys']
+        for col in range(len(keys), self._num_keys.value):
+            start = col * self.max_name_len
+            name = self._names[start : start + self.max_name_len]
+            key, cls_name = name.rstrip(b'\0').decode('utf-8').split('\0')
+            module, qualname = cls_name.split(':')
+            keys[key] = (col, getattr(importlib.import_module(module), qualname))
+        return keys
+
+    def _register(self, local, key, cls):
+        """
+        Find or register the column of a key.
+        """
+        with self._lock:
+            keys = self._read_keys(local)
+            if key in keys:
+                return keys[key]
+            name = '{}\0{}:{}'.format(key, cls.__module__, cls.__qualname__)
+            name = name.encode('utf-8')
+            col = self._num_keys.value
+            if col >= self.max_keys or len(name) >= self.max_name_len:
+                return None
+            start = col * self.max_name_len
+            self._names[start : start + len(name)] = name
+            self._num_keys.value = col + 1
+            keys[key] = (col, cls)
+            return keys[key]
+
+    def _get_row(self, local):
+        if local['row'] is None:
+            with self._lock:
+                if self._num_rows.value < self.num_workers:
+                    local['row'] = self._num_rows.value
+                    self._num_rows.value += 1
+                else:
+                    local['row'] = -1
+        return local['row']
+
+    def add(self, key: str, value: Metric) -> bool:
+        """
+        Add a metric to the row of this process.
+
+        :return:
+            whether the metric was stored. If not, it must be aggregated some other
+            way.
+        """
+        if isinstance(value, AverageMetric):
+            numer, denom = value._numer, value._denom
+        elif isinstance(value, SumMetric):
+            numer, denom = value._sum, 0
+        else:
+            return False
+        local = self._get_local()
+        row = self._get_row(local)
+        if row < 0:
+            return False
+        entry = local['keys'].get(key) or self._register(local, key, type(value))
+        if entry is None:
+            return False
+        col = entry[0]
+        with local['lock']:
+            local['numers'][row, col] += numer
+            local['denoms'][row, col] += denom
+            local['counts'][row, col] += 1
+            if not (isinstance(numer, int) and isinstance(denom, int)):
+                local['floats'][row, col] = True
+        return True
+
+    def totals(self):
+        """
+        Return the sums of the numerators, denominators and counts over all rows.
+        """
+        local = self._get_local()
+        # snapshot the key table under the lock writers register new keys with
+        with self._lock:
+            keys = dict(self._read_keys(local))
+        num_keys = len(keys)
+        return (
+            keys,
+            local['numers'][:, :num_keys].sum(axis=0),
+            local['denoms'][:, :num_keys].sum(axis=0),
+            local['counts'][:, :num_keys].sum(axis=0),
+            local['floats'][:, :num_keys].any(axis=0),
+        )
+
+    @staticmethod
+    def to_metrics(keys, numers, denoms, counts, floats, baseline=None):
+        """
+        Build the metrics from (possibly summed) totals.
+
+        Counts since the ``baseline`` totals are reported, if given.
+        """
+        if baseline is not None:
+            num_base = len(baseline[0])
+            numers = numers.copy()
+            denoms = denoms.copy()
+            counts = counts.copy()
+            numers[:num_base] -= baseline[1]
+            denoms[:num_base] -= baseline[2]
+            counts[:num_base] -= baseline[3]
+        metrics = {}
+        for key, (col, cls) in keys.items():
+            if counts[col] <= 0:
+                continue
+            numer, denom = numers[col].item(), denoms[col].item()
+            if not floats[col]:
+                numer, denom = int(numer), int(denom)
+            if issubclass(cls, SumMetric):
+                metrics[key] = cls(numer)
+            else:
+                metrics[key] = cls(numer, denom)
+        return metrics
+
+
 class Metrics(object):
     """
     Threadsafe metrics container focused on aggregation.
     """
 
-    def __init__(self, threadsafe=False, shared=None):
+    def __init__(self, threadsafe=False, shared=None, num_workers=None):
+        """
+        :param threadsafe:
+            whether the metrics are shared by several processes (i.e. hogwild).
+        :param shared:
+            the result of ``share()``, for clones.
+        :param num_workers:
+            the number of processes which may add metrics, if threadsafe. Defaults
+            to the number of CPUs.
+        """
         self._threadsafe = threadsafe
         if self._threadsafe and shared is None:
-            # Threadsafe metrics tracking works by keeping a queue that workers can
-            # push updates to. the main worker works through the queue at report
-            # time. We could add some buffering to improve performance, but we
-            # are deprioritizing hogwild performance at this time.
+            # Threadsafe metrics tracking works by giving each worker process a row
+            # of slots in shared memory, which it updates without any IPC. The main
+            # worker sums the rows at report time. Metrics which don't fit in the
+            # slots go through a queue that the main worker works through instead.
             self._buffer = None
             self._queue = multiprocessing.SimpleQueue()
+            self._slots = _SharedMetricSlots(num_workers or os.cpu_count() or 1)
+            self._baseline = None
             self._worker = False
             self._data = {}
         elif shared and 'queue' in shared:
             # This is a clone, in threadsafe mode
             self._buffer = {}
             self._queue = shared['queue']
+            self._slots = shared['slots']
             self._worker = True
             self._data = None
         elif shared and 'data' in shared:
             # This is a clone, in non-threadsafe mode
             self._buffer = None
             self._queue = None
+            self._slots = None
             self._worker = False
             self._data = shared['data']
         else:
             # The original in non-threadsafe mode
             self._buffer = None
             self._queue = None
+            self._slots = None
             self._worker = False
             self._data = {}
 
@@ -466,7 +799,13 @@ class Metrics(object):
         Clear the local buffer and push it on.
         """
         if self._threadsafe and self._buffer:
-            self._queue.put(self._buffer)
+            leftover = {
+                key: value
+                for key, value in self._buffer.items()
+                if not self._slots.add(key, value)
+            }
+            if leftover:
+                self._queue.put(leftover)
             self._buffer.clear()
 
     def report(self):
@@ -474,7 +813,17 @@ class Metrics(object):
         Report the metrics over all data seen so far.
         """
         self.sync()
-        return {k: v for k, v in self._data.items()}
+        report = {k: v for k, v in self._data.items()}
+        if self._threadsafe and not self._worker:
+            shared = self._slots.to_metrics(
+                *self._slots.totals(), baseline=self._baseline
+            )
+            for key, value in shared.items():
+                if key in report:
+                    report[key] = report[key] + value
+                else:
+                    report[key] = value
+        return report
 
     def sync(self):
         """
@@ -506,12 +855,15 @@ class Metrics(object):
         elif self._threadsafe and not self._worker:
             for _ in self._drain_queue():
                 pass
+            # workers own their slots, so remember the totals to subtract
+            # instead of resetting them
+            self._baseline = self._slots.totals()
         if self._data:
             self._data.clear()
 
     def share(self):
         if self._threadsafe:
-            return {'queue': self._queue}
+            return {'queue': self._queue, 'slots': self._slots}
         else:
             return {'data': self._data}
 
@@ -526,10 +878,13 @@ class TeacherMetrics(Metrics):
         threadsafe: bool = False,
         metrics_list: str = "default",
         shared: Dict[str, Any] = None,
+        num_workers: Optional[int] = None,
     ) -> None:
-        super().__init__(threadsafe=threadsafe, shared=shared)
+        super().__init__(threadsafe=threadsafe, shared=shared, num_workers=num_workers)
         self._metrics_list = self._infer_metrics(metrics_list)
         self.eval_pr = [1, 5, 10, 100]
+        # (prediction, labels, text metrics) computed ahead with a whole batch
+        self._precomputed: Optional[Tuple[str, List[str], Dict[str, Metric]]] = None
 
     @staticmethod
     def _infer_metrics(cli_arg: str) -> Set[str]:
@@ -574,6 +929,40 @@ class TeacherMetrics(Metrics):
         for k in self.eval_pr:
             self.add(f'hits@{k}', AverageMetric(cnts[k] > 0))
 
+    @staticmethod
+    def precompute_batch(
+        teacher_metrics: List['TeacherMetrics'],
+        predictions: List[str],
+        labels: List[List[str]],
+    ) -> None:
+        """
+        Compute the text-based metrics of a batch of responses in one call.
+
+        Each ``TeacherMetrics`` keeps the result of its response, which its next
+        ``evaluate_response()`` uses if called with the same prediction and labels.
+        """
+        groups: Dict[frozenset, List[int]] = {}
+        for i, metrics in enumerate(teacher_metrics):
+            groups.setdefault(frozenset(metrics._metrics_list), []).append(i)
+        for metrics_list, indices in groups.items():
+            results = compute_text_metrics(
+                [predictions[i] for i in indices],
+                [labels[i] for i in indices],
+                set(metrics_list),
+            )
+            for i, result in zip(indices, results):
+                teacher_metrics[i]._precomputed = (predictions[i], labels[i], result)
+
+    def _text_metrics(self, prediction: str, labels: List[str]) -> Dict[str, Metric]:
+        precomputed, self._precomputed = self._precomputed, None
+        if (
+            precomputed is not None
+            and precomputed[0] == prediction
+            and precomputed[1] == labels
+        ):
+            return precomputed[2]
+        return compute_text_metrics([prediction], [labels], self._metrics_list)[0]
+
     def evaluate_response(self, observation: Message, labels: List[str]) -> None:
         """
         Compute all required text-based metrics based on an observation and labels.
@@ -583,21 +972,8 @@ class TeacherMetrics(Metrics):
         self.add('exs', SumMetric(1))
 
         if prediction is not None:
-            self.add('accuracy', ExactMatchMetric.compute(prediction, labels))
-            self.add('f1', F1Metric.compute(prediction, labels))
-
-            for k in range(1, 5):  # 1..4
-                if f'bleu-{k}' in self._metrics_list:
-                    self.add(f'bleu-{k}', BleuMetric.compute(prediction, labels, k))
-            # if any of the rouges are in the list
-            if self._metrics_list & ROUGE_METRICS:
-                r1, r2, rL = RougeMetric.compute_many(prediction, labels)
-                if 'rouge-1' in self._metrics_list:
-                    self.add('rouge-1', r1)
-                if 'rouge-2' in self._metrics_list:
-                    self.add('rouge-2', r2)
-                if 'rouge-L' in self._metrics_list:
-                    self.add('rouge-L', rL)
+            for key, value in self._text_metrics(prediction, labels).items():
+                self.add(key, value)
 
         # Ranking metrics.
         self._update_ranking_metrics(observation, labels)
@@ -608,7 +984,7 @@ class TeacherMetrics(Metrics):
                 if uk in ALL_METRICS:
                     # don't let the user override our metrics
                     uk = f'USER_{uk}'
-                assert isinstance(uk, str), type(k)
+                assert isinstance(uk, str), type(uk)
                 if not isinstance(v, Metric):
                     warn_once(f'Metric {uk} is assumed to be averaged per example.')
                     v = AverageMetric(v)
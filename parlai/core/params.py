@@ -649,6 +649,14 @@ class ParlaiParser(argparse.ArgumentParser):
             help='number of threads. Used for hogwild if batchsize is 1, else '
             'for number of threads in threadpool loading,',
         )
+        parlai.add_argument(
+            '--num-load-threads',
+            default=1,
+            type=int,
+            hidden=True,
+            help='number of threads of the data loader of teachers, e.g. the '
+            'number of chunks read in parallel by chunk teachers.',
+        )
         parlai.add_argument(
             '--hide-labels',
             default=False,
@@ -657,6 +665,15 @@ class ParlaiParser(argparse.ArgumentParser):
             help='default (False) moves labels in valid and test sets to the '
             'eval_labels field. If True, they are hidden completely.',
         )
+        parlai.add_argument(
+            '--compiled-data',
+            default=False,
+            type='bool',
+            hidden=True,
+            help='If True, DialogTeacher data is compiled once into a '
+            'memory-mapped binary format under {datapath}/compiled and read '
+            'from there, rather than held in memory. Ignored when streaming.',
+        )
         parlai.add_argument(
             '-mtw',
             '--multitask-weights',
@@ -678,8 +695,27 @@ class ParlaiParser(argparse.ArgumentParser):
             '--dynamic-batching',
             default=None,
             type='nonestr',
-            choices={None, 'full', 'batchsort'},
-            help='Use dynamic batching',
+            choices={None, 'full', 'batchsort', 'packed'},
+            help='Use dynamic batching. "packed" fills batches up to the same '
+            'token budget as "full", counting padding, to waste less compute on '
+            'pad tokens',
+        )
+        parlai.add_argument(
+            '--batch-prefetch',
+            default=0,
+            type=int,
+            help='When training with batches, prepare the upcoming batches on '
+            'background threads while the model trains on the current one, '
+            'with the teachers acting up to this many batches ahead. 0 '
+            'disables prefetching.',
+            hidden=True,
+        )
+        parlai.add_argument(
+            '--batch-prefetch-workers',
+            default=1,
+            type=int,
+            help='Number of threads building prefetched batches.',
+            hidden=True,
         )
         self.add_parlai_data_path(parlai)
 
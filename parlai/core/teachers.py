@@ -25,8 +25,9 @@ This module provides a set of teachers that deal with dialog.
      See the class description for more details. **This class is deprecated**.
 
 This module also includes ``DataLoader``, a threadpool data loader for
-``FixedDialogTeacher``, and ``DialogData``/``StreamDialogData``, data
-structures for accessing textual dialog data and utilized by ``DialogTeacher``
+``FixedDialogTeacher``, and ``DialogData``/``StreamDialogData``/
+``CompiledDialogData``, data structures for accessing textual dialog data and
+utilized by ``DialogTeacher``
 """
 import copy
 from typing import List, Tuple
@@ -35,22 +36,33 @@ from parlai.core.agents import Agent, create_agent_from_shared
 from parlai.core.image_featurizers import ImageLoader
 from parlai.core.loader import load_teacher_module
 from parlai.core.message import Message
-from parlai.core.metrics import TeacherMetrics, aggregate_named_reports
+from parlai.core.metrics import (
+    AverageMetric,
+    SumMetric,
+    TeacherMetrics,
+    aggregate_named_reports,
+)
 from parlai.core.opt import Opt
 from parlai.utils.misc import AttrDict, no_lock, str_to_msg, warn_once
 
+from array import array
 from functools import lru_cache
 from abc import ABC, abstractmethod
+from collections import deque
 
 import concurrent.futures
+import hashlib
 import multiprocessing
 from multiprocessing import Value, Lock
 from threading import Thread
+import threading
 import queue
 import random
+import shutil
 import sys
 import time
 import os
+import numpy as np
 import torch
 import json
 import argparse
@@ -93,10 +105,14 @@ class DataLoader(Thread):
         with executor:
             while True:
                 receive_fn, load_fn, args = self.request_queue.get()
-                if type(args) == dict:
-                    future = executor.submit(load_fn, **args)
-                else:
-                    future = executor.submit(load_fn, *args)
+                try:
+                    if type(args) == dict:
+                        future = executor.submit(load_fn, **args)
+                    else:
+                        future = executor.submit(load_fn, *args)
+                except RuntimeError:
+                    # the interpreter is exiting, and doesn't start new loads
+                    return
                 receive_fn(future)
 
 
@@ -117,6 +133,7 @@ class Teacher(Agent):
                 threadsafe=(opt.get('numthreads', 1) > 1),
                 metrics_list=opt.get('metrics', 'default'),
                 shared=shared['metrics'] if shared is not None else None,
+                num_workers=opt.get('numthreads', 1),
             )
         self.epochDone = False
 
@@ -234,6 +251,11 @@ class FixedDialogTeacher(Teacher):
     To see this in action, take a look at this teacher in ``tasks.vqa_v1.agents``.
     """
 
+    # act() does not depend on the replies observed, so a BatchWorld may run it
+    # ahead of them (see --batch-prefetch). Subclasses which break this must
+    # set it to False.
+    supports_prefetch = True
+
     def __init__(self, opt, shared=None):
         super().__init__(opt, shared)
 
@@ -340,8 +362,10 @@ class FixedDialogTeacher(Teacher):
         :param loop:
             default None loops during training but not evaluation.
         """
+        start = 0
         if num_eps is None:
-            num_eps = self.num_episodes()
+            start, end = self.episode_range()
+            num_eps = end - start
         if loop is None:
             loop = self.training
         if self.random:
@@ -351,9 +375,32 @@ class FixedDialogTeacher(Teacher):
                 self.index.value += 1
                 if loop:
                     self.index.value %= num_eps
-                new_idx = self.index.value
+                new_idx = start + self.index.value
         return new_idx
 
+    def can_shard_episodes(self):
+        """
+        Return whether the episodes can be split between evaluation workers.
+
+        Sharding needs a fixed order of episodes, accessed by index.
+        """
+        return not self.random and not self.training
+
+    def episode_range(self):
+        """
+        Return the (start, end) indices of the episodes this teacher goes through.
+
+        With ``--num-eval-workers``, evaluation worker ``opt['eval_worker']`` only
+        goes through a contiguous shard of the episodes, the first worker getting
+        the first shard.
+        """
+        num_eps = self.num_episodes()
+        num_shards = self.opt.get('num_eval_workers') or 1
+        shard = self.opt.get('eval_worker')
+        if shard is None or num_shards <= 1 or not self.can_shard_episodes():
+            return 0, num_eps
+        return num_eps * shard // num_shards, num_eps * (shard + 1) // num_shards
+
     def next_example(self):
         """
         Return the next example.
@@ -368,7 +415,8 @@ class FixedDialogTeacher(Teacher):
         else:
             self.entry_idx += 1
 
-        if self.episode_idx >= self.num_episodes():
+        end = self.episode_range()[1]
+        if self.episode_idx >= end:
             return {'episode_done': True}, True
 
         ex = self.get(self.episode_idx, self.entry_idx)
@@ -377,7 +425,7 @@ class FixedDialogTeacher(Teacher):
         if (
             not self.random
             and self.episode_done
-            and self.episode_idx + self.opt.get("batchsize", 1) >= self.num_episodes()
+            and self.episode_idx + self.opt.get("batchsize", 1) >= end
         ):
             epoch_done = True
         else:
@@ -508,17 +556,21 @@ class DialogTeacher(FixedDialogTeacher):
             self.datatype.startswith('train') and 'evalmode' not in self.datatype
         )
         self.stream = 'stream' in self.datatype
+        self.compiled = opt.get('compiled_data', False) and not self.stream
 
         # first initialize any shared objects
-        data_class = StreamDialogData if self.stream else DialogData
-        kwargs = (
+        if self.stream:
+            data_class = StreamDialogData
             # never cycle if "ordered" is in the datatype. this is used by
             # build_dict to enumerate through the data exactly once while still
             # marking examples as training examples.
-            {'cycle': self.training and 'ordered' not in self.datatype}
-            if self.stream
-            else {}
-        )
+            kwargs = {'cycle': self.training and 'ordered' not in self.datatype}
+        elif self.compiled:
+            data_class = CompiledDialogData
+            kwargs = {'compiled_path': self.compiled_data_path()}
+        else:
+            data_class = DialogData
+            kwargs = {}
         if shared and shared.get('data'):
             self.data = data_class(opt, shared=shared['data'], **kwargs)
         else:
@@ -549,6 +601,77 @@ class DialogTeacher(FixedDialogTeacher):
             shared['data'] = self.data.share()
         return shared
 
+    def can_shard_episodes(self):
+        # streamed data can't be accessed by episode index
+        return not self.stream and super().can_shard_episodes()
+
+    def compiled_data_opt_keys(self):
+        """
+        Return the opt keys whose values may change the output of setup_data.
+
+        By default, these are the options added by the teacher's own
+        ``add_cmdline_args``. Override to add options which setup_data reads
+        without the teacher defining them.
+        """
+        from parlai.core.params import ParlaiParser
+
+        add_cmdline_args = getattr(type(self), 'add_cmdline_args', None)
+        if add_cmdline_args is None:
+            return []
+        parser = ParlaiParser(False, False)
+        add_cmdline_args(parser)
+        args, _ = parser.parse_known_args([], nohelp=True)
+        return sorted(vars(args))
+
+    def compiled_data_path(self):
+        """
+        Return the directory holding the compiled version of this teacher's data.
+
+        The path is unique to the teacher class, task, fold, datafile and the
+        values of ``compiled_data_opt_keys()``, and changes whenever the datafile
+        is modified on disk, so stale compiled data is never reused.
+        """
+        datafile = self.opt.get('datafile')
+        datafiles = datafile if type(datafile) is tuple else [datafile]
+        key = [
+            type(self).__module__,
+            type(self).__qualname__,
+            self.opt.get('task'),
+            self.datatype.split(':')[0],
+            repr(datafile),
+            [[k, repr(self.opt.get(k))] for k in self.compiled_data_opt_keys()],
+        ]
+        for f in datafiles:
+            if isinstance(f, str) and os.path.isfile(f):
+                stat = os.stat(f)
+                key.extend([stat.st_size, stat.st_mtime])
+        digest = hashlib.md5(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.opt['datapath'], 'compiled', digest)
+
+    def compile_data(self, dict_agent=None):
+        """
+        Compile this teacher's data into the memory-mapped binary format.
+
+        Any previously compiled data for this teacher is overwritten.
+
+        :param dict_agent:
+            if provided, the token ids of every text field are computed with
+            this dictionary and stored alongside the data.
+
+        :return:
+            the path of the compiled data.
+        """
+        path = self.compiled_data_path()
+        CompiledDialogData(
+            self.opt,
+            data_loader=self.setup_data,
+            cands=self.label_candidates(),
+            compiled_path=path,
+            dict_agent=dict_agent,
+            force_compile=True,
+        )
+        return path
+
     def label_candidates(self):
         """
         Provide consistent label candidates for all examples.
@@ -1011,6 +1134,252 @@ class StreamDialogData(DialogData):
         return self.data
 
 
+class CompiledDialogData(DialogData):
+    """
+    Provides a memory-mapped, pre-compiled view of textual dialog data.
+
+    On first use, the episodes produced by the data loader are written once into
+    a directory of flat binary arrays (a UTF-8 string blob with its offsets, a
+    per-entry table of field spans and the episode boundaries), optionally along
+    with the dictionary token ids of every text field. Afterwards the data is
+    only memory-mapped, so ``get`` is a constant-time slice and every copy of
+    the teacher, including Hogwild processes, shares the same pages instead of
+    holding its own Python objects.
+
+    Entries whose label candidates were repeated from the previous entry point
+    to the same span of strings rather than storing them twice.
+
+    :param opt:
+        options to initialize the class
+    :param data_loader:
+        an iterable with each call returning a tuple in the form
+        ``((x, y, r, c, i), new_episode?)``, see ``DialogData``.
+    :param cands:
+        can be set to provide a list of candidate labels for every example in
+        this dataset.
+    :param compiled_path:
+        directory where the compiled data is stored.
+    :param dict_agent:
+        (default None) dictionary used to precompute the token ids of the text
+        field when compiling.
+    :param force_compile:
+        (default False) compile the data even if it was already compiled.
+    """
+
+    VERSION = 1
+    # order of the fields in each entry, matching the data loader tuples
+    FIELDS = ('text', 'labels', 'reward', 'label_candidates', 'image')
+    # fields stored as a single string rather than a tuple of strings
+    SINGLE_FIELDS = {'text', 'reward', 'image'}
+
+    def __init__(self, opt, data_loader=None, cands=None, shared=None, **kwargs):
+        if shared:
+            self.image_loader = shared.get('image_loader', None)
+            self.cands = shared.get('cands', None)
+            self.compiled_path = shared['compiled_path']
+        else:
+            self.image_loader = ImageLoader(opt)
+            self.compiled_path = kwargs['compiled_path']
+            meta_file = os.path.join(self.compiled_path, 'meta.json')
+            if kwargs.get('force_compile') or not os.path.isfile(meta_file):
+                self._compile(
+                    self.compiled_path,
+                    self._read_episode(data_loader(opt['datafile'])),
+                    kwargs.get('dict_agent'),
+                )
+            self.cands = None if cands is None else set(sys.intern(c) for c in cands)
+        self.addedCands = []
+        self.copied_cands = False
+        self._open(self.compiled_path)
+
+    def share(self):
+        """
+        Share the location of the data; copies memory-map it themselves.
+        """
+        shared = {
+            'compiled_path': self.compiled_path,
+            'cands': self.cands,
+            'image_loader': self.image_loader,
+        }
+        return shared
+
+    def _compile(self, path, episodes, dict_agent=None):
+        """
+        Write the episodes to ``path`` in the compiled format.
+
+        Files are written to a temporary directory which is renamed into place
+        at the end, so a crash never leaves half-written data behind.
+        """
+        print('[ compiling data to {} ]'.format(path))
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        string_offsets = array('q', [0])
+        token_offsets = array('q', [0])
+        spans = array('q')
+        episode_offsets = array('q', [0])
+
+        strings_file = open(os.path.join(tmp_path, 'strings.bin'), 'wb')
+        tokens_file = open(os.path.join(tmp_path, 'tokens.bin'), 'wb')
+
+        def add_strings(values, tokenize=False):
+            for value in values:
+                data = value.encode('utf-8')
+                strings_file.write(data)
+                string_offsets.append(string_offsets[-1] + len(data))
+                if tokenize and dict_agent is not None:
+                    vec = array('i', dict_agent.txt2vec(value))
+                    vec.tofile(tokens_file)
+                    token_offsets.append(token_offsets[-1] + len(vec))
+                else:
+                    token_offsets.append(token_offsets[-1])
+            end = len(string_offsets) - 1
+            return [end - len(values), end]
+
+        for episode in episodes:
+            last_cands = [-1, -1]
+            for entry in episode:
+                for i, field in enumerate(self.FIELDS):
+                    value = entry[i] if i < len(entry) else None
+                    if value is None:
+                        span = [-1, -1]
+                    elif field == 'label_candidates' and type(value) is str:
+                        # marker for "same candidates as the previous entry"
+                        span = last_cands
+                    elif field == 'reward':
+                        span = add_strings([json.dumps(value)])
+                    elif field in self.SINGLE_FIELDS:
+                        span = add_strings([value], tokenize=(field == 'text'))
+                    else:
+                        span = add_strings(value)
+                    if field == 'label_candidates':
+                        last_cands = span
+                    spans.extend(span)
+            episode_offsets.append(episode_offsets[-1] + len(episode))
+
+        strings_file.close()
+        tokens_file.close()
+        for name, arr in [
+            ('string_offsets', string_offsets),
+            ('token_offsets', token_offsets),
+            ('spans', spans),
+            ('episode_offsets', episode_offsets),
+        ]:
+            with open(os.path.join(tmp_path, name + '.bin'), 'wb') as f:
+                arr.tofile(f)
+
+        meta = {
+            'version': self.VERSION,
+            'num_episodes': len(episode_offsets) - 1,
+            'num_examples': episode_offsets[-1],
+            'num_strings': len(string_offsets) - 1,
+            'num_tokens': token_offsets[-1],
+            'fingerprint': None if dict_agent is None else dict_agent.fingerprint(),
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.rename(tmp_path, path)
+
+    def _memmap(self, name, dtype, shape):
+        """
+        Memory-map one of the compiled arrays read-only.
+        """
+        if shape[0] == 0:
+            # mmap cannot map empty files
+            return np.zeros(shape, dtype=dtype)
+        filename = os.path.join(self.compiled_path, name + '.bin')
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape)
+
+    def _open(self, path):
+        """
+        Memory-map the compiled data stored at ``path``.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != self.VERSION:
+            raise RuntimeError(
+                'Compiled data at {} has version {}, expected {}. Delete it to '
+                'recompile.'.format(path, self.meta.get('version'), self.VERSION)
+            )
+        num_strings = self.meta['num_strings']
+        self._strings = self._memmap(
+            'strings', np.uint8, (os.path.getsize(os.path.join(path, 'strings.bin')),)
+        )
+        self._string_offsets = self._memmap(
+            'string_offsets', np.int64, (num_strings + 1,)
+        )
+        self._tokens = self._memmap('tokens', np.int32, (self.meta['num_tokens'],))
+        self._token_offsets = self._memmap(
+            'token_offsets', np.int64, (num_strings + 1,)
+        )
+        self._spans = self._memmap(
+            'spans', np.int64, (self.meta['num_examples'], len(self.FIELDS), 2)
+        )
+        self._episode_offsets = self._memmap(
+            'episode_offsets', np.int64, (self.meta['num_episodes'] + 1,)
+        )
+
+    def _string(self, idx):
+        start, end = self._string_offsets[idx : idx + 2].tolist()
+        return self._strings[start:end].tobytes().decode('utf-8')
+
+    def num_episodes(self):
+        """
+        Return number of episodes in the dataset.
+        """
+        return self.meta['num_episodes']
+
+    def num_examples(self):
+        """
+        Return total number of entries available.
+        """
+        return self.meta['num_examples']
+
+    def get(self, episode_idx, entry_idx=0):
+        """
+        Get the specified episode and the specified entry in that episode.
+
+        :param episode_idx:
+            which episode to return examples from
+        :param entry_idx:
+            which example to return from the episode. Many datasets have only
+            single-entry episodes, so this defaults to zero.
+        """
+        ep_start, ep_end = self._episode_offsets[episode_idx : episode_idx + 2].tolist()
+        spans = self._spans[ep_start + entry_idx].tolist()
+
+        entry = []
+        for field, (start, end) in zip(self.FIELDS, spans):
+            if start < 0:
+                entry.append(None)
+            elif field == 'reward':
+                entry.append(json.loads(self._string(start)))
+            elif field in self.SINGLE_FIELDS:
+                entry.append(self._string(start))
+            else:
+                entry.append(tuple(self._string(i) for i in range(start, end)))
+        table = self.build_table(entry)
+
+        text_start = spans[0][0]
+        if self.meta['fingerprint'] is not None and text_start >= 0:
+            tok_start, tok_end = self._token_offsets[
+                text_start : text_start + 2
+            ].tolist()
+            table['text_token_ids'] = self._tokens[tok_start:tok_end]
+            table['token_ids_fingerprint'] = self.meta['fingerprint']
+
+        episode_done = ep_start + entry_idx == ep_end - 1
+        end_of_data = episode_done and episode_idx == self.num_episodes() - 1
+        table['episode_done'] = episode_done
+        return table, end_of_data
+
+
 class FbDialogTeacher(DialogTeacher):
     """
     This module provides access to data in the Facebook Dialog format.
@@ -1791,6 +2160,13 @@ class MultiTaskTeacher(Teacher):
             self.cum_task_weights[i] = weight + sum
             sum += weight
 
+    @property
+    def supports_prefetch(self):
+        """
+        Whether every task may act ahead of the replies, see FixedDialogTeacher.
+        """
+        return all(getattr(t, 'supports_prefetch', False) for t in self.tasks)
+
     def num_examples(self):
         """
         Return the number of examples.
@@ -1908,12 +2284,100 @@ class MultiTaskTeacher(Teacher):
             t.update_counters()
 
 
+class _ChunkSampleBuffer(object):
+    """
+    Bounded buffer of the samples of a ``ChunkTeacher``, filled a chunk at a time.
+
+    Loaded chunks are appended in bulk, and samples are popped from a deque without
+    locking unless the buffer is empty, instead of going one by one through a
+    ``queue.Queue``.
+
+    Producers never wait for space: when ``has_room()`` is False, they leave their
+    chunks aside, and ``on_space`` is called by the consumer as soon as it pops the
+    buffer below ``maxsize``. So no loader thread is ever stuck on a full buffer,
+    which would hold up both the teacher and the interpreter's exit.
+
+    ``clear()`` starts a new generation: puts from older generations are dropped,
+    so that loads still in flight at a reset don't leak into the new epoch.
+    """
+
+    def __init__(self, maxsize, on_space):
+        self.maxsize = maxsize
+        self.generation = 0
+        # number of times a sample was requested from an empty buffer
+        self.stalls = 0
+        self._samples = deque()
+        self._cond = threading.Condition()
+        self._on_space = on_space
+        self._space_requested = False
+
+    def __len__(self):
+        return len(self._samples)
+
+    def has_room(self):
+        """
+        Return whether samples can be added, or else ask to be called back.
+        """
+        if len(self._samples) < self.maxsize:
+            return True
+        self._space_requested = True
+        # check again, in case the consumer popped before seeing the request
+        return len(self._samples) < self.maxsize
+
+    def put_all(self, samples, generation):
+        """
+        Append samples, whether or not there is room for them.
+
+        :return:
+            False if the samples were dropped, as the buffer was cleared since
+            generation.
+        """
+        with self._cond:
+            if generation != self.generation:
+                return False
+            self._samples.extend(samples)
+            self._cond.notify_all()
+        return True
+
+    def get(self):
+        """
+        Pop the next sample, waiting for one if the buffer is empty.
+        """
+        try:
+            sample = self._samples.popleft()
+        except IndexError:
+            with self._cond:
+                self.stalls += 1
+                while not self._samples:
+                    self._cond.wait()
+                sample = self._samples.popleft()
+        if self._space_requested and len(self._samples) < self.maxsize:
+            self._space_requested = False
+            self._on_space()
+        return sample
+
+    def clear(self):
+        """
+        Drop all samples, and the puts of the current generation.
+        """
+        with self._cond:
+            self.generation += 1
+            self._samples.clear()
+            self._space_requested = False
+
+
 class ChunkTeacher(FixedDialogTeacher, ABC):
     """
     Useful for loading large amounts of data.
 
-    Data is separated into chunks and loaded one chunk at a time. Loads the data off of
-    the main thread.
+    Data is separated into chunks and loaded off of the main thread. Up to
+    ``--num-load-threads`` chunks are read in parallel, and up to
+    ``get_num_prefetch_chunks()`` chunks are loaded ahead. Chunks are handed over to
+    the buffer of samples in the order they were requested, whatever the order they
+    finish loading in, so that valid and test orderings stay reproducible.
+
+    Samples can also be interleaved across ``get_num_interleave_chunks()``
+    consecutive chunks, with a fixed seed outside of training.
     """
 
     def __init__(self, opt, shared=None):
@@ -1943,16 +2407,23 @@ class ChunkTeacher(FixedDialogTeacher, ABC):
             self.rng = shared['rng']
         else:
             self.is_root_teacher = True
-            self.samples = queue.Queue(maxsize=self.buffersize)
+            self.samples = _ChunkSampleBuffer(self.buffersize, self._deliver_chunks)
             self.chunks = queue.Queue()
             if self.is_train:
                 # TODO: possible need a fixed seed here in the future
                 self.rng = random.Random()
             else:
                 self.rng = random.Random(42)
-            self._enqueue_chunks()
-            # launch queue loader on the main thread
-            self._enqueue_request()
+            self.num_interleave_chunks = max(1, self.get_num_interleave_chunks())
+            self.num_prefetch_chunks = max(
+                self.num_interleave_chunks, self.get_num_prefetch_chunks()
+            )
+            # chunk loads in flight, in the order they were requested
+            self._loads = deque()
+            self._deliver_lock = threading.Lock()
+            self._load_stats = {'exs': 0, 'chunks': 0, 'secs': 0.0}
+            self._load_stats_time = time.time()
+            self._start_epoch()
 
         self.episode_done = True
 
@@ -1992,6 +2463,24 @@ class ChunkTeacher(FixedDialogTeacher, ABC):
         """
         return 100000
 
+    def get_num_prefetch_chunks(self):
+        """
+        Number of chunks loaded ahead of the buffer, including those loading.
+
+        Override this in your child class to change it. Defaults to the number of
+        load threads, so that each of them can read a chunk.
+        """
+        return self.opt.get('num_load_threads', 1)
+
+    def get_num_interleave_chunks(self):
+        """
+        Number of consecutive chunks whose samples are interleaved.
+
+        Override this in your child class to mix the samples of several chunks.
+        Defaults to 1, i.e. chunks are not mixed.
+        """
+        return 1
+
     def set_datasettings(self, datatype):
         self.folder = self._get_data_folder()
         self.num_exs, self.num_eps = self.get_num_samples(datatype)
@@ -2018,28 +2507,110 @@ class ChunkTeacher(FixedDialogTeacher, ABC):
     def num_examples(self):
         return self.num_exs
 
+    def can_shard_episodes(self):
+        # samples come from a queue of chunks, not by episode index
+        return False
+
+    def _start_epoch(self):
+        """
+        Queue the chunks of a new epoch, and start loading the first ones.
+        """
+        self._enqueue_chunks()
+        # interleave the same way in every valid/test epoch
+        self._interleave_rng = random.Random() if self.is_train else random.Random(42)
+        for _ in range(self.num_prefetch_chunks):
+            self._enqueue_request()
+
     def _enqueue_request(self):
         """
-        Queue a request for loading to the data loader.
+        Queue a request for loading the next chunk to the data loader.
         """
-        self.data_loader.request_load(self.receive_data, self.get_chunk, ())
+        if self.chunks.empty():
+            if self.is_train:
+                self._enqueue_chunks()
+            else:
+                # if we're in valid/test, there is nothing left to load
+                return
+        chunk_idx = self.chunks.get()
+        # keep track of the request right away, to deliver chunks in this order
+        load = AttrDict(generation=self.samples.generation, future=None)
+        self._loads.append(load)
+        # shuffle the samples randomly for training, but the same way otherwise
+        seed = None if self.is_train else 42
+        self.data_loader.request_load(
+            lambda future: self._receive_chunk(load, future),
+            self._load_chunk,
+            (chunk_idx, seed),
+        )
 
-    def receive_data(self, future):
+    def _load_chunk(self, chunk_idx, seed):
         """
-        Loads data.
+        Load and shuffle a chunk, on a data loader thread.
+        """
+        start = time.time()
+        # abstract method `load_from_chunk` returns a list of tuples
+        output = self.load_from_chunk(chunk_idx)
+        random.Random(seed).shuffle(output)
+        return output, time.time() - start
+
+    def _receive_chunk(self, load, future):
+        """
+        Receive the future of a chunk load from the data loader.
+
+        Its samples are added to the buffer once it and all the chunks requested
+        before it are loaded.
+        """
+        load.future = future
+        future.add_done_callback(lambda _: self._deliver_chunks())
+
+    def _deliver_chunks(self):
+        """
+        Move the loaded chunks at the head of the requests to the buffer.
+
+        Stops when the buffer is full; the buffer calls this again once samples
+        are consumed.
+        """
+        with self._deliver_lock:
+            while self._loads and self.samples.has_room():
+                num = min(self.num_interleave_chunks, len(self._loads))
+                heads = [self._loads[i] for i in range(num)]
+                if not all(h.future is not None and h.future.done() for h in heads):
+                    return
+                # with fewer chunks left than interleaved, wait for the last ones
+                if num < self.num_interleave_chunks and not self._no_more_chunks():
+                    return
+                for _ in range(num):
+                    self._loads.popleft()
+                chunks = []
+                secs = 0.0
+                for head in heads:
+                    output, load_secs = head.future.result()
+                    chunks.append(output)
+                    secs += load_secs
+                samples = self._interleave(chunks)
+                if not self.samples.put_all(samples, heads[0].generation):
+                    # the teacher was reset while we were loading
+                    continue
+                self._load_stats['exs'] += len(samples)
+                self._load_stats['chunks'] += num
+                self._load_stats['secs'] += secs
+                # and start loading the next chunks
+                for _ in range(num):
+                    self._enqueue_request()
 
-        Load data into self.samples until buffersize is reached.
+    def _no_more_chunks(self):
+        return not self.is_train and self.chunks.empty()
+
+    def _interleave(self, chunks):
         """
-        data = future.result()
-        if data is None:
-            return
-        while data:
-            # self.samples is a queue with maxsize
-            # self.buffersize, so will block if the
-            # buffer gets full
-            self.samples.put(data.pop(0))
-        # and start loading the next chunk
-        self._enqueue_request()
+        Mix the samples of chunks, keeping the order of each chunk.
+        """
+        if len(chunks) == 1:
+            return chunks[0]
+        sources = [i for i, chunk in enumerate(chunks) for _ in chunk]
+        self._interleave_rng.shuffle(sources)
+        iters = [iter(chunk) for chunk in chunks]
+        return [next(iters[i]) for i in sources]
 
     def _enqueue_chunks(self):
         """
@@ -2067,28 +2638,6 @@ class ChunkTeacher(FixedDialogTeacher, ABC):
         """
         pass
 
-    def get_chunk(self):
-        """
-        Refill the buffer.
-        """
-        if self.chunks.empty():
-            if self.is_train:
-                self._enqueue_chunks()
-            else:
-                # if we're in valid/test, we need to actually signal the end
-                return None
-
-        next_chunk = self.chunks.get()
-        # abstract method `load_from_chunk` returns a list of tuples
-        output = self.load_from_chunk(next_chunk)
-
-        if self.is_train:
-            # randomize the samples
-            random.Random().shuffle(output)
-        else:
-            random.Random(42).shuffle(output)
-        return output
-
     def get(self, episode_idx, entry_idx=0):
         queue_output = self.samples.get()
         if queue_output is None:
@@ -2097,22 +2646,46 @@ class ChunkTeacher(FixedDialogTeacher, ABC):
         # create a Message object from the queue output
         return self.create_message(queue_output)
 
-    def _drain(self, q):
-        while not q.empty():
-            try:
-                q.get()
-            except queue.Empty:
-                return
+    def report(self):
+        """
+        Report metrics, and the throughput of the chunk loader.
+
+        ``load_exs_per_sec`` is the rate at which samples were added to the buffer
+        since the last report, ``load_stalls`` the number of times a sample was
+        requested from an empty buffer, and ``buffer_fill`` the fraction of the
+        buffer in use.
+        """
+        report = super().report()
+        if not self.is_root_teacher:
+            return report
+        with self._deliver_lock:
+            stats = self._load_stats
+            self._load_stats = {'exs': 0, 'chunks': 0, 'secs': 0.0}
+        now = time.time()
+        elapsed, self._load_stats_time = now - self._load_stats_time, now
+        report['load_exs_per_sec'] = AverageMetric(stats['exs'], max(elapsed, 1e-6))
+        if stats['chunks']:
+            report['chunk_load_ms'] = AverageMetric(
+                1000 * stats['secs'], stats['chunks']
+            )
+        report['load_stalls'] = SumMetric(self.samples.stalls)
+        self.samples.stalls = 0
+        report['buffer_fill'] = AverageMetric(len(self.samples), self.buffersize)
+        return report
 
     def reset(self):
         super().reset()
         if self.is_root_teacher:
-            # drain the queues and refill the chunk queue with a new epoch.
-            # additionally, we have to relaunch the loader
-            self._drain(self.samples)
-            self._drain(self.chunks)
-            self._enqueue_chunks()
-            self._enqueue_request()
+            # drop the samples and the chunks in flight, and start a new epoch.
+            self.samples.clear()
+            with self._deliver_lock:
+                self._loads.clear()
+                while not self.chunks.empty():
+                    try:
+                        self.chunks.get_nowait()
+                    except queue.Empty:
+                        break
+                self._start_epoch()
 
 
 def _add_task_flags_to_agent_opt(agent, opt: Opt, flags):
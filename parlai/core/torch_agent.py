@@ -26,12 +26,19 @@ from collections import deque
 import json
 import random
 import os
+import time
 import torch
 from torch import optim
 
 from parlai.core.opt import Opt
 from parlai.core.agents import Agent
 from parlai.utils.thread import SharedTable
+from parlai.utils.checkpoint import (
+    CheckpointWriter,
+    load_checkpoint,
+    peak_memory_mb,
+    save_checkpoint,
+)
 from parlai.core.dict import DictionaryAgent
 from parlai.nn.lr_scheduler import ParlAILRScheduler
 from parlai.core.message import Message
@@ -143,6 +150,64 @@ class Output(AttrDict):
         super().__init__(text=text, text_candidates=text_candidates, **kwargs)
 
 
+class _TokenWindow(object):
+    """
+    The end of a stream of tokens, kept in a flat LongTensor.
+
+    Tokens are only ever written past the end of the buffer, which is reallocated,
+    without the tokens no longer needed, once full. So slices of the buffer handed
+    out never change, and each token is copied a constant number of times on
+    average.
+
+    :param maxlen:
+        number of tokens at the end of the stream to keep, or None for all.
+    """
+
+    def __init__(self, maxlen=None):
+        self.maxlen = maxlen
+        self.reset()
+
+    def reset(self):
+        self._buf = None
+        # stream positions of the first token of the buffer, and after the last one
+        self._start = 0
+        self.end = 0
+
+    def append(self, tokens, keep_from=0):
+        """
+        Append tokens to the stream.
+
+        :param keep_from:
+            stream position of the first token still needed.
+        """
+        new_end = self.end + len(tokens)
+        if self.maxlen is not None:
+            keep_from = max(keep_from, new_end - self.maxlen)
+        if self._buf is None or new_end - self._start > len(self._buf):
+            keep_from = max(keep_from, self._start)
+            kept = max(0, self.end - keep_from)
+            buf = torch.empty(max(64, 2 * (new_end - keep_from)), dtype=torch.long)
+            if kept > 0:
+                buf[:kept] = self._buf[keep_from - self._start : self.end - self._start]
+            self._buf = buf
+            self._start = keep_from
+        skip = max(0, keep_from - self.end)
+        if skip < len(tokens):
+            start = self.end + skip - self._start
+            self._buf[start : new_end - self._start] = torch.LongTensor(
+                list(tokens)[skip:]
+            )
+        self.end = new_end
+
+    def view(self, start):
+        """
+        Return the tokens from stream position start, which must be kept, to the end.
+        """
+        if self._buf is None:
+            return torch.LongTensor([])
+        return self._buf[start - self._start : self.end - self._start]
+
+
 class History(object):
     """
     History handles tracking the dialogue state over the course of an episode.
@@ -169,6 +234,10 @@ class History(object):
 
     :param dict_agent:
         DictionaryAgent object for tokenizing the history
+
+    Besides the list of vecs, the history keeps the end of their concatenation in a
+    ``_TokenWindow``, so that ``get_history_tensor()`` only has to copy the tokens
+    added since the previous turn.
     """
 
     def __init__(
@@ -198,6 +267,9 @@ class History(object):
         self.history_strings = []
         self.history_raw_strings = []
         self.history_vecs = []
+        # the history vecs are concatenated in a window of tokens, and start there
+        self._window = _TokenWindow(maxlen if vec_type == 'deque' else None)
+        self._vec_starts = deque()
 
         # person token args
         self.add_person_tokens = opt.get('person_tokens', False)
@@ -218,24 +290,49 @@ class History(object):
         self.history_raw_strings = []
         self.history_strings = []
         self.history_vecs = []
+        self._window.reset()
+        self._vec_starts.clear()
 
     def _update_strings(self, text):
-        if self.size > 0:
-            while len(self.history_strings) >= self.size:
-                self.history_strings.pop(0)
+        if self.size > 0 and len(self.history_strings) >= self.size:
+            del self.history_strings[: len(self.history_strings) - self.size + 1]
         self.history_strings.append(text)
 
     def _update_raw_strings(self, text):
-        if self.size > 0:
-            while len(self.history_raw_strings) >= self.size:
-                self.history_raw_strings.pop(0)
+        if self.size > 0 and len(self.history_raw_strings) >= self.size:
+            del self.history_raw_strings[
+                : len(self.history_raw_strings) - self.size + 1
+            ]
         self.history_raw_strings.append(text)
 
-    def _update_vecs(self, text):
-        if self.size > 0:
-            while len(self.history_vecs) >= self.size:
-                self.history_vecs.pop(0)
-        self.history_vecs.append(self.parse(text))
+    def _update_vecs(self, text, vec=None):
+        if self.size > 0 and len(self.history_vecs) >= self.size:
+            num_dropped = len(self.history_vecs) - self.size + 1
+            del self.history_vecs[:num_dropped]
+            for _ in range(num_dropped):
+                self._vec_starts.popleft()
+        if vec is None:
+            vec = self.parse(text)
+        if self.history_vecs:
+            self._window.append(self.delimiter_tok, self._vec_starts[0])
+        self._vec_starts.append(self._window.end)
+        self._window.append(vec, self._vec_starts[0])
+        self.history_vecs.append(vec)
+
+    def _precomputed_vec(self, obs):
+        """
+        Return the token ids the teacher precomputed for this field, if valid.
+
+        Compiled teacher data may carry the token ids of the text field along
+        with the fingerprint of the dictionary which produced them; they are
+        only used if that matches our own dictionary.
+        """
+        if self.field != 'text' or obs.get('text_token_ids') is None:
+            return None
+        fingerprint = getattr(self.dict, 'fingerprint', None)
+        if fingerprint is None or obs.get('token_ids_fingerprint') != fingerprint():
+            return None
+        return obs['text_token_ids'].tolist()
 
     def add_reply(self, text):
         """
@@ -258,6 +355,10 @@ class History(object):
                 next_texts = obs[self.field].split('\n')
             else:
                 next_texts = [obs[self.field]]
+            # precomputed ids only cover the unmodified field
+            vec = None
+            if not self.split_on_newln and not self.add_person_tokens:
+                vec = self._precomputed_vec(obs)
             for text in next_texts:
                 self._update_raw_strings(text)
                 if self.add_person_tokens:
@@ -267,7 +368,7 @@ class History(object):
                 # update history string
                 self._update_strings(text)
                 # update history vecs
-                self._update_vecs(text)
+                self._update_vecs(text, vec)
 
     def get_history_str(self):
         """
@@ -300,6 +401,32 @@ class History(object):
 
         return history
 
+    def get_history_tensor(self, truncate=None):
+        """
+        Return the vectorized history as a LongTensor, keeping its last truncate tokens.
+
+        Same as ``torch.LongTensor(get_history_vec())``, truncated, but the tensor is
+        a view of the tokens kept by the history, so this doesn't go through the
+        whole history every turn.
+        """
+        if len(self.history_vecs) == 0:
+            return None
+        if type(self).get_history_vec is not History.get_history_vec or len(
+            self._vec_starts
+        ) != len(self.history_vecs):
+            # subclasses changing the vectorized history, or the vecs changed directly
+            vec = self.get_history_vec()
+            if truncate and len(vec) > truncate:
+                vec = list(vec)[-truncate:]
+            return torch.LongTensor(vec)
+        start = self._vec_starts[0]
+        end = self._window.end
+        if self._window.maxlen is not None:
+            start = max(start, end - self._window.maxlen)
+        if truncate:
+            start = max(start, end - truncate)
+        return self._window.view(start)
+
     def get_history_vec_list(self):
         """
         Return a list of history vecs.
@@ -334,6 +461,11 @@ class TorchAgent(ABC, Agent):
     P1_TOKEN = '__p1__'
     P2_TOKEN = '__p2__'
 
+    # observe() and self_observe() only touch the history and vectors of a copy,
+    # so a BatchWorld may run them on a background thread while the model trains
+    # (see --batch-prefetch)
+    supports_prefetch = True
+
     @classmethod
     def optim_opts(self):
         """
@@ -605,6 +737,36 @@ class TorchAgent(ABC, Agent):
             default='\n',
             help='Join history lines with this token, defaults to newline',
         )
+        # checkpointing arguments
+        agent.add_argument(
+            '--save-async',
+            type='bool',
+            default=False,
+            hidden=True,
+            help='Copy the model states to CPU memory when saving, and write them '
+            'to disk on a background thread. Training only waits if the '
+            'previous save is still being written.',
+        )
+        agent.add_argument(
+            '--keep-checkpoints',
+            type=int,
+            default=1,
+            hidden=True,
+            help='Number of versions of each saved model to keep. Older versions '
+            'are saved with a numbered suffix, e.g. model.checkpoint.1 is the '
+            'previous model.checkpoint.',
+        )
+        agent.add_argument(
+            '--save-format',
+            type=str,
+            default='torch',
+            choices=['torch', 'mmap'],
+            hidden=True,
+            help='Layout of saved models. mmap saves the model tensors to a '
+            'separate raw buffer file, which is memory-mapped when loading, and '
+            'the optimizer states to another file, which is only read when '
+            'training. This reduces the loading time and memory of models.',
+        )
         # GPU arguments
         # these gpu options are all mutually exclusive, and should error if the
         # user tries to present multiple of them
@@ -673,7 +835,11 @@ class TorchAgent(ABC, Agent):
                         self.dict['__FP16_PAD_{}__'.format(i)] = 1
 
             # global_metrics keeps track of batch-level or global-level metrics
-            self.global_metrics = Metrics(opt.get('numthreads', 1) > 1, shared=None)
+            self.global_metrics = Metrics(
+                opt.get('numthreads', 1) > 1,
+                shared=None,
+                num_workers=opt.get('numthreads', 1),
+            )
             # self.metrics is there for legacy reasons
             self.metrics: Dict[str, Any] = {}
         else:
@@ -699,6 +865,8 @@ class TorchAgent(ABC, Agent):
         self.START_IDX = self.dict[self.dict.start_token]
         self.END_IDX = self.dict[self.dict.end_token]
 
+        # writes checkpoints in the background with --save-async
+        self._checkpoint_writer = None
         # for gradient acumulation
         self._number_grad_accum = 0
         # for the LR scheduler
@@ -992,6 +1160,9 @@ class TorchAgent(ABC, Agent):
 
         Report includes learning rate and number of training updates.
         """
+        if self._checkpoint_writer is not None:
+            for save_time in self._checkpoint_writer.pop_save_times():
+                self.global_metrics.add('save_ms', AverageMetric(1000 * save_time))
         report = self.global_metrics.report()
 
         # only report LR if we have a scheduler
@@ -1006,6 +1177,11 @@ class TorchAgent(ABC, Agent):
             # be done on the primary worker
             report['total_train_updates'] = FixedMetric(self._number_training_updates)
 
+        cache = getattr(self.dict, 'tokenization_cache', None)
+        if cache is not None and cache.hits + cache.misses > 0:
+            report['tok_cache_hits'] = SumMetric(cache.hits)
+            report['tok_cache_misses'] = SumMetric(cache.misses)
+
         return report
 
     def _gpu_usage(self):
@@ -1246,7 +1422,9 @@ class TorchAgent(ABC, Agent):
                 return obs
             obs['full_text'] = history_string
             if history_string:
-                obs['text_vec'] = history.get_history_vec()
+                # already truncated
+                obs['text_vec'] = history.get_history_tensor(truncate)
+                return obs
 
         # check truncation
         if obs.get('text_vec') is not None:
@@ -1702,21 +1880,38 @@ class TorchAgent(ABC, Agent):
                 self.dict.save(model_dict_path, sort=False)
             states = self.state_dict()
             if states:  # anything found to save?
-                with open(path, 'wb') as write:
-                    torch.save(states, write)
-
-                # save opt file
-                with open(path + '.opt', 'w', encoding='utf-8') as handle:
-                    if hasattr(self, 'model_version'):
-                        self.opt['model_version'] = self.model_version()
-                    saved_opts = deepcopy(self.opt)
-                    if 'interactive_mode' in saved_opts:
-                        # We do not save the state of interactive mode, it is only decided
-                        # by scripts or command line.
-                        del saved_opts['interactive_mode']
-                    json.dump(saved_opts, handle, indent=4)
-                    # for convenience of working with jq, make sure there's a newline
-                    handle.write('\n')
+                if hasattr(self, 'model_version'):
+                    self.opt['model_version'] = self.model_version()
+                saved_opts = deepcopy(self.opt)
+                if 'interactive_mode' in saved_opts:
+                    # We do not save the state of interactive mode, it is only decided
+                    # by scripts or command line.
+                    del saved_opts['interactive_mode']
+                # for convenience of working with jq, make sure there's a newline
+                opt_json = json.dumps(saved_opts, indent=4) + '\n'
+                keep = self.opt.get('keep_checkpoints', 1)
+                save_format = self.opt.get('save_format', 'torch')
+
+                if self.opt.get('save_async'):
+                    if self._checkpoint_writer is None:
+                        self._checkpoint_writer = CheckpointWriter(keep, save_format)
+                    blocked = self._checkpoint_writer.save(path, states, opt_json)
+                    self.global_metrics.add(
+                        'save_block_ms', AverageMetric(1000 * blocked)
+                    )
+                else:
+                    start = time.time()
+                    save_checkpoint(path, states, opt_json, keep, save_format)
+                    self.global_metrics.add(
+                        'save_ms', AverageMetric(1000 * (time.time() - start))
+                    )
+
+    def wait_for_save(self):
+        """
+        Wait until the model saved last with ``--save-async`` is written to disk.
+        """
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
 
     def load_state_dict(self, state_dict):
         """
@@ -1745,16 +1940,30 @@ class TorchAgent(ABC, Agent):
         Return opt and model states.
 
         Override this method for more specific loading.
-        """
-        import parlai.utils.pickle
 
-        states = torch.load(
-            path, map_location=lambda cpu, _: cpu, pickle_module=parlai.utils.pickle
+        Models saved with ``--save-format mmap`` are memory-mapped. The optimizer
+        states are skipped when they can't be used, i.e. in interactive mode or
+        when not training.
+        """
+        start = time.time()
+        load_optimizer = not self.opt.get('interactive_mode') and (
+            'train' in self.opt.get('datatype', 'train')
         )
+        states = load_checkpoint(path, load_optimizer=load_optimizer)
         if 'model' in states:
             self.load_state_dict(states['model'])
         if 'optimizer' in states and hasattr(self, 'optimizer'):
             self.optimizer.load_state_dict(states['optimizer'])
+
+        peak_memory = peak_memory_mb()
+        print(
+            '[ Loaded model states in {:.1f}s{} ]'.format(
+                time.time() - start,
+                ''
+                if peak_memory is None
+                else ', peak memory {:.0f}MB'.format(peak_memory),
+            )
+        )
         return states
 
     @classmethod
@@ -1789,6 +1998,9 @@ class TorchAgent(ABC, Agent):
         """
         super().reset_metrics()
         self.global_metrics.clear()
+        cache = getattr(self.dict, 'tokenization_cache', None)
+        if cache is not None:
+            cache.reset_counters()
 
     def act(self):
         """
@@ -1822,8 +2034,10 @@ class TorchAgent(ABC, Agent):
         # check if there are any labels available, if so we will train on them
         self.is_training = any('labels' in obs for obs in observations)
 
-        # create a batch from the vectors
-        batch = self.batchify(observations)
+        # create a batch from the vectors, unless a BatchWorld prefetched it
+        batch = getattr(observations, 'prefetched_batch', None)
+        if batch is None:
+            batch = self.batchify(observations)
 
         if (
             'label_vec' in batch
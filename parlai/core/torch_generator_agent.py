@@ -20,7 +20,7 @@ Contains the following utilities:
 from abc import ABC, abstractmethod
 from typing import TypeVar, List
 import math
-from operator import attrgetter
+from operator import itemgetter
 
 import torch
 import torch.nn as nn
@@ -32,7 +32,7 @@ from parlai.core.torch_agent import TorchAgent, Batch, Output
 from parlai.utils.misc import warn_once
 from parlai.core.metrics import SumMetric, AverageMetric, BleuMetric, FairseqBleuMetric
 from parlai.utils.fp16 import FP16SafeCrossEntropy
-from parlai.utils.torch import neginf
+from parlai.utils.torch import neginf, padded_tensor
 
 
 try:
@@ -752,12 +752,13 @@ class TorchGeneratorAgent(TorchAgent, ABC):
             self._compute_nltk_bleu(batch, text)
         return Output(text, cand_choices, token_losses=token_losses)
 
-    def _treesearch_factory(self, device):
+    def _treesearch_factory(self, device, batchsize):
         method = self.opt.get('inference', 'greedy')
         beam_size = self.opt.get('beam_size', 1)
         if method == 'greedy':
             return GreedySearch(
                 beam_size,
+                batchsize=batchsize,
                 min_length=0,
                 block_ngram=self.beam_block_ngram,
                 context_block_ngram=self.beam_context_block_ngram,
@@ -770,6 +771,7 @@ class TorchGeneratorAgent(TorchAgent, ABC):
         elif method == 'beam':
             return BeamSearch(
                 beam_size,
+                batchsize=batchsize,
                 min_length=self.beam_min_length,
                 block_ngram=self.beam_block_ngram,
                 context_block_ngram=self.beam_context_block_ngram,
@@ -783,6 +785,7 @@ class TorchGeneratorAgent(TorchAgent, ABC):
             return TopKSampling(
                 self.opt['topk'],
                 beam_size,
+                batchsize=batchsize,
                 min_length=self.beam_min_length,
                 block_ngram=self.beam_block_ngram,
                 context_block_ngram=self.beam_context_block_ngram,
@@ -796,6 +799,7 @@ class TorchGeneratorAgent(TorchAgent, ABC):
             return NucleusSampling(
                 self.opt['topp'],
                 beam_size,
+                batchsize=batchsize,
                 min_length=self.beam_min_length,
                 block_ngram=self.beam_block_ngram,
                 context_block_ngram=self.beam_context_block_ngram,
@@ -812,15 +816,34 @@ class TorchGeneratorAgent(TorchAgent, ABC):
         """
         Set the beam context for n-gram context blocking.
 
-        Intentionally overridable for more complex model histories.
+        Intentionally overridable for more complex model histories. Prefer
+        overriding ``_get_batch_context``, which calls this for every example if
+        it is overridden.
         """
         return batch.text_vec[batch_idx]
 
+    def _get_batch_context(self, batch):
+        """
+        Set the beam context for n-gram context blocking.
+
+        Returns a (batchsize x context_len) LongTensor. Intentionally overridable
+        for more complex model histories.
+        """
+        if type(self)._get_context is not TorchGeneratorAgent._get_context:
+            # subclasses written before batched search override the per example
+            # context: stack their contexts
+            contexts = [
+                self._get_context(batch, i) for i in range(batch.text_vec.size(0))
+            ]
+            return padded_tensor(contexts, self.NULL_IDX)[0]
+        return batch.text_vec
+
     def _generate(self, batch, beam_size, max_ts):
         """
         Generate an output with beam search.
 
         Depending on the options, this may perform greedy/topk/nucleus generation.
+        All samples in the batch are searched over together by a single TreeSearch.
 
         :param Batch batch:
             Batch structure with input and labels
@@ -830,14 +853,13 @@ class TorchGeneratorAgent(TorchAgent, ABC):
             the maximum length of the decoded sequence
 
         :return:
-            tuple (beam_pred_scores, n_best_pred_scores, beams)
+            tuple (beam_pred_scores, beams)
 
             - beam_preds_scores: list of (prediction, score) pairs for each sample in
               Batch
-            - n_best_preds_scores: list of n_best list of tuples (prediction, score)
-              for each sample from Batch
-            - beams :list of Beam instances defined in Beam class, can be used for any
-              following postprocessing, e.g. dot logging.
+            - beams: the TreeSearch instance used for the whole batch, can be used
+              for any following postprocessing, e.g. getting the n-best lists with
+              ``beams.get_rescored_finished(n_best)``.
         """
         model = self.model
         if isinstance(model, torch.nn.parallel.DistributedDataParallel):
@@ -853,16 +875,9 @@ class TorchGeneratorAgent(TorchAgent, ABC):
             if batch.text_lengths is not None
             else len(batch.image)
         )
+        beams = self._treesearch_factory(dev, bsz)
         if batch.text_vec is not None:
-            batchsize = batch.text_vec.size(0)
-            beams = [
-                self._treesearch_factory(dev).set_context(
-                    self._get_context(batch, batch_idx)
-                )
-                for batch_idx in range(batchsize)
-            ]
-        else:
-            beams = [self._treesearch_factory(dev) for _ in range(bsz)]
+            beams.set_context(self._get_batch_context(batch))
 
         # repeat encoder outputs and decoder inputs
         decoder_input = (
@@ -874,7 +889,7 @@ class TorchGeneratorAgent(TorchAgent, ABC):
         incr_state = None
 
         for _ts in range(max_ts):
-            if all((b.is_done() for b in beams)):
+            if beams.is_done():
                 # exit early if possible
                 break
 
@@ -885,26 +900,17 @@ class TorchGeneratorAgent(TorchAgent, ABC):
             # score contains softmax scores for bsz * beam_size samples
             score = score.view(bsz, beam_size, -1)
             score = F.log_softmax(score, dim=-1)
-            for i, b in enumerate(beams):
-                if not b.is_done():
-                    b.advance(score[i])
-            incr_state_inds = torch.cat(
-                [
-                    beam_size * i + b.get_backtrack_from_current_step()
-                    for i, b in enumerate(beams)
-                ]
-            )
+            beams.advance(score)
+            incr_state_inds = beams.get_backtrack_from_current_step()
             incr_state = model.reorder_decoder_incremental_state(
                 incr_state, incr_state_inds
             )
             decoder_input = torch.index_select(decoder_input, 0, incr_state_inds)
-            selection = torch.cat(
-                [b.get_output_from_current_step() for b in beams]
-            ).unsqueeze(-1)
+            selection = beams.get_output_from_current_step().unsqueeze(-1)
             decoder_input = torch.cat([decoder_input, selection], dim=-1)
 
         # get all finilized candidates for each sample (and validate them)
-        n_best_beam_preds_scores = [b.get_rescored_finished() for b in beams]
+        n_best_beam_preds_scores = beams.get_rescored_finished()
 
         # get the top prediction for each beam (i.e. minibatch sample)
         beam_preds_scores = [n_best_list[0] for n_best_list in n_best_beam_preds_scores]
@@ -912,21 +918,6 @@ class TorchGeneratorAgent(TorchAgent, ABC):
         return beam_preds_scores, beams
 
 
-class _HypothesisTail(object):
-    """
-    Hold some bookkeeping about a hypothesis.
-    """
-
-    # use slots because we don't want dynamic attributes here
-    __slots__ = ['timestep', 'hypid', 'score', 'tokenid']
-
-    def __init__(self, timestep, hypid, score, tokenid):
-        self.timestep = timestep
-        self.hypid = hypid
-        self.score = score
-        self.tokenid = tokenid
-
-
 TSType = TypeVar('TSType', bound='TreeSearch')
 
 
@@ -934,14 +925,19 @@ class TreeSearch(object):
     """
     Abstract Tree Search class.
 
-    It keeps information about beam_size concurrent, developing hypotheses. Concrete
-    implementations make choices about which token to explore next at each point in the
-    tree. Different choices result in different generation algorithms.
+    It keeps information about beam_size concurrent, developing hypotheses for each
+    of the batchsize samples in a batch. All of the bookkeeping (scores,
+    backtracking pointers, finished hypotheses and the partial hypotheses used for
+    n-gram blocking) is kept in (batchsize x beam_size) tensors, so a single call to
+    advance() moves the whole batch forward one step. Concrete implementations make
+    choices about which token to explore next at each point in the tree. Different
+    choices result in different generation algorithms.
     """
 
     def __init__(
         self,
         beam_size,
+        batchsize=1,
         block_ngram=-1,
         context_block_ngram=-1,
         padding_token=0,
@@ -956,6 +952,8 @@ class TreeSearch(object):
 
         :param beam_size:
             number of hypothesis in the beam
+        :param batchsize:
+            number of samples searched over in parallel
         :param block_ngram:
             size of ngrams to block.
         :param context_block_ngram:
@@ -972,6 +970,7 @@ class TreeSearch(object):
             What device to use for computations
         """
         self.beam_size = beam_size
+        self.batchsize = batchsize
         self.length_penalty = length_penalty
         self.block_ngram = block_ngram
         self.min_length = min_length
@@ -984,42 +983,60 @@ class TreeSearch(object):
         # recent score for each hypo in the beam
         self.scores = None
         # self.scores values per each time step
-        self.all_scores = [torch.Tensor([0.0] * beam_size).to(self.device)]
+        self.all_scores = [torch.zeros(batchsize, beam_size, device=self.device)]
         # backtracking id to hypothesis at previous time step
         self.bookkeep = []
         # output tokens at each time step
         self.outputs = [
-            torch.Tensor(self.beam_size).long().fill_(self.bos).to(self.device)
+            torch.full(
+                (batchsize, beam_size), self.bos, dtype=torch.long, device=self.device
+            )
         ]
-        # keeps tuples (score, time_step, hyp_id)
-        self.finished = []
-        self.eos_top = False
-        self.eos_top_ts = None
-        self.n_best_counter = 0
-        self.partial_hyps = [[self.bos] for i in range(beam_size)]
+        # marks the hypotheses which were finalized at each time step
+        self.finished = [
+            torch.zeros(batchsize, beam_size, dtype=torch.bool, device=self.device)
+        ]
+        self.eos_top = torch.zeros(batchsize, dtype=torch.bool, device=self.device)
+        self.n_best_counter = torch.zeros(
+            batchsize, dtype=torch.long, device=self.device
+        )
+        self.done = torch.zeros(batchsize, dtype=torch.bool, device=self.device)
+        # batchsize x beam_size x length, the tokens of each hypothesis so far
+        self.partial_hyps = self.outputs[0].unsqueeze(-1)
+        self._hyp_range = (
+            torch.arange(beam_size, device=self.device)
+            .unsqueeze(0)
+            .expand(batchsize, beam_size)
+        )
+        self._batch_offsets = (
+            torch.arange(batchsize, device=self.device) * beam_size
+        ).unsqueeze(1)
 
     def set_context(self: TSType, context: torch.LongTensor) -> TSType:
         """
         Set the internal context representation and return self.
 
         :param context:
-            a LongTensor representing the input context; used for context
-            ngram blocking, if supplied
+            a (batchsize x context_len) LongTensor representing the input context;
+            used for context ngram blocking, if supplied
         """
-        self.context = context.tolist()
+        self.context = context.to(self.device)
         return self
 
     def get_output_from_current_step(self):
         """
-        Get the outputput at the current step.
+        Get the outputput at the current step, flattened to (batchsize * beam_size).
         """
-        return self.outputs[-1]
+        return self.outputs[-1].view(-1)
 
     def get_backtrack_from_current_step(self):
         """
         Get the backtrack at the current step.
+
+        Indices are flattened to point into the (batchsize * beam_size) hypotheses,
+        so they can be used directly to reorder the decoder state.
         """
-        return self.bookkeep[-1]
+        return (self.bookkeep[-1] + self._batch_offsets).view(-1)
 
     @abstractmethod
     def select_paths(self, logprobs, prior_scores):
@@ -1027,21 +1044,20 @@ class TreeSearch(object):
         Select the next vocabulary item in these beams.
 
         :param logprobs:
-            a (beamsize x vocab) tensor of log probabilities. If this is the first
-            turn in the dialogue, it will be a (1 x vocab) tensor.
+            a (batchsize x beamsize x vocab) tensor of log probabilities.
         :param prior_scores:
-            a (beamsize) tensor of weights with the cumulative running
-            log-probability of each beam. If the first turn, it will be a (1) tensor.
+            a (batchsize x beamsize) tensor of weights with the cumulative running
+            log-probability of each beam.
 
         :return:
             a (hypothesis_ids, token_id, scores) tuple, where:
 
-            - hypothesis_ids is a LongTensor of hypotheses we're extending. May have
-              repeats, but should always be (beamsize) long.
-            - token_ids is a (beamsize) LongTensor of next-token choices for
-              each of the hypotheses.
-            - scores is a (beamsize) Tensor with the updated cumulative log-probs
-              of each beam.
+            - hypothesis_ids is a (batchsize x beamsize) LongTensor of hypotheses
+              we're extending, indexed within each sample's beam. May have repeats.
+            - token_ids is a (batchsize x beamsize) LongTensor of next-token choices
+              for each of the hypotheses.
+            - scores is a (batchsize x beamsize) Tensor with the updated cumulative
+              log-probs of each beam.
         """
         pass
 
@@ -1057,38 +1073,52 @@ class TreeSearch(object):
             Float or HalfTensor, representing the log-probabilities. This is
             modified in place.
         :param source:
-            Source text to grab ngrams from. If None, it uses the current
-            hypothesis (i.e. self-blocking).
-        """
-        for beam_id, hyp in enumerate(self.partial_hyps):
-            if len(hyp) < ngram_size - 1:
-                continue
-            source_ = hyp if source is None else source
-            ngrams = self._find_ngrams(source_, ngram_size)
-            prefix = hyp[-(ngram_size - 1) :]
-            for ngram in ngrams:
-                if ngram_size == 1 or prefix == list(ngram[:-1]):
-                    logprobs[beam_id][ngram[-1]] = neginf(logprobs.dtype)
+            (batchsize x source_len) source text to grab ngrams from. If None, it
+            uses the current hypothesis (i.e. self-blocking).
+        """
+        hyp_len = self.partial_hyps.size(-1)
+        if hyp_len < ngram_size - 1:
+            return logprobs
+        if source is None:
+            if hyp_len < ngram_size:
+                return logprobs
+            # batchsize x beam_size x num_ngrams x ngram_size
+            ngrams = self.partial_hyps.unfold(-1, ngram_size, 1)
+        else:
+            if source.size(-1) < ngram_size:
+                return logprobs
+            ngrams = source.unfold(-1, ngram_size, 1).unsqueeze(1)
+            ngrams = ngrams.expand(-1, self.beam_size, -1, -1)
+        # an ngram is blocked when its first n - 1 tokens match the end of the hyp
+        prefix = self.partial_hyps[:, :, hyp_len - (ngram_size - 1) :]
+        matches = (ngrams[..., :-1] == prefix.unsqueeze(2)).all(dim=-1)
+        batch_ids, hyp_ids, ngram_ids = matches.nonzero(as_tuple=True)
+        blocked = ngrams[batch_ids, hyp_ids, ngram_ids, -1]
+        logprobs[batch_ids, hyp_ids, blocked] = neginf(logprobs.dtype)
         return logprobs
 
     def advance(self, logprobs):
         """
-        Advance the beam one step.
+        Advance the beams one step.
+
+        Samples which are already done are left untouched.
+
+        :param logprobs:
+            a (batchsize x beamsize x vocab) tensor of log probabilities.
         """
         current_length = len(self.all_scores) - 1
         if current_length < self.min_length:
             # penalize all eos probs to make it decode longer
-            for hyp_id in range(logprobs.size(0)):
-                logprobs[hyp_id][self.eos] = neginf(logprobs.dtype)
+            logprobs[:, :, self.eos] = neginf(logprobs.dtype)
 
         if self.scores is None:
-            self.scores = torch.zeros(1).type_as(logprobs).to(logprobs.device)
+            self.scores = torch.zeros(self.batchsize, self.beam_size).type_as(logprobs)
 
         # penalize hypotheses ending in EOS on the prior scores (self.scores) level
         # this is related to search which uses prior scores (self.scores) (e.g. beam)
-        for hyp_id, token in enumerate(self.outputs[-1]):
-            if token == self.eos:
-                self.scores[hyp_id] = neginf(self.scores.dtype)
+        self.scores = self.scores.masked_fill(
+            self.outputs[-1] == self.eos, neginf(self.scores.dtype)
+        )
 
         # beam blocking
         if self.block_ngram > 0:
@@ -1103,83 +1133,43 @@ class TreeSearch(object):
                 self.context_block_ngram, logprobs, self.context
             )
 
-        hyp_ids, tok_ids, self.scores = self.select_paths(logprobs, self.scores)
+        hyp_ids, tok_ids, scores = self.select_paths(logprobs, self.scores)
+
+        # keep finished samples frozen in place
+        frozen = self.done.unsqueeze(1)
+        hyp_ids = torch.where(frozen, self._hyp_range, hyp_ids)
+        tok_ids = tok_ids.masked_fill(frozen, self.pad)
+        self.scores = torch.where(frozen, self.scores, scores)
         # use clone() here to ensure that self.all_scores will not be changed
         # later due to any penalties to self.scores
         self.all_scores.append(self.scores.clone())
 
         self.outputs.append(tok_ids)
         self.bookkeep.append(hyp_ids)
-        self.partial_hyps = [
-            self.partial_hyps[hyp_ids[i]] + [tok_ids[i].item()]
-            for i in range(self.beam_size)
-        ]
-
-        #  check new hypos for eos label, if we have some, add to finished
-        for hypid in range(self.beam_size):
-            if self.outputs[-1][hypid] == self.eos:
-                if self.scores[hypid] == neginf(self.scores.dtype):
-                    continue
-                #  this is finished hypo, adding to finished
-                eostail = _HypothesisTail(
-                    timestep=len(self.outputs) - 1,
-                    hypid=hypid,
-                    score=self.all_scores[-1][hypid],
-                    tokenid=self.eos,
-                )
-                self.finished.append(eostail)
-                self.n_best_counter += 1
+        self.partial_hyps = torch.cat(
+            [
+                self.partial_hyps.gather(
+                    1, hyp_ids.unsqueeze(-1).expand_as(self.partial_hyps)
+                ),
+                tok_ids.unsqueeze(-1),
+            ],
+            dim=-1,
+        )
 
-        if self.outputs[-1][0] == self.eos:
-            self.eos_top = True
-            if self.eos_top_ts is None:
-                self.eos_top_ts = len(self.outputs) - 1
+        #  check new hypos for eos label, if we have some, mark them finished
+        finished = (
+            (tok_ids == self.eos) & (self.scores != neginf(self.scores.dtype)) & ~frozen
+        )
+        self.finished.append(finished)
+        self.n_best_counter += finished.sum(dim=1)
+        self.eos_top |= (tok_ids[:, 0] == self.eos) & ~self.done
+        self.done = self.eos_top & (self.n_best_counter >= self.beam_size)
 
     def is_done(self):
         """
-        Return whether beam search is complete.
-        """
-        return self.eos_top and self.n_best_counter >= self.beam_size
-
-    def _find_ngrams(self, input_list, n):
-        """
-        Find ngrams of size n in input list.
-        """
-        return list(zip(*[input_list[i:] for i in range(n)]))
-
-    def _get_hyp_from_finished(self, hypothesis_tail):
-        """
-        Extract hypothesis ending with EOS at timestep with hyp_id.
-
-        :param timestep:
-            timestep with range up to len(self.outputs) - 1
-
-        :param hyp_id:
-            id with range up to beam_size - 1
-
-        :return:
-            hypothesis sequence
-        """
-        hyp_idx = []
-        endback = hypothesis_tail.hypid
-        for i in range(hypothesis_tail.timestep, -1, -1):
-            hyp_idx.append(
-                _HypothesisTail(
-                    timestep=i,
-                    hypid=endback,
-                    score=self.all_scores[i][endback],
-                    tokenid=self.outputs[i][endback],
-                )
-            )
-            endback = self.bookkeep[i - 1][endback]
-
-        return hyp_idx
-
-    def _get_pretty_hypothesis(self, list_of_hypotails):
-        """
-        Return hypothesis as a tensor of token ids.
+        Return whether beam search is complete for every sample in the batch.
         """
-        return torch.stack([ht.tokenid for ht in reversed(list_of_hypotails)])
+        return bool(self.done.all())
 
     def get_rescored_finished(self, n_best=None):
         """
@@ -1189,62 +1179,72 @@ class TreeSearch(object):
         penalizes long utterances.
 
         :param n_best:
-            number of finalized hypotheses to return
+            number of finalized hypotheses to return for each sample
 
         :return:
-            list of (tokens, score) pairs, in sorted order, where:
+            one list for each sample in the batch, containing (tokens, score)
+            pairs in sorted order, where:
               - tokens is a tensor of token ids
               - score is the adjusted log probability of the entire utterance
         """
         # if we never actually finished, force one
-        if not self.finished:
-            self.outputs[-1][0] = self.eos
-            self.finished.append(
-                _HypothesisTail(
-                    timestep=len(self.outputs) - 1,
-                    hypid=0,
-                    score=self.all_scores[-1][0],
-                    tokenid=self.outputs[-1][0],
-                )
+        never_finished = ~torch.stack(self.finished).any(dim=0).any(dim=-1)
+        self.outputs[-1][:, 0].masked_fill_(never_finished, self.eos)
+        self.finished[-1][:, 0] |= never_finished
+
+        # (timestep, batch index, hypothesis id) of every finished hypothesis,
+        # ordered by timestep and then hypothesis id as they were found
+        timesteps, batch_ids, hyp_ids = torch.stack(self.finished).nonzero(
+            as_tuple=True
+        )
+        scores = torch.stack(self.all_scores)[timesteps, batch_ids, hyp_ids]
+
+        # follow the backtracking pointers for all hypotheses at once
+        outputs = torch.stack(self.outputs)
+        tokens = outputs.new_full((len(timesteps), len(self.outputs)), self.pad)
+        current = hyp_ids
+        for i in range(len(self.outputs) - 1, -1, -1):
+            alive = timesteps >= i
+            tokens[:, i] = torch.where(
+                alive, outputs[i, batch_ids, current], tokens[:, i]
             )
-
-        rescored_finished = []
-        for finished_item in self.finished:
-            current_length = finished_item.timestep + 1
-            # these weights are from Google NMT paper
-            length_penalty = math.pow((1 + current_length) / 6, self.length_penalty)
-            rescored_finished.append(
-                _HypothesisTail(
-                    timestep=finished_item.timestep,
-                    hypid=finished_item.hypid,
-                    score=finished_item.score / length_penalty,
-                    tokenid=finished_item.tokenid,
+            if i > 0:
+                current = torch.where(
+                    alive, self.bookkeep[i - 1][batch_ids, current], current
                 )
-            )
 
-        # Note: beam size is almost always pretty small, so sorting is cheap enough
-        srted = sorted(rescored_finished, key=attrgetter('score'), reverse=True)
+        # these weights are from Google NMT paper
+        lengths = (timesteps + 1).to(scores.dtype)
+        rescored = scores / torch.pow((1 + lengths) / 6, self.length_penalty)
 
-        if n_best is not None:
-            srted = srted[:n_best]
+        # check that each finalized candidate contains only one EOS
+        eos_counts = (tokens == self.eos).sum(dim=-1)
+        assert (
+            eos_counts == 1
+        ).all(), 'TreeSearch returned a finalized hypo with multiple end tokens'
 
-        n_best_list = [
-            (self._get_pretty_hypothesis(self._get_hyp_from_finished(hyp)), hyp.score)
-            for hyp in srted
-        ]
+        candidates = [[] for _ in range(self.batchsize)]
+        for i, (timestep, batch_idx, score) in enumerate(
+            zip(timesteps.tolist(), batch_ids.tolist(), rescored.tolist())
+        ):
+            candidates[batch_idx].append(
+                (score, tokens[i, : timestep + 1], rescored[i])
+            )
 
-        # check that there is at least one finished candidate
-        # and assert that each of them contains only one EOS
-        assert (
-            len(n_best_list) >= 1
-        ), f'TreeSearch returned {len(n_best_list)} candidates, must be >= 1'
-        for (pred, score) in n_best_list:
-            assert (
-                pred == self.eos
-            ).sum() == 1, f'TreeSearch returned a finalized hypo with multiple end tokens \
-            with score {score.item():.2f}'
+        n_best_lists = []
+        for sample_candidates in candidates:
+            # Note: beam size is almost always pretty small, so sorting is cheap
+            srted = sorted(sample_candidates, key=itemgetter(0), reverse=True)
+            if n_best is not None:
+                srted = srted[:n_best]
+            n_best_lists.append([(pred, score) for _, pred, score in srted])
+
+        # check that there is at least one finished candidate for each sample
+        assert all(
+            len(n_best_list) >= 1 for n_best_list in n_best_lists
+        ), 'TreeSearch returned no candidates for a sample, must be >= 1'
 
-        return n_best_list
+        return n_best_lists
 
 
 class GreedySearch(TreeSearch):
@@ -1261,9 +1261,9 @@ class GreedySearch(TreeSearch):
             raise ValueError('Greedy search can only be run with beam size 1.')
 
     def select_paths(self, logprobs, prior_scores):
-        tok_scores, tok_ids = logprobs.max(1)
+        tok_scores, tok_ids = logprobs.max(dim=-1)
         best_scores = tok_scores + prior_scores
-        hyp_ids = torch.arange(logprobs.size(0)).to(logprobs.device)
+        hyp_ids = self._hyp_range.to(logprobs.device)
         return (hyp_ids, tok_ids, best_scores)
 
 
@@ -1276,18 +1276,19 @@ class BeamSearch(TreeSearch):
         """
         Select the next vocabulary item in these beams.
         """
-        # if numel is 1, then this is the first time step, only one hyp is expanded
-        if prior_scores.numel() == 1:
-            logprobs = logprobs[0:1]
+        # if this is the first time step, only one hyp is expanded
+        if not self.bookkeep:
+            logprobs = logprobs[:, 0:1]
+            prior_scores = prior_scores[:, 0:1]
 
         # beam search actually looks over all hypotheses together so we flatten
-        beam_scores = logprobs + prior_scores.unsqueeze(1).expand_as(logprobs)
-        flat_beam_scores = beam_scores.view(-1)
+        beam_scores = logprobs + prior_scores.unsqueeze(-1)
+        flat_beam_scores = beam_scores.view(beam_scores.size(0), -1)
         best_scores, best_idxs = torch.topk(flat_beam_scores, self.beam_size, dim=-1)
         voc_size = logprobs.size(-1)
 
         # get the backtracking hypothesis id as a multiple of full voc_sizes
-        hyp_ids = best_idxs / voc_size
+        hyp_ids = best_idxs // voc_size
         # get the actual word id from residual of the same division
         tok_ids = best_idxs % voc_size
 
@@ -1313,11 +1314,12 @@ class TopKSampling(TreeSearch):
     def select_paths(self, logprobs, prior_scores):
         values, indices = logprobs.topk(self.k, dim=-1)
         probs = torch.softmax(values, dim=-1)
-        choices = torch.multinomial(probs, 1)[:, 0]
-        hyp_ids = torch.arange(logprobs.size(0)).to(logprobs.device)
-        tok_ids = indices[hyp_ids, choices]
-        scores = values[hyp_ids, choices]
-        best_scores = prior_scores.expand_as(scores) + scores
+        choices = torch.multinomial(probs.view(-1, self.k), 1)
+        choices = choices.view(*probs.shape[:-1], 1)
+        tok_ids = indices.gather(-1, choices).squeeze(-1)
+        scores = values.gather(-1, choices).squeeze(-1)
+        hyp_ids = self._hyp_range.to(logprobs.device)
+        best_scores = prior_scores + scores
         return (hyp_ids, tok_ids, best_scores)
 
 
@@ -1345,13 +1347,14 @@ class NucleusSampling(TreeSearch):
         # The subtraction here is so that we always include the first word to
         # go over p. For example, if the most probable token has a prob of 0.5, and
         # p = 0.3, then we need still need to include that first token.
-        mask = (sprobs.cumsum(dim=-1) - sprobs[:, :1]) >= self.p
+        mask = (sprobs.cumsum(dim=-1) - sprobs[..., :1]) >= self.p
         sprobs[mask] = 0
-        sprobs.div_(sprobs.sum(dim=-1).unsqueeze(1))
-        choices = torch.multinomial(sprobs, 1)[:, 0]
-        hyp_ids = torch.arange(logprobs.size(0)).to(logprobs.device)
-        tok_ids = sinds[hyp_ids, choices]
+        sprobs.div_(sprobs.sum(dim=-1, keepdim=True))
+        choices = torch.multinomial(sprobs.view(-1, sprobs.size(-1)), 1)
+        choices = choices.view(*sprobs.shape[:-1], 1)
+        tok_ids = sinds.gather(-1, choices).squeeze(-1)
         # Convert back to logspace.
-        scores = sprobs[hyp_ids, choices].log()
-        best_scores = prior_scores.expand_as(scores) + scores
+        scores = sprobs.gather(-1, choices).squeeze(-1).log()
+        hyp_ids = self._hyp_range.to(logprobs.device)
+        best_scores = prior_scores + scores
         return (hyp_ids, tok_ids, best_scores)
@@ -16,15 +16,25 @@ from itertools import islice
 import os
 from tqdm import tqdm
 import random
+import time
+
+import numpy as np
 
 import torch
 
 
 from parlai.core.opt import Opt
+from parlai.core.agents import create_agent, create_agent_from_shared
+from parlai.core.message import Message
 from parlai.utils.distributed import is_distributed
 from parlai.core.torch_agent import TorchAgent, Output
 from parlai.utils.misc import warn_once
-from parlai.utils.torch import padded_3d
+from parlai.utils.torch import neginf, padded_3d
+from parlai.utils.candidate_index import (
+    build_candidate_index,
+    candidate_index_exists,
+    load_candidate_index,
+)
 from parlai.core.metrics import AverageMetric
 
 
@@ -140,6 +150,50 @@ class TorchRankerAgent(TorchAgent):
             help='Ranking returns the top k results of k > 0, otherwise sorts every '
             'single candidate according to the ranking.',
         )
+        agent.add_argument(
+            '--candidate-index',
+            type=str,
+            default='none',
+            choices=['none', 'flat', 'ivf'],
+            help='With --eval-candidates fixed and --encode-candidate-vecs true, '
+            'retrieve the top candidates from a nearest-neighbour index over the '
+            'fixed candidate encodings instead of scoring every candidate. "flat" '
+            'is exact, "ivf" is approximate. The index is saved next to the '
+            'candidate encodings, and follows --fixed-candidate-vecs. Retrieves '
+            '--rank-top-k candidates if set, otherwise --cap-num-predictions. No '
+            'loss is reported when using an index.',
+        )
+        agent.add_argument(
+            '--candidate-index-nlist',
+            type=int,
+            default=-1,
+            help='Number of clusters of the ivf candidate index. Defaults to '
+            '4 * sqrt(number of candidates).',
+        )
+        agent.add_argument(
+            '--candidate-index-nprobe',
+            type=int,
+            default=8,
+            help='Number of clusters searched for each query by the ivf candidate '
+            'index. Higher values improve recall at the cost of latency.',
+        )
+        agent.add_argument(
+            '--first-stage-model-file',
+            type=str,
+            default=None,
+            help='Model file of a cheaper ranker, e.g. a bi-encoder or poly-encoder, '
+            'which first narrows the eval candidates down to --first-stage-top-k. '
+            'Only those are scored by this model. Its candidate encodings are '
+            'cached for fixed candidates if it has --encode-candidate-vecs true. '
+            'No loss is reported when ranking in two stages.',
+        )
+        agent.add_argument(
+            '--first-stage-top-k',
+            type=int,
+            default=100,
+            help='Number of candidates kept by the first stage ranker for each '
+            'example.',
+        )
         agent.add_argument(
             '--inference',
             choices={'max', 'topk'},
@@ -188,10 +242,13 @@ class TorchRankerAgent(TorchAgent):
                 states = {}
 
         self.rank_top_k = opt.get('rank_top_k', -1)
+        self.candidate_index_type = opt.get('candidate_index', 'none')
 
         # Vectorize and save fixed/vocab candidates once upfront if applicable
         self.set_fixed_candidates(shared)
         self.set_vocab_candidates(shared)
+        self.first_stage_top_k = opt.get('first_stage_top_k', 100)
+        self.set_first_stage(shared)
 
         if shared:
             # We don't use get here because hasattr is used on optimizer later.
@@ -269,9 +326,49 @@ class TorchRankerAgent(TorchAgent):
         """
         pass
 
+    def encode_retrieval_queries(self, batch):
+        """
+        Encode the contexts of a batch into queries for the candidate index.
+
+        This is an abstract method, which must be implemented to use
+        --candidate-index. Candidates are retrieved by the inner product of the
+        queries with the candidate encodings.
+
+        :param Batch batch:
+            a Batch object (defined in torch_agent.py)
+
+        :return:
+            a [bsz, dim] FloatTensor of queries
+        """
+        raise NotImplementedError(
+            'Abstract method: user must implement encode_retrieval_queries() to '
+            'use --candidate-index.'
+        )
+
+    def score_retrieved_candidates(self, batch, queries, cand_encs):
+        """
+        Score the candidates retrieved from the candidate index.
+
+        By default, scores are the inner products used for the retrieval. Agents
+        which score candidates differently from their retrieval (e.g. the
+        poly-encoder) should override this to rerank the retrieved candidates.
+
+        :param Batch batch:
+            a Batch object (defined in torch_agent.py)
+        :param queries:
+            the [bsz, dim] output of encode_retrieval_queries()
+        :param cand_encs:
+            a [bsz, k, dim] FloatTensor of the retrieved candidate encodings
+
+        :return:
+            a [bsz, k] FloatTensor of scores
+        """
+        return torch.bmm(cand_encs, queries.unsqueeze(2)).squeeze(2)
+
     def _maybe_invalidate_fixed_encs_cache(self):
         if self.candidates != 'fixed':
             self.fixed_candidate_encs = None
+            self.fixed_candidate_index = None
 
     def _get_batch_train_metrics(self, scores):
         """
@@ -425,40 +522,48 @@ class TorchRankerAgent(TorchAgent):
             batch, source=self.eval_candidates, mode='eval'
         )
 
-        cand_encs = None
-        if self.encode_candidate_vecs and self.eval_candidates in ['fixed', 'vocab']:
-            # if we cached candidate encodings for a fixed list of candidates,
-            # pass those into the score_candidates function
-            if self.fixed_candidate_encs is None:
-                self.fixed_candidate_encs = self._make_candidate_encs(
-                    cand_vecs
-                ).detach()
-            if self.eval_candidates == 'fixed':
-                cand_encs = self.fixed_candidate_encs
-            elif self.eval_candidates == 'vocab':
-                cand_encs = self.vocab_candidate_encs
-
-        scores = self.score_candidates(batch, cand_vecs, cand_encs=cand_encs)
-        if self.rank_top_k > 0:
-            _, ranks = scores.topk(
-                min(self.rank_top_k, scores.size(1)), 1, largest=True
-            )
+        if self._use_candidate_index():
+            ranks = self._rank_with_candidate_index(batch, cands, cand_vecs, label_inds)
+        elif self.first_stage is not None and batch.text_vec is not None:
+            ranks = self._rank_first_stage_top_k(batch, cands, cand_vecs, label_inds)
         else:
-            _, ranks = scores.sort(1, descending=True)
-
-        # Update metrics
-        if label_inds is not None:
-            loss = self.criterion(scores, label_inds)
-            self.record_local_metric('loss', AverageMetric.many(loss))
-            ranks_m = []
-            mrrs_m = []
-            for b in range(batchsize):
-                rank = (ranks[b] == label_inds[b]).nonzero()
-                rank = rank.item() if len(rank) == 1 else scores.size(1)
-                ranks_m.append(1 + rank)
-                mrrs_m.append(1.0 / (1 + rank))
-            self.record_local_metric('rank', AverageMetric.many(ranks_m))
-            self.record_local_metric('mrr', AverageMetric.many(mrrs_m))
+            cand_encs = None
+            if self.encode_candidate_vecs and self.eval_candidates in [
+                'fixed',
+                'vocab',
+            ]:
+                # if we cached candidate encodings for a fixed list of candidates,
+                # pass those into the score_candidates function
+                if self.fixed_candidate_encs is None:
+                    self.fixed_candidate_encs = self._make_candidate_encs(
+                        cand_vecs
+                    ).detach()
+                if self.eval_candidates == 'fixed':
+                    cand_encs = self.fixed_candidate_encs
+                elif self.eval_candidates == 'vocab':
+                    cand_encs = self.vocab_candidate_encs
+
+            scores = self.score_candidates(batch, cand_vecs, cand_encs=cand_encs)
+            if self.rank_top_k > 0:
+                _, ranks = scores.topk(
+                    min(self.rank_top_k, scores.size(1)), 1, largest=True
+                )
+            else:
+                _, ranks = scores.sort(1, descending=True)
+
+            # Update metrics
+            if label_inds is not None:
+                loss = self.criterion(scores, label_inds)
+                self.record_local_metric('loss', AverageMetric.many(loss))
+                ranks_m = []
+                mrrs_m = []
+                for b in range(batchsize):
+                    rank = (ranks[b] == label_inds[b]).nonzero()
+                    rank = rank.item() if len(rank) == 1 else scores.size(1)
+                    ranks_m.append(1 + rank)
+                    mrrs_m.append(1.0 / (1 + rank))
+                self.record_local_metric('rank', AverageMetric.many(ranks_m))
+                self.record_local_metric('mrr', AverageMetric.many(mrrs_m))
 
         ranks = ranks.cpu()
         max_preds = self.opt['cap_num_predictions']
@@ -491,6 +596,200 @@ class TorchRankerAgent(TorchAgent):
 
         return Output(preds, cand_preds)
 
+    def _use_candidate_index(self):
+        return (
+            self.candidate_index_type != 'none'
+            and self.encode_candidate_vecs
+            and self.eval_candidates == 'fixed'
+        )
+
+    def _rank_with_candidate_index(self, batch, cands, cand_vecs, label_inds):
+        """
+        Rank the fixed candidates retrieved from the candidate index.
+
+        Only the top candidates are scored, so the ranks of other candidates are
+        unknown: a label missing from the retrieved candidates gets the worst
+        possible rank, and no loss is computed.
+
+        :return:
+            a [bsz, k] LongTensor of candidate indices, best first
+        """
+        if self.fixed_candidate_index is None:
+            # invalidated during training, rebuild it in memory
+            if self.fixed_candidate_encs is None:
+                self.fixed_candidate_encs = self._make_candidate_encs(
+                    self.fixed_candidate_vecs
+                ).detach()
+            self.fixed_candidate_index = self._build_candidate_index(
+                self.fixed_candidate_encs
+            )
+            self.fixed_candidate_encs = None
+        index = self.fixed_candidate_index
+        k = self.rank_top_k if self.rank_top_k > 0 else self.opt['cap_num_predictions']
+
+        with torch.no_grad():
+            queries = self.encode_retrieval_queries(batch)
+            _, cand_ids = index.search(queries, k)
+            cand_ids = cand_ids.to(queries.device)
+            cand_encs = index.get_vectors(cand_ids).to(queries)
+            num_extra = len(cands) - len(index)
+            if num_extra > 0:
+                # candidates appended to the fixed set for this batch, e.g. the
+                # labels of AddLabelFixedCandsTRA; always score them
+                extra_encs = self.encode_candidates(cand_vecs[len(index) :])
+                extra_encs = extra_encs.view(num_extra, -1).to(queries)
+                bsz = queries.size(0)
+                extra_ids = torch.arange(len(index), len(cands), device=queries.device)
+                cand_ids = torch.cat([cand_ids, extra_ids.expand(bsz, -1)], dim=1)
+                cand_encs = torch.cat(
+                    [cand_encs, extra_encs.expand(bsz, -1, -1)], dim=1
+                )
+            scores = self.score_retrieved_candidates(batch, queries, cand_encs)
+        ranks = self._sort_candidate_ids(cand_ids, scores)
+        if label_inds is not None:
+            self._record_top_k_ranks(ranks, label_inds, len(cands))
+        return ranks
+
+    def _rank_first_stage_top_k(self, batch, cands, cand_vecs, label_inds):
+        """
+        Rank the top candidates of the first stage ranker with this model.
+
+        As with the candidate index, the ranks of other candidates are unknown: a
+        label missing from the top candidates gets the worst possible rank, and no
+        loss is computed. The recall of the first stage, and the latency of both
+        stages, are reported.
+
+        :return:
+            a [bsz, k] LongTensor of candidate indices, best first
+        """
+        start = time.time()
+        with torch.no_grad():
+            first_stage_scores = self._first_stage_scores(batch, cands, cand_vecs)
+            k = min(self.first_stage_top_k, first_stage_scores.size(1))
+            _, cand_ids = first_stage_scores.topk(k, dim=1)
+            cand_ids = cand_ids.to(cand_vecs.device)
+            if self.use_cuda:
+                torch.cuda.synchronize()
+            first_stage_end = time.time()
+            if cand_vecs.dim() == 2:
+                top_vecs = cand_vecs[cand_ids]
+            else:
+                top_vecs = cand_vecs.gather(
+                    1, cand_ids.unsqueeze(2).expand(-1, -1, cand_vecs.size(2))
+                )
+            scores = self.score_candidates(batch, top_vecs)
+            if self.use_cuda:
+                torch.cuda.synchronize()
+        end = time.time()
+        self.global_metrics.add(
+            'first_stage_ms', AverageMetric(1000 * (first_stage_end - start))
+        )
+        self.global_metrics.add(
+            'rerank_ms', AverageMetric(1000 * (end - first_stage_end))
+        )
+
+        ranks = self._sort_candidate_ids(cand_ids, scores)
+        if label_inds is not None:
+            label_inds = label_inds.to(cand_ids.device)
+            recalls = (cand_ids == label_inds.unsqueeze(1)).any(dim=1)
+            self.record_local_metric(
+                'first_stage_recall', AverageMetric.many(recalls.tolist())
+            )
+            self._record_top_k_ranks(ranks, label_inds, cand_vecs.size(-2))
+        return ranks
+
+    def _first_stage_scores(self, batch, cands, cand_vecs):
+        """
+        Score every candidate of the batch with the first stage ranker.
+
+        The first stage ranker vectorizes the contexts and candidates with its own
+        dictionary. The vectors, and encodings, of the fixed candidates are cached.
+        """
+        first_stage = self.first_stage
+        first_stage.model.eval()
+        first_stage_batch = self._first_stage_batch(batch)
+        if cand_vecs.dim() == 3:
+            # inline candidates
+            first_stage_cand_vecs = padded_3d(
+                [first_stage.vectorize_fixed_candidates(c) for c in cands],
+                pad_idx=first_stage.NULL_IDX,
+                use_cuda=first_stage.use_cuda,
+            )
+            scores = first_stage.score_candidates(
+                first_stage_batch, first_stage_cand_vecs
+            )
+            # never keep the padding over real candidates
+            for i, cands_i in enumerate(cands):
+                scores[i, len(cands_i) :] = neginf(scores.dtype)
+            return scores
+
+        if cands is not self.fixed_candidates:
+            first_stage_cand_vecs = padded_3d(
+                [first_stage.vectorize_fixed_candidates(cands)],
+                pad_idx=first_stage.NULL_IDX,
+                use_cuda=first_stage.use_cuda,
+            ).squeeze(0)
+            return first_stage.score_candidates(
+                first_stage_batch, first_stage_cand_vecs
+            )
+
+        if self.first_stage_fixed_cands is None:
+            vecs = first_stage._make_candidate_vecs(cands)
+            if first_stage.use_cuda:
+                vecs = vecs.cuda()
+            encs = None
+            if first_stage.encode_candidate_vecs:
+                encs = first_stage._make_candidate_encs(vecs).detach()
+                encs = encs.half() if first_stage.fp16 else encs.float()
+            self.first_stage_fixed_cands = (vecs, encs)
+        vecs, encs = self.first_stage_fixed_cands
+        return first_stage.score_candidates(first_stage_batch, vecs, cand_encs=encs)
+
+    def _first_stage_batch(self, batch):
+        """
+        Vectorize the contexts of the batch for the first stage ranker.
+        """
+        first_stage = self.first_stage
+        obs_batch = []
+        for obs in batch.observations:
+            message = Message(
+                {'text': obs.get('full_text', obs.get('text')), 'episode_done': True}
+            )
+            history = first_stage.build_history()
+            history.update_history(message)
+            obs_batch.append(
+                first_stage.vectorize(
+                    message, history, text_truncate=first_stage.text_truncate
+                )
+            )
+        return first_stage.batchify(obs_batch)
+
+    def _sort_candidate_ids(self, cand_ids, scores):
+        """
+        Sort the [bsz, k] candidate indices by decreasing score.
+
+        Ties are broken by candidate index, as when sorting every candidate.
+        """
+        cand_ids = cand_ids.cpu()
+        order = np.lexsort((cand_ids.numpy(), -scores.float().cpu().numpy()))
+        return cand_ids.gather(1, torch.from_numpy(order))
+
+    def _record_top_k_ranks(self, ranks, label_inds, num_cands):
+        """
+        Record the rank and mrr of the labels among the top ranked candidates.
+        """
+        # ranks are sorted on the CPU, labels may be on the GPU
+        label_inds = label_inds.to(ranks.device)
+        ranks_m = []
+        mrrs_m = []
+        for b in range(ranks.size(0)):
+            rank = (ranks[b] == label_inds[b]).nonzero()
+            rank = rank.item() if len(rank) == 1 else num_cands
+            ranks_m.append(1 + rank)
+            mrrs_m.append(1.0 / (1 + rank))
+        self.record_local_metric('rank', AverageMetric.many(ranks_m))
+        self.record_local_metric('mrr', AverageMetric.many(mrrs_m))
+
     def block_repeats(self, cand_preds):
         """
         Heuristic to block a model repeating a line from the history.
@@ -743,6 +1042,10 @@ class TorchRankerAgent(TorchAgent):
         shared['fixed_candidates'] = self.fixed_candidates
         shared['fixed_candidate_vecs'] = self.fixed_candidate_vecs
         shared['fixed_candidate_encs'] = self.fixed_candidate_encs
+        shared['fixed_candidate_index'] = self.fixed_candidate_index
+        if self.first_stage is not None:
+            shared['first_stage'] = self.first_stage.share()
+            shared['first_stage_fixed_cands'] = self.first_stage_fixed_cands
         shared['num_fixed_candidates'] = self.num_fixed_candidates
         shared['vocab_candidates'] = self.vocab_candidates
         shared['vocab_candidate_vecs'] = self.vocab_candidate_vecs
@@ -815,9 +1118,11 @@ class TorchRankerAgent(TorchAgent):
             self.fixed_candidates = shared['fixed_candidates']
             self.fixed_candidate_vecs = shared['fixed_candidate_vecs']
             self.fixed_candidate_encs = shared['fixed_candidate_encs']
+            self.fixed_candidate_index = shared.get('fixed_candidate_index')
             self.num_fixed_candidates = shared['num_fixed_candidates']
         else:
             self.num_fixed_candidates = 0
+            self.fixed_candidate_index = None
             opt = self.opt
             cand_path = self.fixed_candidates_path
             if 'fixed' in (self.candidates, self.eval_candidates):
@@ -861,20 +1166,40 @@ class TorchRankerAgent(TorchAgent):
                     enc_path = os.path.join(
                         model_dir, '.'.join([model_name, cands_name, 'encs'])
                     )
-                    if setting == 'reuse' and os.path.isfile(enc_path):
+                    index_path = None
+                    if self.candidate_index_type != 'none':
+                        index_name = '.'.join(
+                            [model_name, cands_name, self.candidate_index_type, 'index']
+                        )
+                        index_path = os.path.join(model_dir, index_name)
+                        if setting == 'reuse':
+                            self.fixed_candidate_index = self._load_candidate_index(
+                                index_path, enc_path, len(cands)
+                            )
+                    if self.fixed_candidate_index is not None:
+                        # the index holds the encodings
+                        encs = None
+                    elif setting == 'reuse' and os.path.isfile(enc_path):
                         encs = self.load_candidates(enc_path, cand_type='encodings')
                     else:
                         encs = self._make_candidate_encs(self.fixed_candidate_vecs)
                         self._save_candidates(
                             encs, path=enc_path, cand_type='encodings'
                         )
+                    if encs is not None:
+                        if self.use_cuda:
+                            encs = encs.cuda()
+                        encs = encs.half() if self.fp16 else encs.float()
                     self.fixed_candidate_encs = encs
-                    if self.use_cuda:
-                        self.fixed_candidate_encs = self.fixed_candidate_encs.cuda()
-                    if self.fp16:
-                        self.fixed_candidate_encs = self.fixed_candidate_encs.half()
-                    else:
-                        self.fixed_candidate_encs = self.fixed_candidate_encs.float()
+                    if index_path is not None and self.fixed_candidate_index is None:
+                        self.fixed_candidate_index = self._build_candidate_index(
+                            self.fixed_candidate_encs
+                        )
+                        print(
+                            "[ Saving fixed candidate index to {} ]".format(index_path)
+                        )
+                        self.fixed_candidate_index.save(index_path)
+                        self.fixed_candidate_encs = None
                 else:
                     self.fixed_candidate_encs = None
 
@@ -883,6 +1208,85 @@ class TorchRankerAgent(TorchAgent):
                 self.fixed_candidate_vecs = None
                 self.fixed_candidate_encs = None
 
+    def set_first_stage(self, shared):
+        """
+        Create the first stage ranker of --first-stage-model-file, if any.
+
+        self.first_stage_fixed_cands will cache the vectors and encodings of the
+        fixed candidates by the first stage ranker.
+        """
+        self.first_stage = None
+        self.first_stage_fixed_cands = None
+        if shared:
+            if 'first_stage' in shared:
+                self.first_stage = create_agent_from_shared(shared['first_stage'])
+                self.first_stage_fixed_cands = shared['first_stage_fixed_cands']
+            return
+        model_file = self.opt.get('first_stage_model_file')
+        if not model_file:
+            return
+        # the first stage ranker only scores the candidates it is given
+        override = {
+            'eval_candidates': 'inline',
+            'interactive_mode': False,
+            'candidate_index': 'none',
+            'first_stage_model_file': None,
+            'no_cuda': not self.use_cuda,
+        }
+        first_stage_opt = {
+            'model_file': model_file,
+            'datapath': self.opt['datapath'],
+            'gpu': self.opt.get('gpu', -1),
+            'override': override,
+        }
+        first_stage_opt.update(override)
+        print("[ Loading first stage ranker from {} ]".format(model_file))
+        self.first_stage = create_agent(first_stage_opt, requireModelExists=True)
+        if not isinstance(self.first_stage, TorchRankerAgent):
+            raise ValueError(
+                '--first-stage-model-file must be the model of a TorchRankerAgent, '
+                'not {}'.format(type(self.first_stage).__name__)
+            )
+
+    def _build_candidate_index(self, encs):
+        """
+        Build the --candidate-index over the given fixed candidate encodings.
+        """
+        # e.g. the poly-encoder stores its encodings as [1, num_cands, dim]
+        encs = encs.view(-1, encs.size(-1))
+        print(
+            "[ Building {} candidate index over {} candidates ]".format(
+                self.candidate_index_type, encs.size(0)
+            )
+        )
+        kwargs = {}
+        if self.candidate_index_type == 'ivf':
+            kwargs['nlist'] = self.opt.get('candidate_index_nlist', -1)
+            kwargs['nprobe'] = self.opt.get('candidate_index_nprobe', 8)
+        return build_candidate_index(self.candidate_index_type, encs, **kwargs)
+
+    def _load_candidate_index(self, index_path, enc_path, num_cands):
+        """
+        Load a saved candidate index, unless it is missing or out of date.
+        """
+        if not candidate_index_exists(index_path):
+            return None
+        if os.path.isfile(enc_path) and os.path.getmtime(enc_path) > os.path.getmtime(
+            index_path
+        ):
+            # the encodings were replaced since the index was built
+            return None
+        print("[ Loading fixed candidate index from {} ]".format(index_path))
+        index = load_candidate_index(
+            index_path, nprobe=self.opt.get('candidate_index_nprobe', 8)
+        )
+        if len(index) != num_cands:
+            return None
+        return index.to(
+            device='cuda' if self.use_cuda else None,
+            dtype=torch.half if self.fp16 else torch.float,
+        )
+
     def load_candidates(self, path, cand_type='vectors'):
         """
         Load fixed candidates from a path.
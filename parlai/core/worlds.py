@@ -41,24 +41,42 @@ All worlds are initialized with the following parameters:
         data (possibly in different Processes).
 """
 
+import bisect
+import collections
 import copy
+import heapq
+import queue
 import random
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Tuple, Union
 
 try:
-    from torch.multiprocessing import Process, Value, Condition, Semaphore
+    from torch.multiprocessing import Process, Value, Array, Condition, Semaphore
 except ImportError:
-    from multiprocessing import Process, Value, Semaphore, Condition  # noqa: F401
+    from multiprocessing import (  # noqa: F401
+        Process,
+        Value,
+        Array,
+        Semaphore,
+        Condition,
+    )
 
 from parlai.core.agents import create_agents_from_shared
 from parlai.core.loader import load_task_module, load_world_module
-from parlai.core.metrics import aggregate_named_reports
+from parlai.core.metrics import (
+    aggregate_named_reports,
+    AverageMetric,
+    SumMetric,
+    TeacherMetrics,
+)
 from parlai.core.opt import Opt
-from parlai.core.teachers import create_task_agent_from_taskname
-from parlai.utils.misc import Timer, display_messages
+from parlai.core.teachers import MultiTaskTeacher, create_task_agent_from_taskname
+from parlai.utils.misc import Timer, display_messages, warn_once
+from parlai.utils.thread import memory_usage
 from parlai.tasks.tasks import ids_to_tasks
 
 
@@ -794,6 +812,261 @@ def _override_opts_in_shared(table, overrides):
     return table
 
 
+class _PrefetchedObservations(list):
+    """
+    A batch of observations along with the Batch already built from them.
+
+    ``TorchAgent.batch_act`` uses ``prefetched_batch`` instead of calling
+    ``batchify`` again.
+    """
+
+    def __init__(self, observations, prefetched_batch):
+        super().__init__(observations)
+        self.prefetched_batch = prefetched_batch
+
+
+class _BatchPrefetcher(object):
+    """
+    Builds the upcoming batches of a BatchWorld on background threads.
+
+    A producer thread runs the teacher ``act`` for every sub-world, up to
+    ``depth`` batches ahead of the one being trained on. Once the model replied
+    to a batch, the producer replays the replies into the model copies'
+    ``self_observe`` and has them ``observe`` (which vectorizes) the next one,
+    in exactly the order BatchWorld would. A pool of workers then ``batchify``
+    the observations, pinning memory if CUDA is available.
+
+    This is only valid when the teachers' next acts do not depend on the
+    replies, i.e. while training with ``--use-reply label`` or ``none``, with
+    teachers and a model which opt in with ``supports_prefetch``. Teacher
+    metrics are still computed against the label of the example each reply
+    belongs to, by the teacher, or sub-teacher of a ``MultiTaskTeacher``, which
+    produced it.
+
+    ``lock`` only serializes the producer with the teachers observing replies.
+    The producer runs the teachers' ``act`` and the model copies' ``observe`` and
+    ``self_observe`` while the main thread runs the model's ``batch_act``,
+    ``report`` and ``reset_metrics``, and ``report`` and ``reset_metrics`` of the
+    teachers. So the former must not touch the state used by the latter, such as
+    the model, the metrics, or the optimizer, which is what ``supports_prefetch``
+    promises.
+
+    :param batch_world:
+        the BatchWorld whose sub-worlds are advanced.
+    :param depth:
+        maximum number of batches the teachers act ahead of time.
+    :param num_workers:
+        number of threads running ``batchify``.
+    """
+
+    def __init__(self, batch_world, depth, num_workers):
+        self.batch_world = batch_world
+        self.depth = depth
+        self.num_workers = max(num_workers, 1)
+        # guards the agents' state between the producer and the main thread
+        self.lock = threading.Lock()
+        self.thread = None
+        self.reset_metrics()
+
+    @staticmethod
+    def can_prefetch(opt, world):
+        """
+        Return whether batches of this world may be built ahead of time.
+        """
+        datatype = opt.get('datatype', '')
+        agents = world.get_agents()
+        return (
+            datatype.startswith('train')
+            and 'evalmode' not in datatype
+            and opt.get('use_reply', 'label') in ('label', 'none')
+            and isinstance(world, DialogPartnerWorld)
+            and type(world).parley is DialogPartnerWorld.parley
+            and not hasattr(world, 'observe')
+            and len(agents) == 2
+            and getattr(agents[0], 'supports_prefetch', False)
+            and getattr(agents[1], 'supports_prefetch', False)
+            and hasattr(agents[1], 'batchify')
+            and hasattr(agents[1], 'batch_act')
+        )
+
+    def start(self):
+        """
+        Start producing batches in the background.
+        """
+        self.stop_event = threading.Event()
+        self.queue = queue.Queue(maxsize=self.depth)
+        # the replies to each batch handed out, for the model copies
+        self.replies = queue.Queue()
+        self.pool = ThreadPoolExecutor(self.num_workers)
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop producing batches and drop any which were prepared.
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        while self.thread.is_alive():
+            # unblock the producer if it is waiting on a full queue
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.01)
+        self.pool.shutdown(wait=True)
+        self.thread = None
+
+    def _act(self):
+        """
+        Advance every sub-world by one teacher turn.
+        """
+        teacher_acts = []
+        teachers = []
+        labels = []
+        for w in self.batch_world.worlds:
+            teacher = w.get_agents()[0]
+            act = teacher.act()
+            w.get_acts()[0] = act
+            teacher_acts.append(act)
+            # the multitask teacher may switch tasks before the reply comes back
+            acting = teacher
+            while isinstance(acting, MultiTaskTeacher):
+                acting = acting.tasks[acting.task_idx]
+            teachers.append(acting)
+            labels.append(getattr(acting, 'lastY', None))
+            if hasattr(teacher, 'self_observe'):
+                teacher.self_observe(validate(act))
+        return {
+            'teacher_acts': teacher_acts,
+            'teachers': teachers,
+            'labels': labels,
+            'epoch_done': self.batch_world._epoch_done(),
+        }
+
+    def _observe(self, record, replies):
+        """
+        Have the model copies observe their replies, then the teacher acts.
+        """
+        observations = []
+        for i, w in enumerate(self.batch_world.worlds):
+            model = w.get_agents()[1]
+            if replies is not None and hasattr(model, 'self_observe'):
+                model.self_observe(validate(replies[i]))
+            observation = model.observe(validate(record['teacher_acts'][i]))
+            if observation is None:
+                raise ValueError('Agents should return what they observed.')
+            observations.append(observation)
+        record['observations'] = observations
+
+    def _next_replies(self, acted):
+        """
+        Wait for the replies to the last batch, acting ahead in the meantime.
+
+        :return:
+            the replies, or None if stopped.
+        """
+        while not self.stop_event.is_set():
+            if len(acted) < self.depth:
+                try:
+                    return self.replies.get_nowait()
+                except queue.Empty:
+                    pass
+                with self.lock:
+                    acted.append(self._act())
+            else:
+                try:
+                    return self.replies.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        return None
+
+    def observe_replies(self, replies):
+        """
+        Hand the model's replies to the last batch to the model copies.
+        """
+        self.replies.put(replies)
+
+    def _batchify(self, observations):
+        model = self.batch_world.world.get_agents()[1]
+        batch = model.batchify(observations)
+        if _torch_cuda_available():
+            for key, value in batch.items():
+                if hasattr(value, 'pin_memory') and not value.is_cuda:
+                    batch[key] = value.pin_memory()
+        return batch
+
+    def _produce(self):
+        try:
+            acted = collections.deque()
+            replies = None
+            while not self.stop_event.is_set():
+                if not acted:
+                    with self.lock:
+                        acted.append(self._act())
+                record = acted.popleft()
+                self._observe(record, replies)
+                future = self.pool.submit(self._batchify, record['observations'])
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put((record, future), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                replies = self._next_replies(acted)
+        except Exception as e:
+            self.queue.put((e, None))
+
+    def next(self):
+        """
+        Return the next prepared record, with its Batch, waiting if needed.
+        """
+        if self.thread is None:
+            self.start()
+        depth = self.queue.qsize()
+        start = time.time()
+        record, future = self.queue.get()
+        if isinstance(record, Exception):
+            self.stop()
+            raise record
+        batch = future.result()
+        self.stall_secs += time.time() - start
+        self.queue_depth += depth
+        self.num_batches += 1
+        return record, batch
+
+    def report(self):
+        """
+        Report queue depth and the time spent waiting on the pipeline.
+        """
+        if self.num_batches == 0:
+            return {}
+        return {
+            'prefetch_queue_depth': AverageMetric(self.queue_depth, self.num_batches),
+            'prefetch_stall_secs': SumMetric(self.stall_secs),
+        }
+
+    def reset_metrics(self):
+        """
+        Reset the pipeline metrics.
+        """
+        self.queue_depth = 0
+        self.stall_secs = 0.0
+        self.num_batches = 0
+
+
+def _torch_cuda_available():
+    """
+    Return whether CUDA is available, without requiring torch.
+    """
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
 class BatchWorld(World):
     """
     BatchWorld contains many copies of the same world.
@@ -804,6 +1077,10 @@ class BatchWorld(World):
     The underlying world(s) it is batching can be either
     ``DialogPartnerWorld``, ``MultiAgentWorld``, ``ExecutableWorld`` or
     ``MultiWorld``.
+
+    With ``--batch-prefetch N``, up to N upcoming batches are prepared on
+    background threads while the current one is processed by the model, see
+    ``_BatchPrefetcher``.
     """
 
     def __init__(self, opt: Opt, world):
@@ -827,10 +1104,29 @@ class BatchWorld(World):
         self.first_batch = None
         self.acts = [None] * len(self.world.get_agents())
 
+        self.prefetcher = None
+        if opt.get('batch_prefetch', 0) > 0:
+            if _BatchPrefetcher.can_prefetch(opt, world):
+                self.prefetcher = _BatchPrefetcher(
+                    self, opt['batch_prefetch'], opt.get('batch_prefetch_workers', 1)
+                )
+            else:
+                warn_once(
+                    'WARNING: --batch-prefetch is only supported when training a '
+                    'two-agent dialog task with --use-reply label or none, with a '
+                    'teacher and model which set supports_prefetch. '
+                    'Batches will not be prefetched.'
+                )
+        self._prefetch_epoch_done = False
+
     def batch_observe(self, index, batch_actions, index_acting):
         """
         Observe corresponding actions in all subworlds.
         """
+        if index != index_acting:
+            self._precompute_teacher_metrics(
+                [w.get_agents()[index] for w in self.worlds], batch_actions
+            )
         batch_observations = []
         for i, w in enumerate(self.worlds):
             agents = w.get_agents()
@@ -860,6 +1156,31 @@ class BatchWorld(World):
             batch_observations.append(observation)
         return batch_observations
 
+    def _precompute_teacher_metrics(self, teachers, batch_actions, labels=None):
+        """
+        Compute the text metrics of the batch in one call, before teachers observe it.
+
+        :param labels:
+            the labels of each teacher, if not their current ``lastY``.
+        """
+        metrics, predictions, batch_labels = [], [], []
+        for i, (teacher, act) in enumerate(zip(teachers, batch_actions)):
+            teacher_labels = (
+                getattr(teacher, 'lastY', None) if labels is None else labels[i]
+            )
+            if (
+                teacher_labels is None
+                or not isinstance(getattr(teacher, 'metrics', None), TeacherMetrics)
+                or not isinstance(act, dict)
+                or act.get('text') is None
+            ):
+                continue
+            metrics.append(teacher.metrics)
+            predictions.append(act['text'])
+            batch_labels.append(teacher_labels)
+        if len(metrics) > 1:
+            TeacherMetrics.precompute_batch(metrics, predictions, batch_labels)
+
     def batch_act(self, agent_idx, batch_observation):
         """
         Act in all subworlds.
@@ -889,6 +1210,10 @@ class BatchWorld(World):
 
         Usually with ref:`batch_act` and ref:`batch_observe`.
         """
+        if self.prefetcher is not None:
+            self._prefetched_parley()
+            return
+
         # Collect batch together for each agent, and do update.
         # Assumes DialogPartnerWorld, MultiAgentWorld, or MultiWorlds of them.
         num_agents = len(self.world.get_agents())
@@ -913,6 +1238,32 @@ class BatchWorld(World):
                     batch_observations[other_index] = obs
         self.update_counters()
 
+    def _prefetched_parley(self):
+        """
+        Train on the next prefetched batch and let the teachers observe replies.
+        """
+        record, batch = self.prefetcher.next()
+        model = self.world.get_agents()[1]
+        replies = model.batch_act(
+            _PrefetchedObservations(record['observations'], batch)
+        )
+        self.prefetcher.observe_replies(replies)
+        with self.prefetcher.lock:
+            self._precompute_teacher_metrics(
+                record['teachers'], replies, record['labels']
+            )
+            for i, w in enumerate(self.worlds):
+                w.get_acts()[1] = replies[i]
+                teacher = record['teachers'][i]
+                if hasattr(teacher, 'lastY'):
+                    # the teacher may already be ahead, restore this example's
+                    # label so its metrics are computed against it
+                    teacher.lastY = record['labels'][i]
+                teacher.observe(validate(replies[i]))
+        self.acts = [record['teacher_acts'], replies]
+        self._prefetch_epoch_done = record['epoch_done']
+        self.update_counters()
+
     def display(self):
         """
         Display the full batch.
@@ -978,6 +1329,12 @@ class BatchWorld(World):
         """
         Return if the epoch is done in the root world.
         """
+        if self.prefetcher is not None and self.prefetcher.thread is not None:
+            # the sub-worlds are ahead of what has been trained on
+            return self._prefetch_epoch_done
+        return self._epoch_done()
+
+    def _epoch_done(self):
         # first check parent world: if it says it's done, we're done
         if self.world.epoch_done():
             return True
@@ -991,12 +1348,18 @@ class BatchWorld(World):
         """
         Report metrics for the root world.
         """
-        return self.world.report()
+        report = self.world.report()
+        if self.prefetcher is not None:
+            report.update(self.prefetcher.report())
+        return report
 
     def reset(self):
         """
         Reset the root world, and all copies.
         """
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self._prefetch_epoch_done = False
         self.world.reset()
         for w in self.worlds:
             w.reset()
@@ -1006,6 +1369,8 @@ class BatchWorld(World):
         Reset metrics in the root world.
         """
         self.world.reset_metrics()
+        if self.prefetcher is not None:
+            self.prefetcher.reset_metrics()
 
     def save_agents(self):
         """
@@ -1019,12 +1384,28 @@ class BatchWorld(World):
         """
         Shutdown each world.
         """
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
         for w in self.worlds:
             w.shutdown()
         self.world.shutdown()
 
 
 class DynamicBatchWorld(World):
+    """
+    Group examples of similar lengths into batches, from a buffer of worlds.
+
+    With ``--dynamic-batching batchsort``, batches have a fixed size. With ``full``,
+    batches grow up to a budget of ``(text_truncate + label_truncate) * batchsize``
+    tokens. With ``packed``, batches have the same token budget, counted as the
+    padded text and label tensors the model will actually receive. Examples are kept
+    in buckets of their rounded length, updated as examples come and go, and batches
+    are filled first-fit decreasing from a random anchor example.
+
+    The world reports the ``padding_efficiency`` (real tokens over padded tokens) and
+    the ``tokens_per_batch`` of the batches it built.
+    """
+
     def __init__(self, opt: Opt, world: Union[DialogPartnerWorld, MultiWorld]):
         super().__init__(opt)
         self.opt = opt
@@ -1060,13 +1441,15 @@ class DynamicBatchWorld(World):
         # size of the buffer we will use to find worlds
         self._BUFFER_SIZE = 1021  # chosen as a prime number
 
-        if opt['dynamic_batching'] == 'full':
+        if opt['dynamic_batching'] in ('full', 'packed'):
             # full dynamic batching, we can grow our batchsize
             self.max_batch_size = self._BUFFER_SIZE
         else:
             # simple batchsort
             self.max_batch_size = opt['batchsize']
 
+        self.packed = opt['dynamic_batching'] == 'packed'
+
         # TODO: check to ensure the agent has self_observe
         shared = world.share()
         self.world = world
@@ -1084,6 +1467,13 @@ class DynamicBatchWorld(World):
         super().reset()
         self._obs = [None for _ in range(self._BUFFER_SIZE)]
         self._scores = [None for _ in range(self._BUFFER_SIZE)]
+        # for packed batching: rounded (text, label) widths -> indices of the
+        # worlds with examples of those widths, and the widths which have examples
+        # sorted by text width, label width and total width (see _width_keys)
+        self._buckets: Dict[Tuple[int, int], List[int]] = {}
+        self._widths_by_text: List[Tuple[int, int]] = []
+        self._widths_by_label: List[Tuple[int, int]] = []
+        self._widths_by_sum: List[Tuple[int, int]] = []
 
         self.number_parleys = 0
         self.total_exs = 0
@@ -1091,12 +1481,19 @@ class DynamicBatchWorld(World):
         self.rng = random.Random(4)
         for w in self.worlds:
             w.reset()
+        self._reset_padding_metrics()
 
     def reset_metrics(self):
         super().reset_metrics()
         self.world.reset_metrics()
         for w in self.worlds:
             w.reset_metrics()
+        self._reset_padding_metrics()
+
+    def _reset_padding_metrics(self):
+        self._num_batches = 0
+        self._real_tokens = 0
+        self._padded_tokens = 0
 
     def epoch_done(self):
         return (
@@ -1161,11 +1558,45 @@ class DynamicBatchWorld(World):
             self._scores[i] = self._score(obs)
             if self._scores[i] is not None:
                 indices.append(i)
+                if self.packed:
+                    self._bucket_add(i)
 
         # quick invariant checks
         assert len(indices) != 0, "DynamicBatchWorld ran out of data!"
         assert not any(self._scores[i] is None for i in indices)
 
+        if self.packed:
+            batch = self._packed_batch()
+        else:
+            batch = self._sorted_batch(indices)
+
+        # great, this batch is good to go! let's run it!
+        batch_obs = [self._obs[i] for i in batch]
+        self._update_padding_metrics(batch_obs)
+        acts = self.world.get_model_agent().batch_act(batch_obs)
+        # broadcast the results back to all the models
+        for i, act in zip(batch, acts):
+            # we need to make sure that the teachers saw the result
+            self.worlds[i].get_task_agent().observe(act)
+            # and that the agent copies saw their own voice
+            self.worlds[i].get_model_agent().self_observe(act)
+
+            # move these worlds forward
+            act = self.worlds[i].get_task_agent().act()
+            obs = self.worlds[i].get_model_agent().observe(act)
+            self._scores[i] = self._score(obs)
+            self._obs[i] = obs
+            if self.packed and self._scores[i] is not None:
+                self._bucket_add(i)
+
+        # update metrics
+        self.total_parleys += 1
+        self.total_exs += len(batch)
+
+    def _sorted_batch(self, indices):
+        """
+        Build a batch by sorting the whole buffer by length.
+        """
         # sort all the indices by their score, so that we can find similarly lengthed
         # items in O(1)
         indices = sorted(indices, key=lambda i: self._scores[i] + (self.rng.random(),))
@@ -1214,31 +1645,152 @@ class DynamicBatchWorld(World):
         assert self._ceil(width) * len(batch) <= self.max_words
         assert len(batch) > 0
         assert len(batch) <= self.max_batch_size
+        return batch
 
-        # great, this batch is good to go! let's run it!
-        acts = self.world.get_model_agent().batch_act([self._obs[i] for i in batch])
-        # broadcast the results back to all the models
-        for i, act in zip(batch, acts):
-            # we need to make sure that the teachers saw the result
-            self.worlds[i].get_task_agent().observe(act)
-            # and that the agent copies saw their own voice
-            self.worlds[i].get_model_agent().self_observe(act)
+    def _lengths(self, obs):
+        """
+        Return the unpadded text and label lengths of an observation.
+        """
+        label = obs.get('labels_vec', obs.get('eval_labels_vec', []))
+        return len(obs['text_vec']), len(label)
 
-            # move these worlds forward
-            act = self.worlds[i].get_task_agent().act()
-            obs = self.worlds[i].get_model_agent().observe(act)
-            self._scores[i] = self._score(obs)
-            self._obs[i] = obs
+    def _sorted_widths(self, width):
+        """
+        Return each sorted list of widths, with the key of the width in it.
+        """
+        text, label = width
+        return zip(
+            [self._widths_by_text, self._widths_by_label, self._widths_by_sum],
+            [(text, -label), (label, -text), (text + label, text)],
+        )
 
-        # update metrics
-        self.total_parleys += 1
-        self.total_exs += len(batch)
+    def _bucket_add(self, index):
+        # text and label widths, rounded like the score
+        score = self._scores[index]
+        width = (score[0], sum(score[1:]))
+        if width not in self._buckets:
+            self._buckets[width] = []
+            for widths, key in self._sorted_widths(width):
+                bisect.insort(widths, key)
+        self._buckets[width].append(index)
+
+    def _bucket_pop(self, width):
+        """
+        Remove a random world from the bucket of the given width.
+        """
+        bucket = self._buckets[width]
+        pos = self.rng.randrange(len(bucket))
+        bucket[pos], bucket[-1] = bucket[-1], bucket[pos]
+        index = bucket.pop()
+        if not bucket:
+            del self._buckets[width]
+            for widths, key in self._sorted_widths(width):
+                widths.pop(bisect.bisect_left(widths, key))
+        return index
+
+    def _widths_by_padding(self, text_width, label_width):
+        """
+        Return the buffered widths, by the padding they add to a batch of the given
+        widths.
+
+        Widths within the given ones come first, largest first. The others follow by
+        how much they widen the batch, then largest first: those wider in text only
+        are read off the widths sorted by text width, those wider in label only off
+        the widths sorted by label width, and those wider in both off the widths
+        sorted by total width, so nothing needs sorting.
+        """
+        inf = float('inf')
+        by_sum = self._widths_by_sum
+        fit = bisect.bisect_right(by_sum, (text_width + label_width, inf))
+        within = [
+            (text, total - text)
+            for total, text in reversed(by_sum[:fit])
+            if text <= text_width and total - text <= label_width
+        ]
+        # (widened, -total, width) of the widths wider in text, label, and both
+        start = bisect.bisect_right(self._widths_by_text, (text_width, inf))
+        wider_text = [
+            (text + label_width, neg_label - text, (text, -neg_label))
+            for text, neg_label in self._widths_by_text[start:]
+            if -neg_label <= label_width
+        ]
+        start = bisect.bisect_right(self._widths_by_label, (label_width, inf))
+        wider_label = [
+            (text_width + label, neg_text - label, (-neg_text, label))
+            for label, neg_text in self._widths_by_label[start:]
+            if -neg_text <= text_width
+        ]
+        wider_both = [
+            (total, -total, (text, total - text))
+            for total, text in by_sum[fit:]
+            if text > text_width and total - text > label_width
+        ]
+        merged = heapq.merge(wider_text, wider_label, wider_both)
+        return within + [width for _, _, width in merged]
+
+    def _packed_batch(self):
+        """
+        Build a batch from the length buckets, within the padded token budget.
+
+        A random example is the anchor. Its text and label widths bound the batch
+        first: examples which fit within them add no padding, and are taken
+        first-fit decreasing until the budget is full. If room is left, examples
+        which widen the batch are then taken the same way, as long as the padded
+        text and label tensors stay within the budget.
+        """
+        # pick the anchor uniformly among all buffered examples
+        target = self.rng.randrange(sum(len(b) for b in self._buckets.values()))
+        for text, neg_label in self._widths_by_text:
+            anchor = (text, -neg_label)
+            target -= len(self._buckets[anchor])
+            if target < 0:
+                break
+        text_width, label_width = anchor
+        batch = [self._bucket_pop(anchor)]
+
+        # largest examples first among those within the anchor's widths, then
+        # those which widen the batch the least
+        for width in self._widths_by_padding(text_width, label_width):
+            while width in self._buckets and len(batch) < self.max_batch_size:
+                new_text = max(text_width, width[0])
+                new_label = max(label_width, width[1])
+                if (len(batch) + 1) * (new_text + new_label) > self.max_words:
+                    break
+                batch.append(self._bucket_pop(width))
+                text_width, label_width = new_text, new_label
+            if len(batch) >= self.max_batch_size:
+                break
+
+        # Always have a batch size that's a multiple of 4, for fp16's sake.
+        while len(batch) > 4 and len(batch) % 4 != 0:
+            # put back the last added one, which widened the batch the most
+            self._bucket_add(batch.pop(-1))
+
+        assert len(batch) <= self.max_batch_size
+        return batch
+
+    def _update_padding_metrics(self, batch_obs):
+        """
+        Count the real and padded tokens of the text and label tensors of a batch.
+        """
+        text_lens, label_lens = zip(*(self._lengths(obs) for obs in batch_obs))
+        self._num_batches += 1
+        self._real_tokens += sum(text_lens) + sum(label_lens)
+        self._padded_tokens += len(batch_obs) * (max(text_lens) + max(label_lens))
 
     def get_total_epochs(self):
         return self.total_exs / self.num_examples()
 
     def report(self):
-        return self.world.report()
+        report = self.world.report()
+        if self._num_batches > 0:
+            report['padding_efficiency'] = AverageMetric(
+                self._real_tokens, self._padded_tokens
+            )
+            report['tokens_per_batch'] = AverageMetric(
+                self._real_tokens, self._num_batches
+            )
+        return report
 
 
 class HogwildProcess(Process):
@@ -1253,6 +1805,7 @@ class HogwildProcess(Process):
         opt = copy.deepcopy(opt)
         opt['numthreads'] = 1  # don't let threads create more threads!
         self.opt = opt
+        self.tid = tid
         self.shared = shared
         self.shared['threadindex'] = tid
         if 'agents' in self.shared:
@@ -1271,6 +1824,10 @@ class HogwildProcess(Process):
         world = self.shared['world_class'](self.opt, None, self.shared)
         if self.opt.get('batchsize', 1) > 1:
             world = BatchWorld(self.opt, world)
+        usage = memory_usage()
+        if usage is not None:
+            self.sync['memory'][2 * self.tid] = usage['resident']
+            self.sync['memory'][2 * self.tid + 1] = usage['shared']
         self.sync['threads_sem'].release()
         with world:
             while True:
@@ -1351,6 +1908,8 @@ class HogwildWorld(World):
             # counters
             'epoch_done_ctr': Value('i', 0),  # number of done threads
             'total_parleys': Value('l', 0),  # number of parleys in threads
+            # resident and shared bytes of each thread, once initialized
+            'memory': Array('d', 2 * self.numthreads, lock=False),
         }
 
         self.threads: List[HogwildProcess] = []
@@ -1367,6 +1926,20 @@ class HogwildWorld(World):
             self.sync['threads_sem'].acquire()  # type: ignore
 
         print(f'[ {self.numthreads} threads initialized ]')
+        self._report_memory()
+
+    def _report_memory(self):
+        """
+        Print the resident and shared memory of each thread.
+        """
+        memory = self.sync['memory']
+        for tid in range(self.numthreads):
+            resident, shared = memory[2 * tid], memory[2 * tid + 1]
+            if resident > 0:
+                print(
+                    f'[ thread {tid}: {resident / 2 ** 20:.1f} MB resident, '
+                    f'{shared / 2 ** 20:.1f} MB shared ]'
+                )
 
     def display(self):
         """
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compile task data into the memory-mapped format used by ``--compiled-data``.
+
+Data is otherwise compiled automatically the first time it is used with
+``--compiled-data true``; running this script ahead of time also lets you store
+the token ids of every text field, so agents using the same dictionary do not
+need to tokenize the dialogue again at train time.
+
+Examples
+--------
+
+.. code-block:: shell
+
+  python compile_data.py -t convai2 -dt train --dict-file /tmp/model.dict
+"""
+
+from parlai.core.params import ParlaiParser
+from parlai.core.dict import DictionaryAgent
+from parlai.core.teachers import (
+    DialogTeacher,
+    MultiTaskTeacher,
+    create_task_agent_from_taskname,
+)
+
+import copy
+
+
+def setup_args(parser=None):
+    if parser is None:
+        parser = ParlaiParser(True, False, 'Compile task data for fast loading')
+    DictionaryAgent.add_cmdline_args(parser)
+    parser.set_defaults(datatype='train')
+    return parser
+
+
+def _flatten_teachers(teachers):
+    for teacher in teachers:
+        if isinstance(teacher, MultiTaskTeacher):
+            yield from _flatten_teachers(teacher.tasks)
+        else:
+            yield teacher
+
+
+def compile_data(opt):
+    opt = copy.deepcopy(opt)
+    # create the teachers in streaming mode so the data is not loaded twice
+    if 'stream' not in opt['datatype']:
+        opt['datatype'] = opt['datatype'] + ':stream'
+    opt['compiled_data'] = False
+
+    dict_agent = DictionaryAgent(opt) if opt.get('dict_file') else None
+
+    paths = []
+    for teacher in _flatten_teachers(create_task_agent_from_taskname(opt)):
+        if not isinstance(teacher, DialogTeacher):
+            print(
+                '[ skipping {}: only DialogTeachers can be compiled ]'.format(
+                    teacher.getID()
+                )
+            )
+            continue
+        paths.append(teacher.compile_data(dict_agent))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = setup_args()
+    compile_data(parser.parse_args())
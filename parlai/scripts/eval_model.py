@@ -15,18 +15,29 @@ Examples
 
   python eval_model.py -t "babi:Task1k:2" -m "repeat_label"
   python eval_model.py -t "#CornellMovie" -m "ir_baseline" -mp "-lp 0.5"
+  python eval_model.py -t convai2 -mf zoo:blender/blender_90M/model --num-eval-workers 16
 """
 
 from parlai.core.params import ParlaiParser, print_announcements
-from parlai.core.agents import create_agent
+from parlai.core.agents import create_agent, create_agent_from_shared
 from parlai.core.logs import TensorboardLogger
-from parlai.core.metrics import aggregate_named_reports
+from parlai.core.metrics import (
+    Metric,
+    aggregate_named_reports,
+    aggregate_unnamed_reports,
+)
 from parlai.core.worlds import create_task
 from parlai.utils.misc import TimeLogger, nice_report
 from parlai.utils.world_logging import WorldLogger
 
 import json
+import multiprocessing
+import multiprocessing.connection
+import os
 import random
+import shutil
+import tempfile
+import traceback
 
 
 def setup_args(parser=None):
@@ -52,6 +63,16 @@ def setup_args(parser=None):
     parser.add_argument('-ne', '--num-examples', type=int, default=-1)
     parser.add_argument('-d', '--display-examples', type='bool', default=False)
     parser.add_argument('-ltim', '--log-every-n-secs', type=float, default=2)
+    parser.add_argument(
+        '--num-eval-workers',
+        type=int,
+        default=1,
+        help='Split the episodes of each task between this many worker processes, '
+        'each loading its own copy of the agent. Reports and world logs are '
+        'merged in episode order. Only for agents on CPU, and teachers whose '
+        'episodes can be accessed by index; falls back to a single process '
+        'otherwise.',
+    )
     parser.add_argument(
         '-mcs',
         '--metrics',
@@ -75,28 +96,20 @@ def _save_eval_stats(opt, report):
     if report_fname.startswith('.'):
         report_fname = opt['model_file'] + report_fname
 
+    report = {k: v.value() if isinstance(v, Metric) else v for k, v in report.items()}
     # Save report
     with open(report_fname, 'w') as f:
         print(f'[ Saving model report to {report_fname} ... ]')
         json.dump({'opt': opt, 'report': report}, f, indent=4)
 
 
-def _eval_single_world(opt, agent, task):
-    print(
-        '[ Evaluating task {} using datatype {}. ] '.format(
-            task, opt.get('datatype', 'N/A')
-        )
-    )
-    # set up world logger
-    world_logger = WorldLogger(opt) if opt['save_world_logs'] else None
-
-    task_opt = opt.copy()  # copy opt since we're editing the task
-    task_opt['task'] = task
-    world = create_task(task_opt, agent)  # create worlds for tasks
-
+def _run_world(opt, world, world_logger=None, log_progress=True):
+    """
+    Run the world through its epoch, and return its report.
+    """
     # set up logging
     log_every_n_secs = opt.get('log_every_n_secs', -1)
-    if log_every_n_secs <= 0:
+    if log_every_n_secs <= 0 or not log_progress:
         log_every_n_secs = float('inf')
     log_time = TimeLogger()
 
@@ -121,14 +134,172 @@ def _eval_single_world(opt, agent, task):
 
     report = world.report()
     world.reset()
-
     if world_logger is not None:
-        # dump world acts to file
         world_logger.reset()  # add final acts to logs
+    return report
+
+
+def _eval_shard(opt, shared, task, shard, num_threads, log_file, conn):
+    """
+    Evaluate one shard of the episodes of a task, in a spawned worker process.
+
+    The worker evaluates a copy of the agent shared by the parent process, which
+    uses the parent's weights in place. Streams the world logs to ``log_file``, if
+    not None, and sends the shard's report through ``conn``, or None if the task
+    can't be sharded and another worker evaluates it whole.
+    """
+    try:
+        import torch
+
+        # don't let every worker use every core
+        torch.set_num_threads(num_threads)
+        random.seed(42)
+        agent = create_agent_from_shared(shared)
+        task_opt = opt.copy()
+        task_opt['task'] = task
+        task_opt['eval_worker'] = shard
+        world = create_task(task_opt, agent)
+        teacher = world.get_task_agent()
+        if not getattr(teacher, 'can_shard_episodes', lambda: False)():
+            if shard > 0:
+                conn.send(None)
+                return
+            print(f'[ task {task} cannot be sharded, evaluating in one worker ]')
+        world_logger = None
+        if log_file is not None:
+            # plain text, put back together by the parent process
+            log_opt = opt.copy()
+            log_opt['log_compression'] = 'none'
+            log_opt['log_rotate_mb'] = -1
+            world_logger = WorldLogger(log_opt, outfile=log_file)
+        report = _run_world(opt, world, world_logger, log_progress=shard == 0)
+        if world_logger is not None:
+            world_logger.close()
+        conn.send(report)
+    except BaseException:
+        conn.send(RuntimeError(traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _eval_sharded_world(opt, agent, task, world_logger=None):
+    """
+    Evaluate a task with ``--num-eval-workers`` worker processes.
+
+    Workers are spawned rather than forked, as the parent holds data loader and
+    torch threads which a forked child could find in an inconsistent state. The
+    model is moved to shared memory, and each worker gets a copy of the agent
+    which attaches to it, so the weights are only held once.
+
+    The world logs of the shards are written to ``world_logger`` in shard order,
+    so in the same order as a single process would log them.
+
+    :return:
+        the sum of the reports of the shards.
+    """
+    import torch
+
+    num_workers = opt['num_eval_workers']
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    log_dir = tempfile.mkdtemp() if world_logger is not None else None
+    log_files = [
+        os.path.join(log_dir, f'shard{shard}') if log_dir else None
+        for shard in range(num_workers)
+    ]
+    model = getattr(agent, 'model', None)
+    if isinstance(model, torch.nn.Module):
+        model.share_memory()
+    shared = agent.share()
+    # pickles tensors as handles to their shared memory
+    ctx = torch.multiprocessing.get_context('spawn')
+    pipes = [ctx.Pipe(duplex=False) for _ in range(num_workers)]
+    processes = [
+        ctx.Process(
+            target=_eval_shard,
+            args=(
+                opt,
+                shared,
+                task,
+                shard,
+                num_threads,
+                log_files[shard],
+                pipes[shard][1],
+            ),
+            daemon=True,
+        )
+        for shard in range(num_workers)
+    ]
+    try:
+        for p in processes:
+            p.start()
+        # only the workers hold the sending ends now, so that a worker dying
+        # without sending its report shows up as the end of its pipe
+        for _, sender in pipes:
+            sender.close()
+        receivers = {receiver: shard for shard, (receiver, _) in enumerate(pipes)}
+        shard_reports = {}
+        while receivers:
+            for receiver in multiprocessing.connection.wait(list(receivers)):
+                shard = receivers.pop(receiver)
+                try:
+                    shard_reports[shard] = receiver.recv()
+                except EOFError:
+                    raise RuntimeError(
+                        f'Evaluation worker {shard} exited without a report, with '
+                        f'exit code {processes[shard].exitcode}'
+                    )
+        for p in processes:
+            p.join()
+
+        for shard in range(num_workers):
+            if isinstance(shard_reports[shard], Exception):
+                raise shard_reports[shard]
+        reports = []
+        for shard in range(num_workers):
+            if shard_reports[shard] is None:
+                continue
+            reports.append(shard_reports[shard])
+            if world_logger is not None:
+                world_logger.append_file(log_files[shard])
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        if log_dir is not None:
+            shutil.rmtree(log_dir)
+    return aggregate_unnamed_reports(reports)
+
+
+def _eval_single_world(opt, agent, task):
+    print(
+        '[ Evaluating task {} using datatype {}. ] '.format(
+            task, opt.get('datatype', 'N/A')
+        )
+    )
+    # set up world logger, which writes episodes as they finish
+    world_logger = None
+    if opt['save_world_logs']:
         base_outfile = opt['report_filename'].split('.')[0]
         outfile = base_outfile + f'_{task}_replies.jsonl'
-        # world_logger.write_jsonl_format(outfile)
-        world_logger.write_parlai_format(outfile)
+        print(f'[ Saving log to {outfile} in ParlAI format ]')
+        world_logger = WorldLogger(opt, outfile=outfile)
+
+    if (
+        opt.get('num_eval_workers', 1) > 1
+        # keep the same examples as a single process
+        and opt['num_examples'] <= 0
+        # every worker would need its own copy of the model on the GPU
+        and not getattr(agent, 'use_cuda', False)
+    ):
+        report = _eval_sharded_world(opt, agent, task, world_logger)
+    else:
+        task_opt = opt.copy()  # copy opt since we're editing the task
+        task_opt['task'] = task
+        world = create_task(task_opt, agent)  # create worlds for tasks
+        report = _run_world(opt, world, world_logger)
+
+    if world_logger is not None:
+        world_logger.close()
 
     return report
 
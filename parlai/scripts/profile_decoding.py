@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark incremental decoding with the TransformerDecoder, using random weights.
+
+Compares the tokens per second of the preallocated ``TransformerDecoderCache``
+against the dict-based incremental state, which concatenates the keys and values
+of every layer at each step.
+
+Examples
+--------
+
+.. code-block:: shell
+
+  python profile_decoding.py --batchsize 64 --beam-size 10 --n-layers 6
+"""
+
+from parlai.core.params import ParlaiParser
+from parlai.agents.transformer.modules import (
+    TransformerDecoder,
+    TransformerDecoderCache,
+)
+
+import time
+import torch
+import torch.nn.functional as F
+
+
+def setup_args(parser=None):
+    if parser is None:
+        parser = ParlaiParser(False, False, 'Benchmark transformer decoding')
+    parser.add_argument('-bs', '--batchsize', type=int, default=16)
+    parser.add_argument('--beam-size', type=int, default=5)
+    parser.add_argument('--max-len', type=int, default=64, help='Steps to decode')
+    parser.add_argument('--src-len', type=int, default=64, help='Encoder length')
+    parser.add_argument('--n-layers', type=int, default=2)
+    parser.add_argument('--n-heads', type=int, default=4)
+    parser.add_argument('--embedding-size', type=int, default=256)
+    parser.add_argument('--ffn-size', type=int, default=1024)
+    parser.add_argument('--vocab-size', type=int, default=8000)
+    parser.add_argument('--num-trials', type=int, default=3)
+    parser.add_argument('--no-cuda', type='bool', default=False)
+    return parser
+
+
+def _decode(decoder, encoder_state, opt, use_cache):
+    batchsize, beam_size = opt['batchsize'], opt['beam_size']
+    bsz = batchsize * beam_size
+    device = encoder_state[0].device
+    beam_starts = torch.arange(batchsize, device=device) * beam_size
+    beam_starts = beam_starts.unsqueeze(1).repeat(1, beam_size).view(-1)
+
+    tokens = torch.ones(bsz, 1, dtype=torch.long, device=device)
+    incr_state = None
+    for _ in range(opt['max_len']):
+        output, incr_state = decoder(tokens, encoder_state, incr_state)
+        scores = F.linear(output[:, -1], decoder.embeddings.weight)
+        next_tokens = scores.argmax(dim=-1)
+        # reorder the hypotheses within each beam, as beam search would
+        inds = beam_starts + torch.randint(0, beam_size, (bsz,), device=device)
+        if use_cache:
+            if not isinstance(incr_state, TransformerDecoderCache):
+                incr_state = TransformerDecoderCache.from_incr_state(incr_state)
+            incr_state = incr_state.reorder(inds)
+        else:
+            incr_state = {
+                idx: layer.reorder_incremental_state(incr_state[idx], inds)
+                for idx, layer in enumerate(decoder.layers)
+            }
+        tokens = torch.cat([tokens[inds], next_tokens[inds].unsqueeze(1)], dim=1)
+
+
+def profile_decoding(opt):
+    use_cuda = not opt['no_cuda'] and torch.cuda.is_available()
+    device = 'cuda' if use_cuda else 'cpu'
+    decoder = TransformerDecoder(
+        n_heads=opt['n_heads'],
+        n_layers=opt['n_layers'],
+        embedding_size=opt['embedding_size'],
+        ffn_size=opt['ffn_size'],
+        vocabulary_size=opt['vocab_size'],
+        embedding=torch.nn.Embedding(opt['vocab_size'], opt['embedding_size']),
+        # positional embeddings don't matter for speed
+        learn_positional_embeddings=True,
+        n_positions=max(1024, opt['max_len'] + 1),
+    )
+    decoder = decoder.to(device).eval()
+
+    bsz = opt['batchsize'] * opt['beam_size']
+    encoder_output = torch.randn(
+        bsz, opt['src_len'], opt['embedding_size'], device=device
+    )
+    encoder_mask = torch.ones(bsz, opt['src_len'], dtype=torch.bool, device=device)
+    encoder_state = (encoder_output, encoder_mask)
+
+    results = {}
+    with torch.no_grad():
+        for name, use_cache in (('dict', False), ('cache', True)):
+            best = None
+            for _ in range(opt['num_trials']):
+                start = time.time()
+                _decode(decoder, encoder_state, opt, use_cache)
+                if use_cuda:
+                    torch.cuda.synchronize()
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = bsz * opt['max_len'] / best
+            print(f'{name:>6}: {results[name]:10.1f} tokens/sec')
+    print(f'speedup: {results["cache"] / results["dict"]:.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    profile_decoding(setup_args().parse_args(print_args=False))
@@ -8,10 +8,12 @@ Allows a model to self-chat on a given task.
 """
 from parlai.core.params import ParlaiParser
 from parlai.core.agents import create_agent
-from parlai.core.worlds import create_task
+from parlai.core.worlds import create_task, BatchWorld
+from parlai.tasks.self_chat.worlds import ContinuousSelfChatWorld, SelfChatBaseWorld
 from parlai.utils.world_logging import WorldLogger
 from parlai.utils.misc import TimeLogger
 
+import copy
 import random
 
 
@@ -72,7 +74,17 @@ def self_chat(opt, print_parser=None):
     if hasattr(agent2, 'id'):
         agent2.id = agent2.id + "2"
 
-    world = create_task(opt, [agent1, agent2])
+    # with a batchsize, self chat worlds run a pool of conversations out of step,
+    # instead of a batch of conversations waiting for each other
+    world_opt = copy.deepcopy(opt)
+    world_opt['batchsize'] = 1
+    world = create_task(world_opt, [agent1, agent2])
+    if opt.get('batchsize', 1) > 1:
+        if isinstance(world, SelfChatBaseWorld):
+            world = ContinuousSelfChatWorld(opt, world)
+        else:
+            world = BatchWorld(opt, world)
+    continuous = isinstance(world, ContinuousSelfChatWorld)
 
     if print_parser:
         # Show arguments after loading model
@@ -84,18 +96,26 @@ def self_chat(opt, print_parser=None):
     if log_every_n_secs <= 0:
         log_every_n_secs = float('inf')
     log_time = TimeLogger()
-    logger = WorldLogger(opt)
+    file_format = 'jsonl' if opt['format'] == 'json' else 'parlai'
+    logger = WorldLogger(opt, outfile=opt['outfile'], file_format=file_format)
 
     # Run some self chats.
     max_cnt = opt['num_examples']
     cnt = 0
     while cnt < max_cnt:
-        cnt += opt.get('batchsize', 1)
         world.parley()
-        logger.log(world)
+        if continuous:
+            cnt = world.total_parleys
+            for episode in world.get_finished_episodes():
+                logger.log_episode(episode)
+        else:
+            cnt += opt.get('batchsize', 1)
+            logger.log(world)
 
         if opt.get('display_examples'):
-            print(world.display())
+            display = world.display()
+            if display:
+                print(display)
         if log_time.time() > log_every_n_secs:
             text = log_time.log(cnt, max_cnt)
             print(text)
@@ -103,7 +123,10 @@ def self_chat(opt, print_parser=None):
     if opt.get('display_examples'):
         print('-- end of episode --')
 
-    logger.write(opt['outfile'], opt['format'])
+    if continuous:
+        for episode in world.get_unfinished_episodes():
+            logger.log_episode(episode)
+    logger.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Serve a model to many concurrent conversations over HTTP.
+
+Unlike ``interactive_web.py``, every conversation gets its own session, with its own
+dialogue history, while all sessions share a single copy of the model. Concurrent
+requests are collected into micro-batches, for up to ``--max-wait-ms`` or until
+``--max-batchsize`` requests are pending, and answered with a single ``batch_act``.
+
+Endpoints (all responses are JSON):
+
+- ``POST /interact`` with ``{"session_id": ..., "text": ...}``. The ``session_id`` is
+  optional; a new session is created if it is missing or unknown, and its id is
+  returned with the reply. Set ``"episode_done": true`` to end the conversation
+  after this reply.
+- ``POST /reset`` with ``{"session_id": ...}`` clears the history of a session.
+- ``GET /health`` reports the number of open sessions and pending requests.
+- ``GET /stats`` reports latency percentiles and batch sizes.
+
+Examples
+--------
+
+.. code-block:: shell
+
+  python serve_model.py -mf zoo:blender/blender_90M/model --port 8080
+  curl -d '{"session_id": "alice", "text": "hello!"}' localhost:8080/interact
+"""
+
+from collections import deque, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import queue
+import threading
+import time
+import uuid
+
+from parlai.core.agents import create_agent, create_agent_from_shared
+from parlai.core.message import Message
+from parlai.core.params import ParlaiParser
+
+
+def setup_args(parser=None):
+    if parser is None:
+        parser = ParlaiParser(True, True, 'Serve a model over HTTP')
+    serving = parser.add_argument_group('Model Serving')
+    serving.add_argument('--host', type=str, default='localhost')
+    serving.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    serving.add_argument(
+        '--max-batchsize',
+        type=int,
+        default=32,
+        help='Maximum number of requests answered together.',
+    )
+    serving.add_argument(
+        '--max-wait-ms',
+        type=float,
+        default=10,
+        help='Maximum time a request waits for others to fill its batch.',
+    )
+    serving.add_argument(
+        '--max-sessions',
+        type=int,
+        default=1000,
+        help='Maximum number of open sessions. The least recently used session '
+        'is closed when this is exceeded.',
+    )
+    serving.add_argument(
+        '--session-timeout',
+        type=float,
+        default=3600,
+        help='Close sessions idle for this many seconds. Disabled if <= 0.',
+    )
+    parser.set_defaults(interactive_mode=True)
+    return parser
+
+
+class SessionManager(object):
+    """
+    Keep a clone of the model agent, and so a dialogue history, for each session.
+
+    Clones are created from the shared parameters of the model agent, so they share
+    its weights. Sessions are closed when idle for ``timeout`` seconds, or when more
+    than ``max_sessions`` are open, least recently used first.
+    """
+
+    def __init__(self, agent, max_sessions=1000, timeout=3600):
+        self.shared = agent.share()
+        self.max_sessions = max_sessions
+        self.timeout = timeout
+        self._sessions = OrderedDict()
+        self._last_used = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id):
+        """
+        Return the agent of the session, creating it if needed.
+        """
+        now = time.time()
+        if session_id in self._sessions:
+            self._sessions.move_to_end(session_id)
+        else:
+            self._sessions[session_id] = create_agent_from_shared(self.shared)
+        self._last_used[session_id] = now
+        self._evict(now)
+        return self._sessions[session_id]
+
+    def reset(self, session_id):
+        if session_id in self._sessions:
+            self._sessions[session_id].reset()
+
+    def _evict(self, now):
+        while len(self._sessions) > self.max_sessions:
+            self._close(next(iter(self._sessions)))
+        if self.timeout > 0:
+            # sessions are ordered by last use, so stop at the first active one
+            for session_id in list(self._sessions):
+                if now - self._last_used[session_id] < self.timeout:
+                    break
+                self._close(session_id)
+
+    def _close(self, session_id):
+        del self._sessions[session_id]
+        del self._last_used[session_id]
+
+
+class LatencyTracker(object):
+    """
+    Thread-safe record of the latencies of the most recent requests.
+    """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batchsizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def add_batch(self, latencies):
+        with self._lock:
+            self._latencies.extend(latencies)
+            self._batchsizes.append(len(latencies))
+            self.num_requests += len(latencies)
+            self.num_batches += 1
+
+    def report(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            batchsizes = list(self._batchsizes)
+            report = {
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+            }
+        if batchsizes:
+            report['mean_batchsize'] = sum(batchsizes) / len(batchsizes)
+        for pct in (50, 90, 99):
+            if latencies:
+                idx = min(len(latencies) - 1, int(len(latencies) * pct / 100))
+                report['latency_p{}_ms'.format(pct)] = 1000 * latencies[idx]
+        return report
+
+
+class _Request(object):
+    """
+    A pending request, answered by the batching thread.
+    """
+
+    def __init__(self, session_id, message=None):
+        self.session_id = session_id
+        # None for a reset
+        self.message = message
+        self.reply = None
+        self.error = None
+        self.start_time = time.time()
+        self._done = threading.Event()
+
+    def finish(self, reply=None, error=None):
+        self.reply = reply
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+
+class RequestBatcher(object):
+    """
+    Collect concurrent requests into micro-batches for the model.
+
+    A single thread owns the model and the sessions: it waits for a first request,
+    then for up to ``max_wait`` seconds for more, and answers them all with one
+    ``batch_act``. Two messages of the same session are never in the same batch, so
+    each conversation sees its messages in order.
+    """
+
+    def __init__(self, agent, sessions, max_batchsize=32, max_wait=0.01):
+        self.agent = agent
+        self.sessions = sessions
+        self.max_batchsize = max_batchsize
+        self.max_wait = max_wait
+        self.latency = LatencyTracker()
+        self._queue = queue.Queue()
+        self._deferred = deque()
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, session_id, message=None):
+        """
+        Queue a message (or a reset if None) for the session and wait for the reply.
+        """
+        request = _Request(session_id, message)
+        self._queue.put(request)
+        return request.wait()
+
+    def pending(self):
+        return self._queue.qsize() + len(self._deferred)
+
+    def shutdown(self):
+        self._shutdown = True
+        self._thread.join()
+
+    def _next_request(self, timeout):
+        if self._deferred:
+            return self._deferred.popleft()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _next_batch(self):
+        first = self._next_request(timeout=0.1)
+        if first is None:
+            return []
+        batch = [first]
+        session_ids = {first.session_id}
+        deferred = []
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batchsize:
+            request = self._next_request(timeout=max(0, deadline - time.time()))
+            if request is None:
+                break
+            if request.session_id in session_ids:
+                # answer it after the earlier message of its session
+                deferred.append(request)
+            else:
+                batch.append(request)
+                session_ids.add(request.session_id)
+        self._deferred.extendleft(reversed(deferred))
+        return batch
+
+    def _run(self):
+        while not self._shutdown:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._process(batch)
+                except Exception as e:
+                    for request in batch:
+                        if not request._done.is_set():
+                            request.finish(error=e)
+
+    def _process(self, batch):
+        interacts = []
+        for request in batch:
+            if request.message is None:
+                self.sessions.reset(request.session_id)
+                request.finish(reply={})
+            else:
+                interacts.append(request)
+        if not interacts:
+            return
+
+        agents = [self.sessions.get(r.session_id) for r in interacts]
+        observations = [a.observe(r.message) for a, r in zip(agents, interacts)]
+        if hasattr(self.agent, 'batch_act'):
+            replies = self.agent.batch_act(observations)
+            for agent, reply in zip(agents, replies):
+                if hasattr(agent, 'self_observe'):
+                    agent.self_observe(reply)
+        else:
+            replies = [agent.act() for agent in agents]
+
+        now = time.time()
+        for request, reply in zip(interacts, replies):
+            request.finish(reply=reply)
+        self.latency.add_batch([now - r.start_time for r in interacts])
+
+
+def _jsonable_reply(reply):
+    """
+    Keep the fields of a reply which can be sent as JSON.
+    """
+    result = {}
+    for key, value in reply.items():
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        result[key] = value
+    return result
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # accept bursts of connections from many concurrent conversations
+    request_queue_size = 1024
+
+
+class ServingHandler(BaseHTTPRequestHandler):
+    """
+    Handle HTTP requests, waiting on the batcher of the server.
+    """
+
+    def log_message(self, format, *args):
+        # don't print a line for every request
+        pass
+
+    def _send_json(self, data, status=200):
+        content = bytes(json.dumps(data), 'utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_json(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length).decode('utf-8')
+        return json.loads(body) if body else {}
+
+    def do_POST(self):
+        """
+        Handle POST requests to /interact and /reset.
+        """
+        batcher = self.server.batcher
+        try:
+            data = self._read_json()
+        except ValueError:
+            return self._send_json({'error': 'invalid JSON'}, status=400)
+
+        if self.path == '/interact':
+            if 'text' not in data:
+                return self._send_json({'error': 'missing "text"'}, status=400)
+            session_id = str(data.get('session_id') or uuid.uuid4().hex)
+            message = Message(
+                {
+                    'id': 'user',
+                    'text': data['text'],
+                    'episode_done': bool(data.get('episode_done', False)),
+                }
+            )
+            try:
+                reply = batcher.submit(session_id, message)
+            except Exception as e:
+                return self._send_json({'error': repr(e)}, status=500)
+            response = _jsonable_reply(reply)
+            response['session_id'] = session_id
+            self._send_json(response)
+        elif self.path == '/reset':
+            if 'session_id' not in data:
+                return self._send_json({'error': 'missing "session_id"'}, status=400)
+            batcher.submit(str(data['session_id']))
+            self._send_json({'session_id': str(data['session_id'])})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_GET(self):
+        """
+        Handle GET requests to /health and /stats.
+        """
+        batcher = self.server.batcher
+        if self.path == '/health':
+            self._send_json(
+                {
+                    'status': 'ok',
+                    'sessions': len(batcher.sessions),
+                    'pending': batcher.pending(),
+                }
+            )
+        elif self.path == '/stats':
+            self._send_json(batcher.latency.report())
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+
+def build_server(opt, agent=None):
+    """
+    Build the HTTP server, without starting it.
+
+    :param opt:
+        options from setup_args()
+    :param agent:
+        the model agent. Created from opt if not given.
+
+    :return:
+        the server, whose ``batcher`` answers the requests.
+    """
+    if agent is None:
+        agent = create_agent(opt, requireModelExists=True)
+    sessions = SessionManager(
+        agent, max_sessions=opt['max_sessions'], timeout=opt['session_timeout']
+    )
+    httpd = ThreadedHTTPServer((opt['host'], opt['port']), ServingHandler)
+    httpd.batcher = RequestBatcher(
+        agent,
+        sessions,
+        max_batchsize=opt['max_batchsize'],
+        max_wait=opt['max_wait_ms'] / 1000,
+    )
+    return httpd
+
+
+def serve_model(opt):
+    httpd = build_server(opt)
+    host, port = httpd.server_address[:2]
+    print('[ serving on http://{}:{}/ ]'.format(host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.batcher.shutdown()
+    httpd.server_close()
+
+
+if __name__ == '__main__':
+    serve_model(setup_args().parse_args())
@@ -24,10 +24,15 @@ Examples
 # TODO List:
 # * More logging (e.g. to files), make things prettier.
 
+from collections import deque
+import glob
 import json
+import multiprocessing
 import numpy as np
 import os
+import shutil
 import signal
+import tempfile
 
 from parlai.core.metrics import Metric
 from parlai.core.agents import create_agent, create_agent_from_shared
@@ -107,6 +112,25 @@ def setup_args(parser=None) -> ParlaiParser:
         help='Validate every n epochs. Saves model to model_file '
         '(if set) whenever best val metric is found',
     )
+    train.add_argument(
+        '--async-validation',
+        type='bool',
+        default=False,
+        hidden=True,
+        help='Validate a snapshot of the model in background processes, so that '
+        'training continues during validation. Results are used for model '
+        'selection and patience as they arrive, in order. Falls back to '
+        'synchronous validation if the model cannot be saved, or in '
+        'distributed training.',
+    )
+    train.add_argument(
+        '--async-validation-workers',
+        type=int,
+        default=1,
+        hidden=True,
+        help='Number of background validations allowed to run at once. Training '
+        'waits for the oldest one when more are pending.',
+    )
     train.add_argument(
         '-vme',
         '--validation-max-exs',
@@ -298,6 +322,21 @@ def run_eval(valid_worlds, opt, datatype, max_exs=-1, write_log=False):
     return sync_object(report)
 
 
+def _run_async_eval(opt, snapshot):
+    """
+    Validate the model snapshot saved at ``snapshot``, in a background process.
+    """
+    opt = opt.copy()
+    opt['model_file'] = snapshot
+    opt['init_model'] = None
+    agent = create_agent(opt, requireModelExists=True)
+    valid_worlds = load_eval_worlds(agent, opt, 'valid')
+    report = run_eval(valid_worlds, opt, 'valid', opt['validation_max_exs'])
+    for valid_world in valid_worlds:
+        valid_world.shutdown()
+    return report
+
+
 class TrainLoop:
     """
     TrainLoop contains the core training loop logic.
@@ -383,6 +422,13 @@ class TrainLoop:
         self.valid_worlds = None
         self.opt = opt
 
+        # background validations, pending in launch order
+        self._async_pool = None
+        self._snapshot_dir = None
+        self._num_snapshots = 0
+        self._pending_valids = deque()
+        self._async_stop = False
+
         # we may have been preempted, make sure we note that amount
         self._preempted_epochs = 0.0
         if opt.get('model_file') and os.path.isfile(
@@ -435,6 +481,17 @@ class TrainLoop:
             except KeyboardInterrupt:
                 pass
 
+    def _wait_for_save(self):
+        """
+        Wait until the agent has written its last saved model to disk.
+
+        Agents saving with ``--save-async`` write in the background, so their files
+        must not be read back before this returns.
+        """
+        wait_for_save = getattr(self.agent, 'wait_for_save', None)
+        if wait_for_save is not None:
+            wait_for_save()
+
     def _safe_report(self, report):
         return {k: v.value() if isinstance(v, Metric) else v for k, v in report.items()}
 
@@ -463,11 +520,19 @@ class TrainLoop:
         """
         Perform a validation run, checking whether we should stop training.
 
+        With ``--async-validation``, only launches the validation of a snapshot of
+        the model, whose results are processed later by
+        ``_collect_async_validations()``.
+
         :return: boolean indicating whether training should stop
         :rtype: bool
         """
         opt = self.opt
 
+        if opt.get('async_validation') and not is_distributed():
+            if self._launch_async_validation():
+                return False
+
         if self.valid_worlds is None:
             # we need to load the world now
             self.valid_worlds = load_eval_worlds(self.agent, opt, 'valid')
@@ -478,14 +543,6 @@ class TrainLoop:
         valid_report = run_eval(
             self.valid_worlds, opt, 'valid', opt['validation_max_exs']
         )
-        v = valid_report.copy()
-        v['train_time'] = self.train_time.time()
-        self.valid_reports.append(v)
-        # logging
-        if opt['tensorboard_log'] and is_primary_worker():
-            self.tb_logger.log_metrics('valid', self.parleys, valid_report)
-            # flush on a validation
-            self.tb_logger.flush()
         # saving
         if (
             opt.get('model_file')
@@ -494,6 +551,36 @@ class TrainLoop:
         ):
             print("[ saving model checkpoint: " + opt['model_file'] + ".checkpoint ]")
             self.save_model('.checkpoint')
+        self.validate_time.reset()
+        return self._process_valid_report(
+            valid_report, self.parleys, self.train_time.time()
+        )
+
+    def _process_valid_report(self, valid_report, parleys, train_time, snapshot=None):
+        """
+        Log a validation report, and update the best model and patience.
+
+        :param valid_report:
+            the report of the validation.
+        :param parleys:
+            the number of parleys when the validated model was taken.
+        :param train_time:
+            the training time when the validated model was taken.
+        :param snapshot:
+            path of the validated model snapshot, saved as the best model if it
+            beats the previous best. If None, the current agent is saved instead.
+
+        :return: boolean indicating whether training should stop
+        """
+        opt = self.opt
+        v = valid_report.copy()
+        v['train_time'] = train_time
+        self.valid_reports.append(v)
+        # logging
+        if opt['tensorboard_log'] and is_primary_worker():
+            self.tb_logger.log_metrics('valid', parleys, valid_report)
+            # flush on a validation
+            self.tb_logger.flush()
 
         # send valid metrics to agent if the agent wants them
         if hasattr(self.agent, 'receive_metrics'):
@@ -523,7 +610,10 @@ class TrainLoop:
             self.impatience = 0
             if opt.get('model_file') and is_primary_worker():
                 print("[ saving best valid model: " + opt['model_file'] + " ]")
-                self.save_model()
+                if snapshot is None:
+                    self.save_model()
+                else:
+                    self._save_snapshot_as_model(snapshot)
                 self.saved = True
             if (
                 opt['validation_metric'] == 'accuracy'
@@ -538,7 +628,6 @@ class TrainLoop:
                     opt['validation_metric'], round(self.best_valid, 4), self.impatience
                 )
             )
-        self.validate_time.reset()
 
         # check if we are out of patience
         if (
@@ -549,6 +638,99 @@ class TrainLoop:
             return True
         return False
 
+    def _launch_async_validation(self):
+        """
+        Snapshot the model and validate it in a background process.
+
+        :return:
+            False if the agent could not be saved as a snapshot, in which case the
+            caller should validate synchronously.
+        """
+        opt = self.opt
+        if self._async_pool is None:
+            self._snapshot_dir = tempfile.mkdtemp(prefix='parlai_valid_')
+            # spawn rather than fork, so the workers don't inherit the trainer's
+            # CUDA context and threads
+            self._async_pool = multiprocessing.get_context('spawn').Pool(
+                opt['async_validation_workers']
+            )
+
+        # bound the number of pending snapshots: wait for the oldest validation
+        while len(self._pending_valids) >= opt['async_validation_workers']:
+            self._pending_valids[0][0].wait()
+            self._collect_async_validations()
+
+        # each snapshot has its own directory, so that globbing the files of one
+        # never matches those of another
+        snapshot_dir = os.path.join(self._snapshot_dir, str(self._num_snapshots))
+        os.makedirs(snapshot_dir)
+        snapshot = os.path.join(snapshot_dir, 'model')
+        self._num_snapshots += 1
+        self.agent.save(snapshot)
+        self._wait_for_save()
+        if not os.path.isfile(snapshot):
+            print('[ agent cannot be saved, validating synchronously ]')
+            self.opt['async_validation'] = False
+            return False
+
+        if opt.get('model_file') and opt.get('save_after_valid'):
+            print("[ saving model checkpoint: " + opt['model_file'] + ".checkpoint ]")
+            self.save_model('.checkpoint')
+
+        print('[ launching validation in the background ]')
+        result = self._async_pool.apply_async(_run_async_eval, (opt, snapshot))
+        self._pending_valids.append(
+            (result, snapshot, self.parleys, self.train_time.time())
+        )
+        self.validate_time.reset()
+        return True
+
+    def _collect_async_validations(self, block=False):
+        """
+        Process the reports of finished background validations, in launch order.
+
+        Results are never processed out of order, so that patience and model
+        selection see the same sequence of reports as synchronous validation.
+
+        :param block:
+            wait for all pending validations to finish.
+        """
+        while self._pending_valids and (block or self._pending_valids[0][0].ready()):
+            result, snapshot, parleys, train_time = self._pending_valids.popleft()
+            # re-raises any exception of the background validation
+            valid_report = result.get()
+            if self._process_valid_report(valid_report, parleys, train_time, snapshot):
+                self._async_stop = True
+            shutil.rmtree(os.path.dirname(snapshot), ignore_errors=True)
+
+    def _finish_async_validations(self):
+        """
+        Wait for all background validations, then stop the workers.
+        """
+        if self._async_pool is None:
+            return
+        self._collect_async_validations(block=True)
+        self._async_pool.close()
+        self._async_pool.join()
+        self._async_pool = None
+        shutil.rmtree(self._snapshot_dir, ignore_errors=True)
+
+    def _save_snapshot_as_model(self, snapshot):
+        """
+        Copy the files of a model snapshot to the model file.
+        """
+        fn = self.opt['model_file']
+        for path in glob.glob(snapshot + '*'):
+            suffix = path[len(snapshot) :]
+            while True:
+                # don't ever let a ctrl-c interrupt saving
+                try:
+                    shutil.copyfile(path, fn + suffix)
+                    break
+                except KeyboardInterrupt:
+                    pass
+        self._save_train_stats()
+
     def _sync_metrics(self, metrics):
         """
         Sync training metrics across workers.
@@ -649,6 +831,11 @@ class TrainLoop:
                 exs_per_epoch = self.world.num_examples()
                 self._total_exs = int(np.round(self._total_epochs * exs_per_epoch))
 
+                if self._pending_valids:
+                    self._collect_async_validations()
+                    if self._async_stop:
+                        break
+
                 # and use the primary worker's timings for everything
                 train_time, log_time, validate_time = sync_object(
                     (
@@ -702,11 +889,16 @@ class TrainLoop:
                     self.save_model('.checkpoint')
                     self.save_time.reset()
 
+        # the remaining background validations may still find a new best model
+        self._finish_async_validations()
+
         if not self.saved and is_primary_worker():
             # save agent
             self.save_model()
+            self._wait_for_save()
         elif opt.get('model_file'):
             # reload best validation model
+            self._wait_for_save()
             self.agent = create_agent(opt)
 
         valid_worlds = load_eval_worlds(self.agent, opt, 'valid')
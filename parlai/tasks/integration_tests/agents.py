@@ -383,6 +383,26 @@ class MultiturnNocandidateTeacher(MultiturnCandidateTeacher):
             yield (t, a), e
 
 
+class MultiturnVariableLengthTeacher(VariableLengthTeacher):
+    """
+    Splits the variable length inputs/targets by spaces into multiple turns.
+
+    Episodes have different lengths, which is good for testing that episodes
+    finishing out of order are kept in order.
+    """
+
+    def setup_data(self, fold):
+        raw = super().setup_data(fold)
+        for (t, a, _r, _c), _e in raw:
+            split_t = t.split(' ')
+            split_a = a[0].split(' ')
+            for i in range(len(split_t)):
+                yield (split_t[i], [' '.join(split_a[: i + 1])]), i == 0
+
+    def num_examples(self):
+        return DialogTeacher.num_examples(self)
+
+
 class BadExampleTeacher(CandidateTeacher):
     """
     Teacher which produces a variety of examples that upset verify_data.py.
@@ -9,8 +9,9 @@ import random
 from typing import Any, Dict, List, Optional
 
 from parlai.agents.repeat_label.repeat_label import RepeatLabelAgent
-from parlai.core.agents import Agent
-from parlai.core.worlds import create_task, DialogPartnerWorld, validate
+from parlai.core.agents import Agent, create_agent_from_shared
+from parlai.core.worlds import create_task, DialogPartnerWorld, validate, World
+from parlai.utils.misc import display_messages
 
 
 def load_openers(opt) -> Optional[List[str]]:
@@ -178,3 +179,176 @@ class SelfChatBaseWorld(DialogPartnerWorld):
 
 class InteractiveWorld(SelfChatBaseWorld):
     pass
+
+
+class _SelfChatSlot(object):
+    """
+    One of the conversations in flight in a ``ContinuousSelfChatWorld``.
+    """
+
+    def __init__(self, agents: List[Agent]):
+        # copies of the two agents, only used by this slot
+        self.agents = agents
+        self.done = True
+
+    def start(self, order: List[int]):
+        for a in self.agents:
+            a.reset()
+        # order[i] is the agent speaking at position i of every parley
+        self.order = order
+        self.agents_ordered = [self.agents[i] for i in order]
+        self.observations: List[Optional[Dict[str, Any]]] = [None, None]
+        self.acts: List[Optional[Dict[str, Any]]] = [None, None]
+        self.seed_utterances: List[Dict[str, Any]] = []
+        self.parleys: List[List[Dict[str, Any]]] = []
+        self.speaker = 0
+        self.done = False
+
+    def speaking_agent(self) -> int:
+        return self.order[self.speaker]
+
+
+class ContinuousSelfChatWorld(World):
+    """
+    Run a pool of self chats at once, batching the turns of all of them.
+
+    Each of the ``--batchsize`` slots holds an independent conversation between
+    copies of the two agents of a ``SelfChatBaseWorld``. Every parley, each agent
+    generates the next message of all the conversations where it is its turn to
+    speak, in a single ``batch_act``. Conversations are out of step: as soon as one
+    ends, its slot starts a new episode, with the contexts and openers of the
+    wrapped world, so that batches stay full.
+
+    Finished episodes are returned by ``get_finished_episodes()``, as lists of
+    parleys, to be logged with ``WorldLogger.log_episode``.
+    """
+
+    def __init__(self, opt, world: SelfChatBaseWorld):
+        super().__init__(opt)
+        self.world = world
+        self.max_turn_cnt = world.max_turn_cnt
+        self.episode_cnt = 0
+        self.slots = [
+            _SelfChatSlot(
+                [create_agent_from_shared(a.share()) for a in world.get_agents()]
+            )
+            for _ in range(opt['batchsize'])
+        ]
+        self._finished: List[List[List[Dict[str, Any]]]] = []
+
+    def get_agents(self):
+        return self.world.get_agents()
+
+    def get_finished_episodes(self) -> List[List[List[Dict[str, Any]]]]:
+        """
+        Return the episodes which ended during the last parley.
+        """
+        return self._finished
+
+    def get_unfinished_episodes(self) -> List[List[List[Dict[str, Any]]]]:
+        """
+        Return the parleys so far of the episodes still in flight.
+        """
+        return [slot.parleys for slot in self.slots if not slot.done]
+
+    def parley(self):
+        self._finished = []
+        self._fill_slots()
+        for agent_idx in range(2):
+            slots = [
+                slot
+                for slot in self.slots
+                if not slot.done and slot.speaking_agent() == agent_idx
+            ]
+            if not slots:
+                continue
+            agent = self.world.get_agents()[agent_idx]
+            if hasattr(agent, 'batch_act'):
+                acts = agent.batch_act(
+                    [slot.observations[slot.speaker] for slot in slots]
+                )
+                for slot, act in zip(slots, acts):
+                    speaker = slot.agents_ordered[slot.speaker]
+                    if hasattr(speaker, 'self_observe'):
+                        speaker.self_observe(act)
+            else:
+                acts = [slot.agents_ordered[slot.speaker].act() for slot in slots]
+            for slot, act in zip(slots, acts):
+                self._add_act(slot, act)
+                self._add_seed_utterances(slot)
+        # refill the slots of the finished episodes right away
+        self._fill_slots()
+
+    def _fill_slots(self):
+        for slot in self.slots:
+            if slot.done:
+                self._start_episode(slot)
+
+    def _start_episode(self, slot: _SelfChatSlot):
+        # choose speaking order
+        slot.start([0, 1] if random.choice([0, 1]) else [1, 0])
+        contexts = self.world.get_contexts(self.episode_cnt)
+        slot.seed_utterances = self.world._get_seed_utt_acts(
+            self.episode_cnt, slot.agents_ordered
+        )
+        self.episode_cnt += 1
+        if contexts:
+            assert len(contexts) == 2
+            for i in range(0, 2):
+                context = {'text': contexts[i], 'episode_done': False, 'id': 'context'}
+                slot.acts[1 - i] = context
+                slot.observations[i] = slot.agents_ordered[i].observe(validate(context))
+            self._end_parley(slot)
+        self._add_seed_utterances(slot)
+
+    def _add_seed_utterances(self, slot: _SelfChatSlot):
+        while slot.seed_utterances and not slot.done:
+            act = slot.seed_utterances.pop(0)
+            speaker = slot.agents_ordered[slot.speaker]
+            if hasattr(speaker, 'self_observe'):
+                speaker.self_observe(act)
+            self._add_act(slot, act)
+
+    def _add_act(self, slot: _SelfChatSlot, act: Dict[str, Any]):
+        """
+        Record the message of the current speaker, and pass it to the other one.
+        """
+        listener = 1 - slot.speaker
+        slot.acts[slot.speaker] = act
+        slot.observations[listener] = slot.agents_ordered[listener].observe(
+            validate(act)
+        )
+        if slot.speaker == 1:
+            self._end_parley(slot)
+        else:
+            slot.speaker = 1
+
+    def _end_parley(self, slot: _SelfChatSlot):
+        slot.parleys.append(slot.acts)
+        slot.acts = [None, None]
+        slot.speaker = 0
+        self.total_parleys += 1
+        if len(slot.parleys) >= self.max_turn_cnt:
+            slot.done = True
+            self._finished.append(slot.parleys)
+
+    def display(self):
+        ignore_fields = self.opt.get('display_ignore_fields', '')
+        s = ''
+        for episode in self._finished:
+            for parley in episode:
+                s += display_messages(parley, ignore_fields=ignore_fields) + '\n'
+            s += '==============================\n'
+        return s
+
+    def epoch_done(self):
+        return False
+
+    def num_examples(self):
+        return self.world.num_examples()
+
+    def num_episodes(self):
+        return self.world.num_episodes()
+
+    def shutdown(self):
+        self.world.shutdown()
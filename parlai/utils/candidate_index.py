@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Nearest-neighbour indexes over fixed candidate encodings.
+
+Rankers which encode their candidates independently of the context (bi-encoders,
+the first stage of poly-encoders, MemNNs) can retrieve their best candidates with
+an inner product search instead of scoring the whole fixed candidate set.
+
+Two backends are provided:
+
+- ``flat`` is exact: it scores every candidate, in chunks, keeping a running top-k
+  so that the full score matrix is never materialized.
+- ``ivf`` is approximate: candidates are clustered with k-means into ``nlist``
+  inverted lists, and only the lists whose centroids best match a query are
+  scored. Probing more lists (``nprobe``) trades latency for recall.
+
+Indexes are saved in two files: ``path`` holds the metadata of the index, while
+``path + '.npy'`` holds the candidate vectors, which are memory-mapped on load.
+"""
+
+import math
+import os
+
+import numpy as np
+import torch
+
+
+class CandidateIndex(object):
+    """
+    Abstract inner-product index over a fixed set of candidate vectors.
+
+    Subclasses implement ``search()``, and may store extra state by overriding
+    ``_get_state()`` and ``_set_state()``.
+    """
+
+    index_type = None
+
+    def __init__(self, vectors):
+        """
+        :param vectors:
+            [num_cands, dim] FloatTensor of candidate encodings.
+        """
+        self.vectors = vectors
+
+    def __len__(self):
+        return self.vectors.size(0)
+
+    @property
+    def dim(self):
+        return self.vectors.size(1)
+
+    def to(self, device=None, dtype=None):
+        """
+        Move the index to the given device and/or dtype.
+        """
+        self.vectors = self.vectors.to(device=device, dtype=dtype)
+        return self
+
+    def search(self, queries, k):
+        """
+        Find the candidates with the highest inner product with each query.
+
+        :param queries:
+            [bsz, dim] FloatTensor of queries.
+        :param k:
+            number of candidates to retrieve. Capped at the size of the index.
+
+        :return: (scores, ids)
+            two [bsz, k] tensors, with the best candidates first. ``ids`` are the
+            indices of the candidates in the original candidate set.
+        """
+        raise NotImplementedError('Abstract method: user must implement search()')
+
+    def get_vectors(self, ids):
+        """
+        Return the vectors of the candidates with the given ids.
+
+        :param ids:
+            LongTensor of candidate ids, of any shape.
+        :return:
+            FloatTensor with an extra trailing dimension of size ``dim``.
+        """
+        return self.vectors[ids.to(self.vectors.device)]
+
+    def _get_state(self):
+        return {}
+
+    def _set_state(self, state, **kwargs):
+        pass
+
+    def save(self, path):
+        """
+        Save the index metadata to ``path`` and its vectors to ``path + '.npy'``.
+        """
+        metadata = {
+            'index_type': self.index_type,
+            'num_cands': len(self),
+            'dim': self.dim,
+            'state': self._get_state(),
+        }
+        with open(path, 'wb') as f:
+            torch.save(metadata, f)
+        np.save(path + '.npy', self.vectors.cpu().numpy())
+
+
+class FlatCandidateIndex(CandidateIndex):
+    """
+    Exact index, scoring every candidate.
+    """
+
+    index_type = 'flat'
+
+    def __init__(self, vectors, chunk_size=65536):
+        super().__init__(vectors)
+        self.chunk_size = chunk_size
+
+    def _set_state(self, state, chunk_size=65536, **kwargs):
+        self.chunk_size = chunk_size
+
+    def search(self, queries, k):
+        k = min(k, len(self))
+        queries = queries.to(self.vectors.device, self.vectors.dtype)
+        best_scores = best_ids = None
+        for start in range(0, len(self), self.chunk_size):
+            chunk = self.vectors[start : start + self.chunk_size]
+            scores = queries.matmul(chunk.t())
+            scores, ids = scores.topk(min(k, scores.size(1)), dim=1)
+            ids += start
+            if best_scores is not None:
+                scores = torch.cat([best_scores, scores], dim=1)
+                ids = torch.cat([best_ids, ids], dim=1)
+                scores, order = scores.topk(k, dim=1)
+                ids = ids.gather(1, order)
+            best_scores, best_ids = scores, ids
+        return best_scores, best_ids
+
+
+class IVFCandidateIndex(CandidateIndex):
+    """
+    Approximate inverted file index.
+
+    Candidates are clustered with k-means, and stored contiguously per cluster. A
+    search scores the queries against the cluster centroids, then scores exactly
+    the candidates of the ``nprobe`` best clusters, probing further clusters if
+    needed to return at least k candidates.
+    """
+
+    index_type = 'ivf'
+
+    def __init__(self, vectors, nlist=-1, nprobe=8, niter=10, seed=0):
+        """
+        :param vectors:
+            [num_cands, dim] FloatTensor of candidate encodings.
+        :param nlist:
+            number of clusters. If <= 0, defaults to 4 * sqrt(num_cands).
+        :param nprobe:
+            number of clusters scored for each query.
+        :param niter:
+            number of k-means iterations.
+        :param seed:
+            seed of the k-means initialization.
+        """
+        num_cands = vectors.size(0)
+        if nlist <= 0:
+            nlist = int(4 * math.sqrt(num_cands))
+        nlist = max(1, min(nlist, num_cands))
+        self.nprobe = nprobe
+
+        self.centroids = self._kmeans(vectors, nlist, niter, seed)
+        assignments = self._assign(vectors, self.centroids)
+        order = torch.sort(assignments)[1]
+        counts = torch.bincount(assignments, minlength=nlist)
+        super().__init__(vectors[order.to(vectors.device)].contiguous())
+        self.ids = order
+        self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        self._build_positions()
+
+    def _build_positions(self):
+        # inverse of self.ids: position of each candidate in self.vectors
+        self.positions = torch.empty_like(self.ids)
+        self.positions[self.ids] = torch.arange(len(self.ids))
+
+    @property
+    def nlist(self):
+        return self.centroids.size(0)
+
+    def _get_state(self):
+        return {
+            'centroids': self.centroids.cpu(),
+            'ids': self.ids.cpu(),
+            'offsets': self.offsets.cpu(),
+            'nprobe': self.nprobe,
+        }
+
+    def _set_state(self, state, nprobe=None, **kwargs):
+        self.centroids = state['centroids']
+        self.ids = state['ids']
+        self.offsets = state['offsets']
+        self.nprobe = state['nprobe'] if nprobe is None else nprobe
+        self._build_positions()
+
+    def to(self, device=None, dtype=None):
+        super().to(device, dtype)
+        self.centroids = self.centroids.to(device=device, dtype=dtype)
+        return self
+
+    @staticmethod
+    def _assign(vectors, centroids, chunk_size=65536):
+        """
+        Return the index of the closest centroid (in L2 distance) of each vector.
+        """
+        centroids = centroids.to(vectors.device, torch.float)
+        c_norms = (centroids * centroids).sum(dim=1)
+        assignments = []
+        for start in range(0, vectors.size(0), chunk_size):
+            chunk = vectors[start : start + chunk_size].float()
+            # ||x - c||^2 up to the constant ||x||^2
+            dists = torch.addmm(c_norms, chunk, centroids.t(), alpha=-2)
+            assignments.append(dists.argmin(dim=1))
+        return torch.cat(assignments).cpu()
+
+    def _kmeans(self, vectors, nlist, niter, seed, max_points_per_list=256):
+        generator = torch.Generator().manual_seed(seed)
+        num_cands = vectors.size(0)
+        num_train = min(num_cands, nlist * max_points_per_list)
+        sample = torch.randperm(num_cands, generator=generator)[:num_train]
+        train = vectors[sample.to(vectors.device)].float()
+
+        centroids = train[:nlist].clone()
+        for _ in range(niter):
+            assignments = self._assign(train, centroids).to(train.device)
+            counts = torch.bincount(assignments, minlength=nlist)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, train)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).to(
+                sums
+            )
+            # restart empty clusters from random training points
+            num_empty = int((~nonempty).sum())
+            if num_empty:
+                restart = torch.randint(num_train, (num_empty,), generator=generator)
+                centroids[~nonempty] = train[restart.to(train.device)]
+        return centroids.to(vectors.dtype)
+
+    def search(self, queries, k):
+        k = min(k, len(self))
+        queries = queries.to(self.vectors.device, self.vectors.dtype)
+        device = self.vectors.device
+        list_order = queries.matmul(self.centroids.t()).argsort(dim=1, descending=True)
+        list_order = list_order.cpu()
+        sizes = self.offsets[1:] - self.offsets[:-1]
+
+        all_scores = []
+        all_ids = []
+        for query, lists in zip(queries, list_order):
+            # probe at least nprobe lists, and enough lists to fill k results
+            probed = sizes[lists].cumsum(0)
+            num_lists = int((probed < k).sum()) + 1
+            num_lists = min(max(num_lists, self.nprobe), self.nlist)
+            positions = torch.cat(
+                [
+                    torch.arange(self.offsets[i], self.offsets[i + 1])
+                    for i in lists[:num_lists].tolist()
+                ]
+            ).to(device)
+            scores = self.vectors[positions].matmul(query)
+            scores, top = scores.topk(k)
+            all_scores.append(scores)
+            all_ids.append(self.ids[positions[top].cpu()])
+        return torch.stack(all_scores), torch.stack(all_ids).to(device)
+
+    def get_vectors(self, ids):
+        return self.vectors[self.positions[ids.cpu()].to(self.vectors.device)]
+
+
+CANDIDATE_INDEXES = {
+    FlatCandidateIndex.index_type: FlatCandidateIndex,
+    IVFCandidateIndex.index_type: IVFCandidateIndex,
+}
+
+
+def build_candidate_index(index_type, vectors, **kwargs):
+    """
+    Build an index of the given type over the [num_cands, dim] vectors.
+
+    Extra keyword arguments are passed to the index constructor.
+    """
+    if index_type not in CANDIDATE_INDEXES:
+        raise ValueError(
+            'Unknown candidate index type {}, choose one of {}'.format(
+                index_type, sorted(CANDIDATE_INDEXES)
+            )
+        )
+    return CANDIDATE_INDEXES[index_type](vectors, **kwargs)
+
+
+def load_candidate_index(path, **kwargs):
+    """
+    Load an index saved with ``CandidateIndex.save()``.
+
+    The vectors are memory-mapped, so only the parts needed by a search are actually
+    read from disk, unless the index is later moved to another device. Extra keyword
+    arguments override query-time settings, e.g. ``nprobe``.
+    """
+    metadata = torch.load(path, map_location=lambda cpu, _: cpu)
+    cls = CANDIDATE_INDEXES[metadata['index_type']]
+    # copy-on-write mapping, so torch gets a writable array
+    vectors = torch.from_numpy(np.load(path + '.npy', mmap_mode='c'))
+    index = cls.__new__(cls)
+    CandidateIndex.__init__(index, vectors)
+    index._set_state(metadata['state'], **kwargs)
+    return index
+
+
+def candidate_index_exists(path):
+    """
+    Return whether both files of an index saved at ``path`` exist.
+    """
+    return os.path.isfile(path) and os.path.isfile(path + '.npy')
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Crash-safe, optionally asynchronous, writing of model checkpoints.
+
+Checkpoints are first written to a temporary file next to their destination,
+flushed to disk, and then atomically renamed over the destination, so that a crash
+in the middle of a save never leaves a truncated model file behind.
+
+With a ``CheckpointWriter``, the serialization itself can run on a background
+thread: the states are copied to CPU memory on the calling thread, which is then
+free to keep training while the copy is written to disk.
+
+Checkpoints can also be saved in a memory-mappable layout, which is faster to load
+and needs less memory for evaluation and serving:
+
+- ``path`` holds the small states (scheduler, number of updates...) and an index
+  giving the dtype, shape and offset of every model tensor;
+- ``path + '.tensors'`` holds the raw bytes of the model tensors, back to back;
+- ``path + '.optim'`` holds the optimizer states, which are only read for training.
+
+Model tensors are loaded as views of the memory-mapped buffer file, so that
+``load_state_dict`` copies them straight from the page cache into the model.
+"""
+
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import torch
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# the tensors of mmap checkpoints start at multiples of this many bytes
+_MMAP_ALIGNMENT = 64
+
+
+def cpu_copy(obj):
+    """
+    Deep copy the tensors of a (nested) state dict to CPU memory.
+
+    Containers are copied too, so that later updates of the original states, e.g.
+    new optimizer steps, don't leak into the copy.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return [cpu_copy(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(cpu_copy(v) for v in obj)
+    return obj
+
+
+def atomic_write(path, write_fn, mode='wb'):
+    """
+    Write a file through ``write_fn(handle)``, atomically replacing path.
+
+    The data is written to ``path + '.tmp'`` and synced to disk before being
+    renamed to path, so that readers only ever see a complete file.
+    """
+    tmp_path = path + '.tmp'
+    kwargs = {} if 'b' in mode else {'encoding': 'utf-8'}
+    with open(tmp_path, mode, **kwargs) as handle:
+        write_fn(handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+
+
+def rotate_checkpoints(path, keep, suffixes=('',)):
+    """
+    Keep the current files of a checkpoint as its most recent old version.
+
+    Old versions are numbered ``path.1`` (most recent) to ``path.{keep - 1}``, and
+    the oldest one is dropped. The current files stay in place, so that path is
+    always a complete checkpoint.
+
+    :param path:
+        path of the checkpoint.
+    :param keep:
+        total number of versions to keep, including the current one. Nothing is
+        done if it is 1 or less.
+    :param suffixes:
+        suffixes of the files making up a checkpoint, e.g. ``('', '.opt')``.
+    """
+    if keep <= 1 or not os.path.isfile(path):
+        return
+    for suffix in suffixes:
+        oldest = '{}.{}{}'.format(path, keep - 1, suffix)
+        if os.path.isfile(oldest):
+            os.remove(oldest)
+        for i in range(keep - 2, 0, -1):
+            src = '{}.{}{}'.format(path, i, suffix)
+            if os.path.isfile(src):
+                os.replace(src, '{}.{}{}'.format(path, i + 1, suffix))
+        if os.path.isfile(path + suffix):
+            dst = '{}.1{}'.format(path, suffix)
+            try:
+                # a hard link is free, and keeps path in place
+                os.link(path + suffix, dst)
+            except OSError:
+                shutil.copyfile(path + suffix, dst)
+
+
+def _write_tensors(handle, tensors):
+    """
+    Write tensors back to back, and return their index.
+    """
+    index = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        padding = -offset % _MMAP_ALIGNMENT
+        handle.write(b'\0' * padding)
+        offset += padding
+        tensor = tensor.detach().cpu().contiguous()
+        data = tensor.reshape(-1).view(torch.uint8).numpy()
+        handle.write(data.tobytes())
+        index[name] = {
+            'dtype': str(tensor.dtype).replace('torch.', ''),
+            'shape': list(tensor.shape),
+            'offset': offset,
+        }
+        offset += data.nbytes
+    return index
+
+
+def _save_mmap_states(path, states):
+    """
+    Atomically save states in the memory-mappable layout.
+    """
+    states = dict(states)
+    model = states.pop('model', {})
+    tensors = {k: v for k, v in model.items() if isinstance(v, torch.Tensor)}
+    states['model_extra'] = {k: v for k, v in model.items() if k not in tensors}
+    index = {}
+
+    def write_tensors(handle):
+        index.update(_write_tensors(handle, tensors))
+
+    atomic_write(path + '.tensors', write_tensors)
+    optimizer = states.pop('optimizer', None)
+    if optimizer is not None:
+        atomic_write(path + '.optim', lambda handle: torch.save(optimizer, handle))
+    elif os.path.isfile(path + '.optim'):
+        # don't leave the optimizer states of a previous save behind
+        os.remove(path + '.optim')
+    states['model_index'] = index
+    # the index is written last, as it refers to the other files
+    atomic_write(path, lambda handle: torch.save(states, handle))
+
+
+def save_checkpoint(path, states, opt_json=None, keep=1, save_format='torch'):
+    """
+    Atomically save states, and optionally their opt file, to path.
+
+    :param states:
+        the states to save with ``torch.save``.
+    :param opt_json:
+        if given, the content of the ``path + '.opt'`` file.
+    :param keep:
+        number of versions of the checkpoint to keep, see ``rotate_checkpoints``.
+    :param save_format:
+        ``'torch'`` to save states in a single file, or ``'mmap'`` to use the
+        memory-mappable layout.
+    """
+    suffixes = ['']
+    if save_format == 'mmap':
+        suffixes += ['.tensors', '.optim']
+    if opt_json is not None:
+        suffixes.append('.opt')
+    rotate_checkpoints(path, keep, suffixes)
+    if save_format == 'mmap':
+        _save_mmap_states(path, states)
+    else:
+        atomic_write(path, lambda handle: torch.save(states, handle))
+    if opt_json is not None:
+        atomic_write(path + '.opt', lambda handle: handle.write(opt_json), mode='w')
+
+
+def load_checkpoint(path, load_optimizer=True):
+    """
+    Load the states saved by ``save_checkpoint`` in either layout, on CPU.
+
+    Model tensors of mmap checkpoints are views of the memory-mapped buffer file,
+    which is never written to: changes to them are private to this process.
+
+    :param load_optimizer:
+        if False, the optimizer states are not returned, and not even read from
+        mmap checkpoints.
+    """
+    import parlai.utils.pickle
+
+    states = torch.load(
+        path, map_location=lambda cpu, _: cpu, pickle_module=parlai.utils.pickle
+    )
+    if not load_optimizer:
+        states.pop('optimizer', None)
+    if 'model_index' not in states:
+        return states
+
+    index = states.pop('model_index')
+    model = states.pop('model_extra')
+    buffer = None
+    for name, meta in index.items():
+        dtype = getattr(torch, meta['dtype'])
+        numel = int(np.prod(meta['shape']))
+        if numel == 0:
+            model[name] = torch.empty(meta['shape'], dtype=dtype)
+            continue
+        if buffer is None:
+            # copy-on-write, so that torch doesn't complain about read-only memory
+            buffer = np.memmap(path + '.tensors', dtype=np.uint8, mode='c')
+        nbytes = numel * torch.tensor([], dtype=dtype).element_size()
+        data = torch.from_numpy(buffer[meta['offset'] : meta['offset'] + nbytes])
+        model[name] = data.view(dtype).view(meta['shape'])
+    states['model'] = model
+    if load_optimizer and os.path.isfile(path + '.optim'):
+        states['optimizer'] = torch.load(
+            path + '.optim',
+            map_location=lambda cpu, _: cpu,
+            pickle_module=parlai.utils.pickle,
+        )
+    return states
+
+
+def peak_memory_mb():
+    """
+    Return the peak resident memory of this process in MB, or None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak / (1024 ** 2 if os.uname().sysname == 'Darwin' else 1024)
+
+
+class CheckpointWriter(object):
+    """
+    Save checkpoints on a background thread, one at a time.
+
+    ``save()`` copies the states to CPU memory and returns as soon as the copy is
+    made; it only blocks if the previous checkpoint is still being written. Use
+    ``wait()`` before reading a checkpoint back.
+    """
+
+    def __init__(self, keep=1, save_format='torch'):
+        """
+        :param keep:
+            number of versions of each checkpoint to keep.
+        :param save_format:
+            layout of the checkpoints, see ``save_checkpoint``.
+        """
+        self.keep = keep
+        self.save_format = save_format
+        self._thread = None
+        self._error = None
+        self._lock = threading.Lock()
+        # durations of the saves completed since the last pop_save_times()
+        self._save_times = []
+
+    def save(self, path, states, opt_json=None):
+        """
+        Start saving a checkpoint in the background.
+
+        :return:
+            the time, in seconds, the caller was blocked: waiting for the previous
+            save, and copying the states.
+        """
+        start = time.time()
+        self.wait()
+        states = cpu_copy(states)
+        self._thread = threading.Thread(
+            target=self._save, args=(path, states, opt_json), name='checkpoint'
+        )
+        # not a daemon, so that the interpreter finishes the save before exiting
+        self._thread.start()
+        return time.time() - start
+
+    def _save(self, path, states, opt_json):
+        start = time.time()
+        try:
+            save_checkpoint(path, states, opt_json, self.keep, self.save_format)
+        except Exception as e:
+            self._error = e
+            return
+        with self._lock:
+            self._save_times.append(time.time() - start)
+
+    def wait(self):
+        """
+        Wait for the checkpoint in flight, if any, to be written.
+
+        Errors from the background save are raised here.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def pop_save_times(self):
+        """
+        Return the durations of the saves completed since the last call.
+        """
+        with self._lock:
+            times, self._save_times = self._save_times, []
+        return times
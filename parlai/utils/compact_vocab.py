@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compact, memory-mapped vocabularies for the ``DictionaryAgent``.
+
+A vocabulary of n tokens is stored in a single binary file, holding:
+
+- ``n + 1`` offsets of the tokens in the file, followed by
+- the ``n`` token frequencies,
+- an open-addressing hash table from the crc32 of a token to its index, and the
+  full crc32 of each slot, checked before comparing the token itself,
+- the utf-8 bytes of all tokens, concatenated in index order.
+
+The file is memory-mapped read-only, so loading it costs almost nothing, and
+processes loading the same file share its pages instead of each building Python
+dicts of every token. ``CompactTok2Ind``, ``CompactInd2Tok`` and ``CompactFreq``
+implement, over a ``CompactVocab``, the mapping interface of the dicts they
+replace in the ``DictionaryAgent``.
+"""
+
+from abc import abstractmethod
+from array import array
+from collections.abc import ItemsView, Mapping, ValuesView
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'PARLAI_VOCAB_V1\n'
+_HEADER_START = len(MAGIC) + 8
+
+
+def _align(n):
+    return (n + 7) // 8 * 8
+
+
+def write_compact_vocab(path, tokens, freqs, metadata=None):
+    """
+    Write a vocabulary to path, atomically.
+
+    :param tokens: list of tokens, in index order.
+    :param freqs: list of the frequencies of the tokens.
+    :param metadata: json-serializable data stored with the vocabulary.
+    """
+    encoded = [t.encode('utf-8') for t in tokens]
+    num_tokens = len(encoded)
+    table_size = 2
+    while table_size < 2 * num_tokens:
+        table_size *= 2
+    header = {
+        'num_tokens': num_tokens,
+        'table_size': table_size,
+        'byteorder': sys.byteorder,
+        'metadata': metadata,
+    }
+    header = json.dumps(header).encode('utf-8')
+    data_start = _align(_HEADER_START + len(header))
+    blob_start = data_start + 8 * (2 * num_tokens + 1) + 8 * table_size
+
+    offsets = array('q', [blob_start])
+    for key in encoded:
+        offsets.append(offsets[-1] + len(key))
+    mask = table_size - 1
+    table = array('i', [-1]) * table_size
+    hashes = array('I', [0]) * table_size
+    for i, key in enumerate(encoded):
+        crc = zlib.crc32(key)
+        h = crc & mask
+        while table[h] >= 0:
+            h = (h + 1) & mask
+        table[h] = i
+        hashes[h] = crc
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_start - _HEADER_START - len(header)))
+        f.write(offsets.tobytes())
+        f.write(array('q', freqs).tobytes())
+        f.write(table.tobytes())
+        f.write(hashes.tobytes())
+        for key in encoded:
+            f.write(key)
+    os.replace(tmp_path, path)
+
+
+class CompactVocab(object):
+    """
+    Read-only vocabulary, memory-mapped from a file written by
+    ``write_compact_vocab()``.
+
+    Pickling only keeps the path, so that other processes map the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mmap
+        if mm[: len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a compact vocabulary'.format(self.path))
+        (header_len,) = struct.unpack('<q', mm[len(MAGIC) : _HEADER_START])
+        header = json.loads(
+            mm[_HEADER_START : _HEADER_START + header_len].decode('utf-8')
+        )
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('{} has another byte order'.format(self.path))
+        self.metadata = header['metadata']
+        self._num_tokens = n = header['num_tokens']
+        self._mask = header['table_size'] - 1
+
+        view = memoryview(mm)
+        start = _align(_HEADER_START + header_len)
+        self._offsets = view[start : start + 8 * (n + 1)].cast('q')
+        start += 8 * (n + 1)
+        self._freqs = view[start : start + 8 * n].cast('q')
+        start += 8 * n
+        table_size = self._mask + 1
+        self._table = view[start : start + 4 * table_size].cast('i')
+        start += 4 * table_size
+        self._hashes = view[start : start + 4 * table_size].cast('I')
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __len__(self):
+        return self._num_tokens
+
+    def index(self, token, default=None):
+        """
+        Return the index of token, or default if not in the vocabulary.
+        """
+        try:
+            key = token.encode('utf-8')
+        except (AttributeError, UnicodeEncodeError):
+            return default
+        mask, table, hashes = self._mask, self._table, self._hashes
+        crc = zlib.crc32(key)
+        h = crc & mask
+        while True:
+            i = table[h]
+            if i < 0:
+                return default
+            if (
+                hashes[h] == crc
+                and self._mmap[self._offsets[i] : self._offsets[i + 1]] == key
+            ):
+                return i
+            h = (h + 1) & mask
+
+    def token(self, index):
+        """
+        Return the token at index, which must be in range.
+        """
+        return self._mmap[self._offsets[index] : self._offsets[index + 1]].decode(
+            'utf-8'
+        )
+
+    def tokens(self):
+        """
+        Iterate over the tokens, in index order.
+        """
+        return map(self.token, range(self._num_tokens))
+
+    def freq(self, index):
+        return self._freqs[index]
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping._iter_items()
+
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        return (v for _, v in self._mapping._iter_items())
+
+
+class _VocabMapping(Mapping):
+    """
+    Read-only mapping over a ``CompactVocab``.
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    @abstractmethod
+    def _iter_items(self):
+        """
+        Iterate over the (key, value) pairs of the mapping.
+        """
+
+
+class CompactTok2Ind(_VocabMapping):
+    """
+    Mapping from tokens to their indices.
+    """
+
+    def __init__(self, vocab):
+        super().__init__(vocab)
+        # skip a call in the hot path of txt2vec
+        self.get = vocab.index
+
+    def __getitem__(self, token):
+        index = self.vocab.index(token)
+        if index is None:
+            raise KeyError(token)
+        return index
+
+    def __contains__(self, token):
+        return self.vocab.index(token) is not None
+
+    def __iter__(self):
+        return self.vocab.tokens()
+
+    def _iter_items(self):
+        return ((t, i) for i, t in enumerate(self.vocab.tokens()))
+
+
+class CompactInd2Tok(_VocabMapping):
+    """
+    Mapping from indices to their tokens.
+    """
+
+    def _check_index(self, index):
+        try:
+            index = operator.index(index)
+        except TypeError:
+            return None
+        return index if 0 <= index < len(self.vocab) else None
+
+    def __getitem__(self, index):
+        checked = self._check_index(index)
+        if checked is None:
+            raise KeyError(index)
+        return self.vocab.token(checked)
+
+    def get(self, index, default=None):
+        checked = self._check_index(index)
+        return default if checked is None else self.vocab.token(checked)
+
+    def __contains__(self, index):
+        return self._check_index(index) is not None
+
+    def __iter__(self):
+        return iter(range(len(self.vocab)))
+
+    def _iter_items(self):
+        return enumerate(self.vocab.tokens())
+
+
+class CompactFreq(_VocabMapping):
+    """
+    Mapping from tokens to their frequencies.
+
+    Like the ``defaultdict(int)`` it replaces, missing tokens have a frequency of
+    0. The frequencies of tokens in the vocabulary may be changed, but no tokens
+    may be added.
+    """
+
+    def __init__(self, vocab):
+        super().__init__(vocab)
+        # index -> frequency, for the frequencies changed since loading
+        self._overrides = {}
+
+    def _freq(self, index):
+        freq = self._overrides.get(index)
+        return self.vocab.freq(index) if freq is None else freq
+
+    def __getitem__(self, token):
+        index = self.vocab.index(token)
+        return 0 if index is None else self._freq(index)
+
+    def get(self, token, default=None):
+        index = self.vocab.index(token)
+        return default if index is None else self._freq(index)
+
+    def __setitem__(self, token, value):
+        index = self.vocab.index(token)
+        if index is None:
+            raise KeyError('Cannot add {} to a compact vocabulary'.format(token))
+        if value == self.vocab.freq(index):
+            self._overrides.pop(index, None)
+        else:
+            self._overrides[index] = value
+
+    def __contains__(self, token):
+        return self.vocab.index(token) is not None
+
+    def __iter__(self):
+        return self.vocab.tokens()
+
+    def _iter_items(self):
+        return ((t, self._freq(i)) for i, t in enumerate(self.vocab.tokens()))
@@ -38,6 +38,8 @@ DISPLAY_MESSAGE_DEFAULT_FIELDS = {
     'reward',
     'eval_labels_vec',
     'text_vec',
+    'text_token_ids',
+    'token_ids_fingerprint',
     'label_candidates_vecs',
     'token_losses',
 }
@@ -8,10 +8,13 @@ Utility functions and classes for detecting offensive language.
 """
 
 from parlai.agents.transformer.transformer import TransformerClassifierAgent
-from parlai.core.agents import create_agent
+from parlai.core.agents import create_agent, create_agent_from_shared
 from parlai.tasks.dialogue_safety.agents import OK_CLASS, NOT_OK_CLASS
 
+from collections import deque
+import hashlib
 import os
+import pickle
 
 
 class OffensiveLanguageClassifier:
@@ -26,6 +29,8 @@ class OffensiveLanguageClassifier:
     def __init__(self):
         self.model = self._create_safety_model()
         self.classes = {OK_CLASS: False, NOT_OK_CLASS: True}
+        # copies of the model sharing its weights, one per batch row
+        self._copies = []
 
     def _create_safety_model(self):
         from parlai.core.params import ParlaiParser
@@ -40,6 +45,13 @@ class OffensiveLanguageClassifier:
         safety_opt = parser.parse_args([], print_args=False)
         return create_agent(safety_opt)
 
+    def _parse_response(self, response):
+        pred_class, prob = [x.split(': ')[-1] for x in response.split('\n')]
+        pred_not_ok = self.classes[pred_class]  # check whether classified as NOT OK
+        prob = float(prob)  # cast string to float
+
+        return pred_not_ok, prob
+
     def contains_offensive_language(self, text):
         """
         Returns the probability that a message is safe according to the classifier.
@@ -47,11 +59,43 @@ class OffensiveLanguageClassifier:
         act = {'text': text, 'episode_done': True}
         self.model.observe(act)
         response = self.model.act()['text']
-        pred_class, prob = [x.split(': ')[-1] for x in response.split('\n')]
-        pred_not_ok = self.classes[pred_class]  # check whether classified as NOT OK
-        prob = float(prob)  # cast string to float
+        return self._parse_response(response)
 
-        return pred_not_ok, prob
+    def batch_contains_offensive_language(self, texts, batchsize=64):
+        """
+        Classify many messages, in batches of up to ``batchsize``.
+
+        :return: a list of (pred_not_ok, prob), as ``contains_offensive_language``.
+        """
+        if len(self._copies) < min(batchsize, len(texts)):
+            shared = self.model.share()
+            while len(self._copies) < min(batchsize, len(texts)):
+                self._copies.append(create_agent_from_shared(shared))
+        results = []
+        for start in range(0, len(texts), batchsize):
+            batch = texts[start : start + batchsize]
+            observations = [
+                copy.observe({'text': text, 'episode_done': True})
+                for copy, text in zip(self._copies, batch)
+            ]
+            replies = self.model.batch_act(observations)
+            for copy, reply in zip(self._copies, replies):
+                copy.self_observe(reply)
+                results.append(self._parse_response(reply['text']))
+        return results
+
+    def batch_contains(self, texts, batchsize=64):
+        """
+        Determine which of the texts the model classifies as offensive.
+
+        :return: a list of booleans, one per text.
+        """
+        return [
+            pred_not_ok
+            for pred_not_ok, _ in self.batch_contains_offensive_language(
+                texts, batchsize
+            )
+        ]
 
     def __contains__(self, key):
         """
@@ -67,11 +111,22 @@ class OffensiveStringMatcher:
     """
     Detects offensive language using a list of offensive language and phrases from
     https://github.com/LDNOOBW.
+
+    Phrases, with common prefixes and suffixes added, are compiled into an
+    Aho-Corasick automaton over tokens, so that a text is matched in a single pass
+    whatever the number of phrases. The automaton is cached next to the phrase list,
+    and rebuilt whenever the list changes.
     """
 
-    def __init__(self):
+    AUTOMATON_VERSION = 1
+
+    def __init__(self, datafile=None):
         """
         Get data from external sources and build data representation.
+
+        :param datafile:
+            file of offensive phrases, one per line. Defaults to the LDNOOBW list,
+            downloaded if needed.
         """
         import parlai.core.build_data as build_data
         from parlai.core.params import ParlaiParser
@@ -107,13 +162,8 @@ class OffensiveStringMatcher:
                 build_data.mark_done(dpath, version)
 
         self.datapath = os.path.join(parser.parlai_home, 'data')
-        self.datafile = _path()
+        self.datafile = _path() if datafile is None else datafile
 
-        # store a token trie: e.g.
-        # {'2': {'girls': {'1': {'cup': {'__END__': True}}}}
-        self.END = '__END__'
-        self.max_len = 1
-        self.offensive_trie = {}
         self.word_prefixes = [
             'de',
             'de-',
@@ -168,27 +218,91 @@ class OffensiveStringMatcher:
             'twinkies',
         ]
 
-        with open(self.datafile, 'r') as f:
-            for p in f.read().splitlines():
+        with open(self.datafile, 'rb') as f:
+            data = f.read()
+        digest = hashlib.md5(data)
+        digest.update(
+            repr((self.word_prefixes, self.word_suffixes, self.white_list)).encode()
+        )
+        self._digest = digest.hexdigest()
+        self.automaton_file = self.datafile + '.automaton'
+        if not self._load_automaton():
+            # states of a trie over tokens: goto[state][token] is the next state,
+            # and ends[state] the number of tokens of the phrase ending there
+            self._goto = [{}]
+            self._ends = [0]
+            self.max_len = 1
+            for p in data.decode('utf-8').splitlines():
                 mod_ps = [p]
                 mod_ps += [pref + p for pref in self.word_prefixes]
                 mod_ps += [p + suff for suff in self.word_suffixes]
                 for mod_p in mod_ps:
                     if mod_p not in self.white_list:
                         self.add_phrase(mod_p)
+            self._build_automaton()
+            self._save_automaton()
+
+    def _load_automaton(self):
+        """
+        Load the cached automaton, if it was built from the same phrases.
+        """
+        if not os.path.isfile(self.automaton_file):
+            return False
+        try:
+            with open(self.automaton_file, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if (
+            state.get('version') != self.AUTOMATON_VERSION
+            or state.get('digest') != self._digest
+        ):
+            return False
+        self._goto = state['goto']
+        self._ends = state['ends']
+        self._fail = state['fail']
+        self._out_len = state['out_len']
+        self.max_len = state['max_len']
+        return True
+
+    def _save_automaton(self):
+        state = {
+            'version': self.AUTOMATON_VERSION,
+            'digest': self._digest,
+            'goto': self._goto,
+            'ends': self._ends,
+            'fail': self._fail,
+            'out_len': self._out_len,
+            'max_len': self.max_len,
+        }
+        try:
+            # write then rename, so concurrent readers never see a partial file
+            tmp = '{}.{}.tmp'.format(self.automaton_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.automaton_file)
+        except OSError:
+            # the data directory may be read-only, the cache is optional
+            pass
 
     def add_phrase(self, phrase):
         """
         Add a single phrase to the filter.
         """
         toks = self.tokenize(phrase)
-        curr = self.offensive_trie
+        if not toks:
+            return
+        state = 0
         for t in toks:
-            if t not in curr:
-                curr[t] = {}
-            curr = curr[t]
-        curr[self.END] = True
+            if t not in self._goto[state]:
+                self._goto[state][t] = len(self._goto)
+                self._goto.append({})
+                self._ends.append(0)
+            state = self._goto[state][t]
+        self._ends[state] = len(toks)
         self.max_len = max(self.max_len, len(toks))
+        # failure links are recomputed before the next match
+        self._fail = None
 
     def add_words(self, phrase_list):
         """
@@ -197,37 +311,79 @@ class OffensiveStringMatcher:
         for phrase in phrase_list:
             self.add_phrase(phrase)
 
-    def _check_sequence(self, toks, idx, node):
+    def _build_automaton(self):
+        """
+        Compute the failure links of the automaton, breadth first.
+
+        ``fail[state]`` is the state of the longest proper suffix of the tokens
+        leading to ``state`` which is also in the trie, and ``out_len[state]`` the
+        length of the longest phrase which is a suffix of those tokens.
+        """
+        goto = self._goto
+        fail = [0] * len(goto)
+        out_len = list(self._ends)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for tok, child in goto[state].items():
+                f = fail[state]
+                while f and tok not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(tok, 0)
+                out_len[child] = max(out_len[child], out_len[fail[child]])
+                queue.append(child)
+        self._fail = fail
+        self._out_len = out_len
+
+    def _find(self, toks):
         """
-        Check if words from the sequence are in the trie.
+        Return the (start, end) token indices of the first offensive phrase in toks.
 
-        This checks phrases made from toks[i], toks[i:i+2] ... toks[i:i + self.max_len]
+        Like scanning every start position in order, this finds the phrase starting
+        first, and the shortest one among those.
         """
-        right = min(idx + self.max_len, len(toks))
-        for i in range(idx, right):
-            if toks[i] in node:
-                node = node[toks[i]]
-                if self.END in node:
-                    return ' '.join(toks[j] for j in range(idx, i + 1))
-            else:
+        if self._fail is None:
+            self._build_automaton()
+        goto, fail, out_len = self._goto, self._fail, self._out_len
+        state = 0
+        best = None
+        for i, tok in enumerate(toks):
+            # a phrase starting before the best one must have ended by now
+            if best is not None and i > best[0] + self.max_len - 2:
                 break
-        return False
+            while state and tok not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(tok, 0)
+            if out_len[state]:
+                start = i - out_len[state] + 1
+                if best is None or start < best[0]:
+                    best = (start, i)
+        return best
+
+    def _tokens(self, text):
+        if type(text) is str:
+            return self.tokenize(text.lower())
+        elif type(text) is list or type(text) is tuple:
+            return text
 
     def contains_offensive_language(self, text):
         """
         Determine if text contains any offensive words in the filter.
         """
-        if type(text) is str:
-            toks = self.tokenize(text.lower())
-        elif type(text) is list or type(text) is tuple:
-            toks = text
-
-        for i in range(len(toks)):
-            res = self._check_sequence(toks, i, self.offensive_trie)
-            if res:
-                return res
+        toks = self._tokens(text)
+        found = self._find(toks)
+        if found is None:
+            return None
+        start, end = found
+        return ' '.join(toks[start : end + 1])
+
+    def batch_contains(self, texts):
+        """
+        Determine which of the texts contain any offensive words in the filter.
 
-        return None
+        :return: a list of booleans, one per text.
+        """
+        return [self._find(self._tokens(t)) is not None for t in texts]
 
     def __contains__(self, key):
         """
@@ -6,15 +6,17 @@
 """
 Provides utilities useful for multiprocessing.
 
-This includes a ``SharedTable``.
+This includes a ``SharedTable`` and ``SharedArrays``.
 """
 
 from multiprocessing import Lock
 from multiprocessing import RawArray  # type: ignore
-from collections.abc import MutableMapping
+from collections.abc import Mapping, MutableMapping
 import ctypes
 import sys
 
+import numpy as np
+
 
 class SharedTable(MutableMapping):
     """
@@ -176,6 +178,118 @@ class SharedTable(MutableMapping):
         return self.lock
 
 
+class SharedArrays(Mapping):
+    """
+    Large arrays and tensors, placed once in shared memory and looked up by name.
+
+    Agents register their big read-only state (e.g. sparse matrices or embeddings)
+    when they are shared, so that the processes of ``HogwildWorld`` all attach to a
+    single copy instead of each holding their own. Numpy arrays are copied into a
+    ``RawArray``, and torch tensors are moved to shared memory in place.
+
+    Use this class as follows:
+
+    .. code-block:: python
+
+        arrays = SharedArrays()
+        self.matrix = arrays.register('matrix', self.matrix)
+        shared['arrays'] = arrays
+        # then, in the worker processes
+        self.matrix = shared['arrays']['matrix']
+
+    Like ``SharedTable``, the arrays must be passed to the worker processes when
+    they are created.
+    """
+
+    def __init__(self):
+        # name -> (RawArray, dtype, shape)
+        self.buffers = {}
+        self.tensors = {}
+        # numpy views on the buffers, rebuilt in each process
+        self._views = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.buffers) + len(self.tensors)
+
+    def __iter__(self):
+        return iter(list(self.buffers) + list(self.tensors))
+
+    def __getitem__(self, name):
+        if name in self.tensors:
+            return self.tensors[name]
+        if name not in self.buffers:
+            raise KeyError('Array "{}" not found in SharedArrays'.format(name))
+        if name not in self._views:
+            buffer, dtype, shape = self.buffers[name]
+            if len(buffer) == 0:
+                view = np.empty(shape, dtype=dtype)
+            else:
+                view = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+            self._views[name] = view
+        return self._views[name]
+
+    def register(self, name, value):
+        """
+        Move an array or tensor to shared memory.
+
+        :return:
+            the shared version of the value, which should replace it.
+        """
+        if name in self:
+            raise KeyError('Array "{}" is already in SharedArrays'.format(name))
+        if is_tensor(value):
+            self.tensors[name] = value.share_memory_()
+            return value
+        value = np.ascontiguousarray(value)
+        buffer = RawArray(ctypes.c_byte, value.nbytes)
+        self.buffers[name] = (buffer, value.dtype.str, value.shape)
+        self[name][...] = value
+        return self[name]
+
+    @property
+    def nbytes(self):
+        """
+        Return the total size of the registered arrays and tensors.
+        """
+        total = sum(len(buffer) for buffer, _, _ in self.buffers.values())
+        for tensor in self.tensors.values():
+            total += tensor.element_size() * tensor.nelement()
+        return total
+
+
+def memory_usage():
+    """
+    Return the resident and shared memory of this process, in bytes.
+
+    Shared memory counts the resident pages also mapped by other processes, such as
+    ``SharedArrays`` or pages not yet copied after a fork.
+
+    :return:
+        a dict with ``resident`` and ``shared`` sizes, or None if unknown (the
+        sizes are read from ``/proc``, so are only available on Linux).
+    """
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == 'kB':
+                    usage[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    if 'Rss' not in usage:
+        return None
+    return {
+        'resident': usage['Rss'],
+        'shared': usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0),
+    }
+
+
 def is_tensor(v):
     """
     Return if an object is a torch Tensor, without importing torch.
@@ -191,6 +191,45 @@ def concat_without_padding(text_idx, cand_idx, use_cuda, null_idx=0):
     return tokens, segments
 
 
+def concat_candidates_without_padding(text_idx, cand_idx, null_idx=0):
+    """
+    Concatenate each text with each of its candidates and move padding to the right.
+
+    Same as ``concat_without_padding()`` on every (text, candidate) pair, but the
+    texts are not copied for each candidate first, and cand_idx may be a view
+    expanding candidates shared by all texts. Runs on the device of the inputs.
+
+    :param text_idx:
+        [bsz, text_len] right padded LongTensor
+    :param cand_idx:
+        [bsz, num_cands, cand_len] right padded LongTensor
+
+    :return:
+        (tokens, segments), two [bsz * num_cands, text_len + cand_len] LongTensors
+    """
+    bsz, text_len = text_idx.shape
+    _, num_cands, cand_len = cand_idx.shape
+    concat_len = text_len + cand_len
+    text_lens = torch.sum(text_idx != null_idx, dim=1, keepdim=True)
+    positions = torch.arange(concat_len, device=text_idx.device)
+    is_text = positions < text_lens
+    is_cand = ~is_text & (positions < text_lens + cand_len)
+
+    tokens = text_idx.new_full((bsz, num_cands, concat_len), null_idx)
+    tokens[:, :, :text_len] = text_idx.masked_fill(
+        ~is_text[:, :text_len], null_idx
+    ).unsqueeze(1)
+    cand_positions = text_lens.unsqueeze(2) + positions[:cand_len]
+    tokens.scatter_(2, cand_positions.expand(bsz, num_cands, cand_len), cand_idx)
+    segments = text_idx.new_full((bsz, concat_len), null_idx)
+    segments = segments.masked_fill(is_text, 0).masked_fill(is_cand, 1)
+    segments = segments.unsqueeze(1).expand(bsz, num_cands, concat_len)
+    return (
+        tokens.view(bsz * num_cands, concat_len),
+        segments.reshape(bsz * num_cands, concat_len),
+    )
+
+
 def argsort(keys: List[Any], *lists: List[List[Any]], descending: bool = False):
     """
     Reorder each list in lists by the (descending) sorted order of keys.
@@ -11,16 +11,123 @@ Useful utilities for logging actions/observations in a world.
 from parlai.core.worlds import BatchWorld
 from parlai.utils.misc import msg_to_str
 
+import bz2
 import copy
+import gzip
+import io
 import json
+import lzma
+import os
+import time
 from tqdm import tqdm
 
 KEEP_ALL = 'all'
 
+# compression: (file extension, function wrapping a binary file for writing)
+COMPRESSIONS = {
+    'none': ('', lambda f: f),
+    'gzip': ('.gz', lambda f: gzip.GzipFile(fileobj=f, mode='wb')),
+    'bz2': ('.bz2', lambda f: bz2.BZ2File(f, mode='wb')),
+    'xz': ('.xz', lambda f: lzma.LZMAFile(f, mode='wb')),
+}
+
+
+class LogFileWriter(object):
+    """
+    Buffered, optionally compressed, text writer for logs, with rotation by size.
+
+    Text is written in records (e.g. episodes), which are never split between two
+    files, so that every file can be read on its own. Once a file holds at least
+    ``rotate_bytes`` (compressed) bytes, the next record starts a new file:
+    ``name.ext``, then ``name.1.ext``, ``name.2.ext``, ...
+
+    :param path:
+        path of the first file. The extension of the compression is appended if
+        missing.
+    :param compression:
+        one of ``COMPRESSIONS``.
+    :param fsync_every_n_secs:
+        force the written records to disk at most this often. Disabled if <= 0.
+    :param rotate_bytes:
+        size after which to start a new file. Disabled if <= 0.
+    """
+
+    def __init__(
+        self, path, compression='none', fsync_every_n_secs=-1, rotate_bytes=-1
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                'Unknown log compression {}, choose one of {}'.format(
+                    compression, sorted(COMPRESSIONS)
+                )
+            )
+        ext, self._wrap = COMPRESSIONS[compression]
+        if ext and path.endswith(ext):
+            path = path[: -len(ext)]
+        self._base, self._ext = path, ext
+        self.fsync_every_n_secs = fsync_every_n_secs
+        self.rotate_bytes = rotate_bytes
+        self.paths = []
+        self._open()
+
+    def _open(self):
+        num = len(self.paths)
+        if num == 0:
+            path = self._base + self._ext
+        else:
+            root, ext = os.path.splitext(self._base)
+            path = '{}.{}{}{}'.format(root, num, ext, self._ext)
+        self.paths.append(path)
+        self._raw = open(path, 'wb')
+        self._compressed = self._wrap(self._raw)
+        self._text = io.TextIOWrapper(self._compressed, encoding='utf-8')
+        self._last_fsync = time.time()
+
+    def _close(self):
+        self._text.close()
+        if not self._raw.closed:
+            # compressed files don't close the file they wrap
+            self._raw.close()
+
+    def write(self, record):
+        """
+        Write a record, starting a new file first if the current one is full.
+        """
+        if self.rotate_bytes > 0 and self._raw.tell() >= self.rotate_bytes:
+            self._close()
+            self._open()
+        self._text.write(record)
+        if (
+            self.fsync_every_n_secs > 0
+            and time.time() - self._last_fsync > self.fsync_every_n_secs
+        ):
+            self.fsync()
+
+    def fsync(self):
+        """
+        Force everything written so far to disk.
+        """
+        self._text.flush()
+        self._compressed.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._last_fsync = time.time()
+
+    def close(self):
+        self._close()
+
 
 class WorldLogger:
     """
     Logs actions/observations in a world and saves in a JSONL format.
+
+    By default, episodes are kept in memory until written with ``write()``. If
+    ``outfile`` is given, each episode is instead written to it in ``file_format``
+    as soon as it is finished, so memory stays constant however long the run;
+    ``close()`` must then be called at the end.
+
+    Episodes of a batch world are logged in the order they started rather than
+    finished, so that the logs don't depend on the batch size.
     """
 
     @staticmethod
@@ -32,13 +139,50 @@ class WorldLogger:
             default=KEEP_ALL,
             help='Fields to keep when logging. Should be a comma separated list',
         )
+        agent.add_argument(
+            '--log-compression',
+            type=str,
+            default='none',
+            choices=sorted(COMPRESSIONS),
+            help='Compression of the logs written as episodes finish.',
+        )
+        agent.add_argument(
+            '--log-fsync-every-n-secs',
+            type=float,
+            default=-1,
+            help='Force the logs to disk at most this often, so they survive a '
+            'crash. Disabled if <= 0.',
+        )
+        agent.add_argument(
+            '--log-rotate-mb',
+            type=float,
+            default=-1,
+            help='Start a new log file once the current one reaches this size. '
+            'Disabled if <= 0.',
+        )
 
-    def __init__(self, opt):
+    def __init__(self, opt, outfile=None, file_format='parlai'):
         self.opt = copy.deepcopy(opt)
         self._set_keep_fields(opt)
 
         self._current_episodes = {}
+        # sub-world index -> start order of its current episode, and finished
+        # episodes waiting for earlier ones, by start order
+        self._episode_starts = {}
+        self._finished_episodes = {}
+        self._num_started = 0
+        self._num_logged = 0
         self._logs = []
+        self.file_format = file_format
+        self._writer = None
+        if outfile is not None:
+            rotate_mb = opt.get('log_rotate_mb', -1)
+            self._writer = LogFileWriter(
+                outfile,
+                compression=opt.get('log_compression', 'none'),
+                fsync_every_n_secs=opt.get('log_fsync_every_n_secs', -1),
+                rotate_bytes=int(rotate_mb * 2 ** 20) if rotate_mb > 0 else -1,
+            )
 
         self.reset()
 
@@ -47,14 +191,20 @@ class WorldLogger:
         self.keep_all = KEEP_ALL in self.keep_fields
 
     def reset(self):
-        for _, ep in self._current_episodes.items():
-            self._add_episode(ep)
-
-        self._current_episodes = {}
+        for idx in list(self._current_episodes):
+            self.reset_world(idx)
 
     def reset_world(self, idx=0):
-        self._add_episode(self._current_episodes[idx])
-        self._current_episodes[idx] = []
+        """
+        Log the current episode of a sub-world, once all earlier ones are logged.
+        """
+        if idx not in self._current_episodes:
+            return
+        start = self._episode_starts.pop(idx)
+        self._finished_episodes[start] = self._current_episodes.pop(idx)
+        while self._num_logged in self._finished_episodes:
+            self._add_episode(self._finished_episodes.pop(self._num_logged))
+            self._num_logged += 1
 
     def _add_msgs(self, acts, idx=0):
         """
@@ -62,22 +212,37 @@ class WorldLogger:
 
         :param acts: list of acts from a `.parley()` call
         """
-        msgs = []
-        for act in acts:
-            if not self.keep_all:
-                msg = {f: act[f] for f in self.keep_fields if f in act}
-            else:
-                msg = act
-            msgs.append(msg)
+        if idx not in self._current_episodes:
+            self._current_episodes[idx] = []
+            self._episode_starts[idx] = self._num_started
+            self._num_started += 1
+        self._current_episodes[idx].append(self._keep(acts))
 
-        self._current_episodes.setdefault(idx, [])
-        self._current_episodes[idx].append(msgs)
+    def _keep(self, acts):
+        """
+        Return the logged fields of the acts of a parley.
+        """
+        if self.keep_all:
+            return list(acts)
+        return [{f: act[f] for f in self.keep_fields if f in act} for act in acts]
 
     def _add_episode(self, episode):
         """
-        Add episode to the logs.
+        Add episode to the logs, or write it out if streaming.
+        """
+        if not episode:
+            return
+        if self._writer is not None:
+            self._writer.write(self.format_episode(episode, self.file_format))
+        else:
+            self._logs.append(episode)
+
+    def _is_padding(self, parley):
+        """
+        Return whether the parley only pads a batch, after its teacher ran out.
         """
-        self._logs.append(episode)
+        # exhausted teachers send messages with nothing but episode_done
+        return set(parley[0].keys()) <= {'id', 'episode_done'}
 
     def _is_batch_world(self, world):
         return isinstance(world, BatchWorld) and len(world.worlds) > 1
@@ -86,6 +251,8 @@ class WorldLogger:
         batch_act = world.get_acts()
         parleys = zip(*batch_act)
         for i, parley in enumerate(parleys):
+            if self._is_padding(parley):
+                continue
             self._add_msgs(parley, idx=i)
             if world.worlds[i].episode_done():
                 self.reset_world(idx=i)
@@ -106,6 +273,39 @@ class WorldLogger:
             # add episode to logs and clear examples
             self.reset_world()
 
+    def log_episode(self, episode):
+        """
+        Log a whole episode, given as the list of the acts of each of its parleys.
+
+        Used by worlds which run many episodes out of step, e.g.
+        ``ContinuousSelfChatWorld``.
+        """
+        self._add_episode([self._keep(parley) for parley in episode])
+
+    def append_file(self, path):
+        """
+        Write out the episodes of an uncompressed log file in this logger's format.
+
+        Used to put back together, in order, the logs of evaluation workers.
+        """
+        with open(path, encoding='utf-8') as f:
+            record = []
+            for line in f:
+                record.append(line)
+                # parlai format episodes end with a blank line
+                if self.file_format == 'jsonl' or line == '\n':
+                    self._writer.write(''.join(record))
+                    record = []
+
+    def close(self):
+        """
+        Log the unfinished episodes, and close the output file if streaming.
+        """
+        self.reset()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
     def convert_to_labeled_data(self, episode):
         out = []
         text_lst = []
@@ -128,26 +328,31 @@ class WorldLogger:
             out[-1]['episode_done'] = True
         return out
 
-    def write_parlai_format(self, outfile):
-        print('[ Saving log to {} in ParlAI format ]'.format(outfile))
+    def format_episode(self, episode, file_format='parlai'):
+        """
+        Return the text of an episode in the 'parlai' or 'jsonl' format.
+        """
+        if file_format == 'jsonl':
+            # one line per episode
+            return json.dumps({'dialog': episode}) + '\n'
+        ep = self.convert_to_labeled_data(episode)
+        return ''.join(msg_to_str(act) + '\n' for act in ep) + '\n'
+
+    def _write_logs(self, outfile, file_format):
         with open(outfile, 'w') as fw:
             for episode in tqdm(self._logs):
-                ep = self.convert_to_labeled_data(episode)
-                for act in ep:
-                    txt = msg_to_str(act)
-                    fw.write(txt + '\n')
-                fw.write('\n')
+                fw.write(self.format_episode(episode, file_format))
+
+    def write_parlai_format(self, outfile):
+        print('[ Saving log to {} in ParlAI format ]'.format(outfile))
+        self._write_logs(outfile, 'parlai')
 
     def write_jsonl_format(self, outfile):
         print('[ Saving log to {} in jsonl format ]'.format(outfile))
-        with open(outfile, 'w') as of:
-            for episode in tqdm(self._logs):
-                dialog = {'dialog': episode}
-                json_episode = json.dumps(dialog, indent=4)
-                of.write(json_episode + '\n')
+        self._write_logs(outfile, 'jsonl')
 
     def write(self, outfile, file_format='jsonl'):
-        if file_format == 'jsonl':
-            self.write_json_format(outfile)
+        if file_format in ('jsonl', 'json'):
+            self.write_jsonl_format(outfile)
         else:
             self.write_parlai_format(outfile)
@@ -6,7 +6,7 @@
 from parlai.agents.repeat_label.repeat_label import RepeatLabelAgent
 from parlai.core.worlds import create_task
 from parlai.scripts.display_data import setup_args
-from parlai.tasks.self_chat.worlds import SelfChatBaseWorld
+from parlai.tasks.self_chat.worlds import ContinuousSelfChatWorld, SelfChatBaseWorld
 
 import unittest
 from unittest.mock import MagicMock
@@ -61,6 +61,33 @@ class TestSelfChat(unittest.TestCase):
         assert_contexts_match(['you are a seal', 'you are an ostrich'])
         assert_contexts_match([])
 
+    def test_continuous(self):
+        self.world.max_turn_cnt = 3
+        self.world.get_contexts = MagicMock()
+        self.world.get_contexts.return_value = ['you are a seal', 'you are an ostrich']
+        self.world.get_openers = MagicMock()
+        self.world.get_openers.side_effect = lambda n: [['hey'], ['hey', 'hi']][n % 2]
+        self.opt['batchsize'] = 2
+        world = ContinuousSelfChatWorld(self.opt, self.world)
+
+        episodes = []
+        for _ in range(6):
+            world.parley()
+            episodes.extend(world.get_finished_episodes())
+        unfinished = world.get_unfinished_episodes()
+        # finished slots are refilled with new episodes right away
+        self.assertEqual(len(unfinished), 2)
+        self.assertEqual(len(episodes) + len(unfinished), world.episode_cnt)
+        self.assertEqual(
+            world.total_parleys, 3 * len(episodes) + sum(len(e) for e in unfinished)
+        )
+        self.assertGreaterEqual(len(episodes), 6)
+        for episode in episodes:
+            self.assertEqual(len(episode), 3)
+            texts = [a['text'] for a in episode[0]]
+            self.assertSetEqual(set(texts), {'you are a seal', 'you are an ostrich'})
+            self.assertEqual(episode[1][0]['text'], 'hey')
+
 
 if __name__ == '__main__':
     unittest.main()
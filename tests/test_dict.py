@@ -126,6 +126,131 @@ class TestDictionary(unittest.TestCase):
         assert vec[0] == num_builtin
         assert vec[1] == num_builtin + 1
 
+    def test_tokenization_cache(self):
+        """
+        Check cached vectorization matches and is invalidated on vocab changes.
+        """
+        argparser = ParlaiParser()
+        DictionaryAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args(
+            ['--dict-tokenization-cache-size', '8'], print_args=False
+        )
+        dictionary = DictionaryAgent(opt)
+        copy = DictionaryAgent(opt, dictionary.share())
+        cache = dictionary.tokenization_cache
+        self.assertIs(cache, copy.tokenization_cache)
+
+        dictionary.add_to_dict(['hello', 'world'])
+        vec = dictionary.txt2vec('hello world')
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # the copy shares the cache, and returns a fresh list every time
+        copy_vec = copy.txt2vec('hello world')
+        self.assertEqual(vec, copy_vec)
+        self.assertIsNot(vec, copy_vec)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # adding a token invalidates the cached vectors
+        dictionary.add_to_dict(['buddy'])
+        self.assertEqual(dictionary.txt2vec('hello buddy')[1], len(dictionary) - 1)
+        self.assertEqual(len(cache), 1)
+
+        # so does changing the tokenizer settings
+        dictionary.add_to_dict(['hello world'])
+        dictionary.max_ngram_size = 2
+        self.assertEqual(dictionary.txt2vec('hello world'), [len(dictionary) - 1])
+        self.assertEqual(len(cache), 1)
+        dictionary.max_ngram_size = 1
+        self.assertEqual(len(dictionary.txt2vec('hello world')), 2)
+
+        # cache is bounded by the total number of tokens
+        dictionary.txt2vec('hello world hello world hello')
+        self.assertEqual(len(cache), 1)
+        dictionary.txt2vec('world')
+        self.assertEqual(len(cache), 2)
+        dictionary.txt2vec('hello world')
+        self.assertEqual(len(cache), 2)
+
+        no_cache = DictionaryAgent(
+            argparser.parse_args(
+                ['--dict-tokenization-cache-size', '0'], print_args=False
+            )
+        )
+        self.assertIsNone(no_cache.tokenization_cache)
+
+    def test_fingerprint(self):
+        """
+        Check the fingerprint changes with the vocabulary, also for copies.
+        """
+        argparser = ParlaiParser()
+        DictionaryAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args([], print_args=False)
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict(['hello', 'hello', 'world'])
+        copy = DictionaryAgent(opt, dictionary.share())
+        fingerprint = copy.fingerprint()
+        self.assertEqual(dictionary.fingerprint(), fingerprint)
+
+        # same size, but a different vocabulary
+        dictionary.remove_tail(2)
+        dictionary.add_token('buddy')
+        self.assertIs(copy.tok2ind, dictionary.tok2ind)
+        self.assertNotEqual(copy.fingerprint(), fingerprint)
+        self.assertEqual(copy.fingerprint(), dictionary.fingerprint())
+
+        # as do tokenizer settings
+        fingerprint = dictionary.fingerprint()
+        dictionary.max_ngram_size = 2
+        self.assertNotEqual(dictionary.fingerprint(), fingerprint)
+
+    def test_compact_dict(self):
+        """
+        Check the compact dictionary loads and maps text like the text dictionary.
+        """
+        with testing_utils.tempdir() as tmpdir:
+            dict_file = os.path.join(tmpdir, 'dict')
+            argparser = ParlaiParser()
+            DictionaryAgent.add_cmdline_args(argparser)
+            opt = argparser.parse_args(['--dict-file', dict_file], print_args=False)
+            dictionary = DictionaryAgent(opt)
+            dictionary.add_to_dict(['hello', 'world', 'hello', 'tab\there', 'héllo'])
+            dictionary.save(dict_file)
+
+            text = DictionaryAgent(opt)
+            opt['dict_compact'] = True
+            compact = DictionaryAgent(opt)
+            self.assertTrue(os.path.isfile(dict_file + '.compact'))
+            self.assertNotIsInstance(compact.tok2ind, dict)
+            self.assertEqual(list(compact.tok2ind.items()), list(text.tok2ind.items()))
+            self.assertEqual(list(compact.ind2tok.items()), list(text.ind2tok.items()))
+            self.assertEqual(dict(compact.freq.items()), dict(text.freq))
+            for sentence in ['hello world', 'héllo tab\there', 'unknown words']:
+                self.assertEqual(compact.txt2vec(sentence), text.txt2vec(sentence))
+            vec = [0, 4, 5, 6, 7, 99, -1]
+            self.assertEqual(compact.vec2txt(vec), text.vec2txt(vec))
+            self.assertEqual(compact.fingerprint(), text.fingerprint())
+
+            # copies share the compact vocabulary
+            copy = DictionaryAgent(opt, compact.share())
+            self.assertIs(copy.tok2ind, compact.tok2ind)
+
+            # a changed dict file is loaded from text, and the copy rewritten
+            with open(dict_file, 'a') as f:
+                f.write('new\t1\n')
+            reloaded = DictionaryAgent(opt)
+            self.assertNotIsInstance(reloaded.tok2ind, dict)
+            self.assertEqual(reloaded['new'], len(text))
+
+            # frequencies of known tokens can be set without thawing
+            reloaded['new'] = 5
+            self.assertNotIsInstance(reloaded.tok2ind, dict)
+            self.assertEqual(reloaded.freq['new'], 5)
+
+            # adding tokens falls back to dicts
+            reloaded.add_to_dict(['newer'])
+            self.assertIsInstance(reloaded.tok2ind, dict)
+            self.assertEqual(reloaded['newer'], len(text) + 1)
+            self.assertEqual(reloaded.freq['hello'], text.freq['hello'])
+
     def test_set_model_file_without_dict_file(self):
         """
         Check that moving a model without moving the dictfile raises an error.
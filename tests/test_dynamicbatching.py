@@ -93,12 +93,15 @@ class TestDynamicBatching(unittest.TestCase):
 
 
 class TestBatchSort(unittest.TestCase):
+    DYNAMIC_BATCHING = 'batchsort'
+
     def _test_correct_processed(self, num_goal: int, **kwargs: Dict[str, Any]):
         opt = Opt({**_DEFAULT_OPTIONS, **kwargs})
-        opt['dynamic_batching'] = 'batchsort'
+        opt['dynamic_batching'] = self.DYNAMIC_BATCHING
         valid_report, test_report = testing_utils.train_model(opt)
         self.assertEqual(valid_report['exs'], num_goal)
         self.assertEqual(test_report['exs'], num_goal)
+        return valid_report
 
     def test_no_batch_act(self):
         """
@@ -148,5 +151,15 @@ class TestBatchSort(unittest.TestCase):
         self._test_correct_processed(NUM_TEST, batchsize=4)
 
 
+class TestPackedBatching(TestBatchSort):
+    DYNAMIC_BATCHING = 'packed'
+
+    def test_padding_metrics(self):
+        report = self._test_correct_processed(NUM_TEST, datatype='train')
+        self.assertGreater(report['padding_efficiency'], 0)
+        self.assertLessEqual(report['padding_efficiency'], 1)
+        self.assertGreater(report['tokens_per_batch'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 from parlai.scripts.eval_model import setup_args
 
+import os
 import unittest
 import parlai.utils.testing as testing_utils
 
@@ -167,6 +168,66 @@ class TestEvalModel(unittest.TestCase):
                     f'train:evalmode failed with bs {bs} and teacher {teacher}',
                 )
 
+    def test_num_eval_workers(self):
+        """
+        Sharded evaluation matches a single process, reports and world logs.
+        """
+        with testing_utils.tempdir() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model')
+            testing_utils.train_model(
+                dict(
+                    task='integration_tests:nocandidate',
+                    model='seq2seq',
+                    model_file=model_file,
+                    dict_file=model_file + '.dict',
+                    hiddensize=16,
+                    embeddingsize=16,
+                    batchsize=16,
+                    num_epochs=0.1,
+                    no_cuda=True,
+                )
+            )
+            for task in [
+                'integration_tests:nocandidate',
+                'integration_tests:multiturn',
+                # episodes of different lengths finish out of order
+                'integration_tests:multiturn_variable_length',
+            ]:
+                for batchsize in [1, 4]:
+                    logs = []
+                    reports = []
+                    for num_workers in [1, 3]:
+                        report_filename = os.path.join(tmpdir, f'w{num_workers}.json')
+                        valid, _ = testing_utils.eval_model(
+                            dict(
+                                task=task,
+                                model_file=model_file,
+                                batchsize=batchsize,
+                                num_eval_workers=num_workers,
+                                report_filename=report_filename,
+                                save_world_logs=True,
+                                no_cuda=True,
+                            ),
+                            skip_test=True,
+                        )
+                        reports.append(valid)
+                        with open(report_filename[:-5] + f'_{task}_replies.jsonl') as f:
+                            logs.append(f.read())
+                    single, sharded = reports
+                    self.assertEqual(single['exs'], sharded['exs'])
+                    self.assertAlmostEqual(single['loss'], sharded['loss'].value())
+                    self.assertAlmostEqual(single['f1'], sharded['f1'].value())
+                    self.assertEqual(logs[0], logs[1])
+
+        # streamed teachers can't be sharded, and are evaluated by one worker
+        valid, _ = testing_utils.eval_model(
+            dict(task='integration_tests', model='repeat_label', num_eval_workers=3),
+            skip_test=True,
+            valid_datatype='valid:stream',
+        )
+        self.assertEqual(valid['exs'], 100)
+        self.assertEqual(valid['accuracy'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
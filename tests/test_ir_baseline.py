@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import random
+import unittest
+
+from parlai.core.agents import create_agent
+from parlai.core.params import ParlaiParser
+from parlai.agents.ir_baseline.ir_baseline import rank_candidates
+import parlai.utils.testing as testing_utils
+
+
+class TestIrBaseline(unittest.TestCase):
+    """
+    Test the inverted index of the IR baseline.
+    """
+
+    def _random_text(self, rng, vocab):
+        return ' '.join(rng.choice(vocab) for _ in range(rng.randint(0, 10)))
+
+    def test_inverted_index(self):
+        rng = random.Random(42)
+        vocab = ['word{}'.format(i) for i in range(40)] + ['the', 'is', 'a']
+        cands = [self._random_text(rng, vocab) for _ in range(500)]
+        # same tokens in another order, and duplicates
+        cands += ['word1 word2 word3', 'word3 word2 word1', '', 'word1 word2 word3']
+
+        with testing_utils.tempdir() as tmpdir:
+            cands_file = os.path.join(tmpdir, 'cands.txt')
+            with open(cands_file, 'w') as f:
+                f.write('\n'.join(cands))
+            parser = ParlaiParser(True, True)
+            parser.set_params(
+                model='ir_baseline',
+                model_file=os.path.join(tmpdir, 'model'),
+                label_candidates_file=cands_file,
+            )
+            opt = parser.parse_args([], print_args=False)
+            agent = create_agent(opt)
+            self.assertEqual(len(agent.inverted_index), len(cands))
+
+            for i in range(50):
+                text = self._random_text(rng, vocab)
+                agent.observe({'text': text, 'episode_done': True})
+                reply = agent.act()
+                rep = agent.build_query_representation(text)
+                expected = rank_candidates(
+                    rep, cands, agent.length_penalty, agent.dictionary
+                )
+                self.assertEqual(reply['text_candidates'], expected)
+                if i == 25:
+                    # also with the weights of a trained dictionary
+                    for c in cands:
+                        agent.dictionary.observe({'text': c})
+                        agent.dictionary.act()
+
+            agent.save()
+            self.assertTrue(os.path.isfile(opt['model_file'] + '.index'))
+            loaded = create_agent(opt)
+            self.assertEqual(loaded.inverted_index.terms, agent.inverted_index.terms)
+            agent.observe({'text': 'word1 word3', 'episode_done': True})
+            loaded.observe({'text': 'word1 word3', 'episode_done': True})
+            self.assertEqual(
+                agent.act()['text_candidates'], loaded.act()['text_candidates']
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,10 +6,33 @@
 
 import unittest
 
+import multiprocessing
 import torch
 import random
-
-from parlai.core.metrics import AverageMetric, SumMetric, FixedMetric, Metrics
+import threading
+
+from parlai.core.message import Message
+from parlai.core.metrics import (
+    AverageMetric,
+    BleuMetric,
+    ExactMatchMetric,
+    SumMetric,
+    FixedMetric,
+    F1Metric,
+    Metrics,
+    TeacherMetrics,
+    compute_text_metrics,
+)
+
+
+def _add_metrics(shared, n):
+    m = Metrics(threadsafe=True, shared=shared)
+    for i in range(n):
+        m.add('exs', SumMetric(1))
+        m.add('loss', AverageMetric(0.5, 1))
+        m.add('f1', F1Metric(i % 2, 1))
+        m.add('fixed', FixedMetric(3))
+        m.flush()
 
 
 class TestMetric(unittest.TestCase):
@@ -172,6 +195,118 @@ class TestMetrics(unittest.TestCase):
 
         assert m.report()['key'] == 32768 + 1
 
+    def test_multiprocess(self):
+        m = Metrics(threadsafe=True, num_workers=4)
+        m.add('exs', SumMetric(2))
+        procs = [
+            multiprocessing.Process(target=_add_metrics, args=(m.share(), 100))
+            for _ in range(4)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        report = m.report()
+        self.assertEqual(report['exs'], 402)
+        self.assertIsInstance(report['exs'].value(), int)
+        self.assertEqual(report['loss'], 0.5)
+        self.assertIsInstance(report['f1'], F1Metric)
+        self.assertEqual(report['f1'], 0.5)
+        # metrics which can't be summed still go through the queue
+        self.assertEqual(report['fixed'], 3)
+
+        m.clear()
+        self.assertEqual(m.report(), {})
+        _add_metrics(m.share(), 10)
+        report = m.report()
+        self.assertEqual(report['exs'], 10)
+        self.assertEqual(set(report), {'exs', 'loss', 'f1', 'fixed'})
+
+    def test_more_processes_than_workers(self):
+        m = Metrics(threadsafe=True, num_workers=1)
+        procs = [
+            multiprocessing.Process(target=_add_metrics, args=(m.share(), 10))
+            for _ in range(3)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        # processes without a row of slots fall back to the queue
+        self.assertEqual(m.report()['exs'], 30)
+
+    def test_report_while_registering(self):
+        m = Metrics(threadsafe=True, num_workers=1)
+        m2 = Metrics(threadsafe=True, shared=m.share())
+
+        def register():
+            for i in range(500):
+                m2.add(f'key{i}', SumMetric(1))
+                m2.flush()
+
+        thread = threading.Thread(target=register)
+        thread.start()
+        while thread.is_alive():
+            report = m.report()
+            self.assertTrue(all(value == 1 for value in report.values()))
+        thread.join()
+        report = m.report()
+        self.assertEqual(len(report), 500)
+        self.assertIsInstance(report['key0'], SumMetric)
+
+
+class TestTextMetrics(unittest.TestCase):
+    """
+    Test the batched computation of text metrics.
+    """
+
+    def _random_text(self, rng):
+        words = ['the', 'a', 'cat', 'sat', 'on', 'mat', ',', '!', "don't", 'The']
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+
+    def test_identical_to_metrics(self):
+        rng = random.Random(0)
+        guesses = [self._random_text(rng) for _ in range(300)]
+        answers = [
+            [self._random_text(rng) for _ in range(rng.randint(1, 3))]
+            for _ in range(300)
+        ]
+        metrics_list = {'bleu-1', 'bleu-2', 'bleu-3', 'bleu-4'}
+        results = compute_text_metrics(guesses, answers, metrics_list)
+        for guess, labels, result in zip(guesses, answers, results):
+            expected = {
+                'accuracy': ExactMatchMetric.compute(guess, labels),
+                'f1': F1Metric.compute(guess, labels),
+            }
+            for k in range(1, 5):
+                bleu = BleuMetric.compute(guess, labels, k)
+                if bleu is not None:
+                    expected[f'bleu-{k}'] = bleu
+            self.assertEqual(set(result), set(expected))
+            for key, value in expected.items():
+                self.assertIs(type(result[key]), type(value))
+                self.assertEqual(result[key].value(), value.value())
+
+    def test_precompute_batch(self):
+        teacher_metrics = [TeacherMetrics(metrics_list='all') for _ in range(2)]
+        TeacherMetrics.precompute_batch(
+            teacher_metrics, ['the cat', 'a dog'], [['cat'], ['dog', 'cat']]
+        )
+        self.assertIsNotNone(teacher_metrics[0]._precomputed)
+        for m, text, labels in zip(
+            teacher_metrics, ['the cat', 'a dog'], [['cat'], ['dog', 'cat']]
+        ):
+            m.evaluate_response(Message({'text': text}), labels)
+            self.assertIsNone(m._precomputed)
+            self.assertEqual(m.report()['accuracy'], 1)
+
+        # a precomputed result for another response is not used
+        m = TeacherMetrics()
+        TeacherMetrics.precompute_batch([m], ['cat'], [['cat']])
+        m.evaluate_response(Message({'text': 'dog'}), ['cat'])
+        self.assertEqual(m.report()['accuracy'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
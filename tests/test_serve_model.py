@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import threading
+import unittest
+import urllib.request
+
+import parlai.utils.testing as testing_utils
+from parlai.scripts.serve_model import setup_args, build_server
+
+
+class TestServeModel(unittest.TestCase):
+    """
+    Test the multi-session model server.
+    """
+
+    def _request(self, port, path, data=None):
+        url = 'http://localhost:{}{}'.format(port, path)
+        if data is not None:
+            data = bytes(json.dumps(data), 'utf-8')
+        with urllib.request.urlopen(url, data=data) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def test_sessions(self):
+        with testing_utils.tempdir() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model')
+            testing_utils.train_model(
+                dict(
+                    task='integration_tests:nocandidate',
+                    model='seq2seq',
+                    model_file=model_file,
+                    dict_file=model_file + '.dict',
+                    hiddensize=16,
+                    embeddingsize=16,
+                    batchsize=16,
+                    num_epochs=0.1,
+                )
+            )
+            parser = setup_args()
+            parser.set_params(
+                model_file=model_file, port=0, max_wait_ms=200, max_batchsize=8
+            )
+            opt = parser.parse_args([], print_args=False)
+            httpd = build_server(opt)
+            port = httpd.server_address[1]
+            thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+            thread.start()
+
+            try:
+                replies = {}
+
+                def interact(i):
+                    replies[i] = self._request(
+                        port, '/interact', {'session_id': str(i), 'text': str(i)}
+                    )
+
+                threads = [
+                    threading.Thread(target=interact, args=(i,)) for i in range(8)
+                ]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+                for i in range(8):
+                    self.assertEqual(replies[i]['session_id'], str(i))
+                    self.assertIn('text', replies[i])
+                    # each session only saw its own messages
+                    history = httpd.batcher.sessions.get(str(i)).history
+                    self.assertEqual(history.history_strings[0], str(i))
+
+                stats = self._request(port, '/stats')
+                self.assertEqual(stats['num_requests'], 8)
+                # concurrent requests were answered together
+                self.assertLess(stats['num_batches'], 8)
+                self.assertIn('latency_p99_ms', stats)
+
+                self._request(port, '/reset', {'session_id': '0'})
+                history = httpd.batcher.sessions.get('0').history
+                self.assertEqual(history.history_strings, [])
+
+                # a new session is created when none is given
+                reply = self._request(port, '/interact', {'text': 'hi'})
+                self.assertNotIn(reply['session_id'], map(str, range(8)))
+
+                health = self._request(port, '/health')
+                self.assertEqual(health['status'], 'ok')
+                self.assertEqual(health['sessions'], 9)
+            finally:
+                httpd.shutdown()
+                httpd.batcher.shutdown()
+                httpd.server_close()
+
+    def test_session_eviction(self):
+        parser = setup_args()
+        parser.set_params(model='repeat_query', port=0, max_sessions=2)
+        opt = parser.parse_args([], print_args=False)
+        httpd = build_server(opt)
+        port = httpd.server_address[1]
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            for i in range(3):
+                reply = self._request(
+                    port, '/interact', {'session_id': str(i), 'text': 'hi'}
+                )
+                self.assertEqual(reply['text'], 'hi')
+            sessions = httpd.batcher.sessions
+            self.assertEqual(len(sessions), 2)
+            self.assertNotIn('0', sessions)
+        finally:
+            httpd.shutdown()
+            httpd.batcher.shutdown()
+            httpd.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
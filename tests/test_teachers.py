@@ -10,9 +10,12 @@ A module for testing various teacher types in ParlAI
 """
 
 import os
+import threading
+import time
 import unittest
 from parlai.utils import testing as testing_utils
 import regex as re
+from parlai.core.teachers import ChunkTeacher, CompiledDialogData
 
 
 class TestAbstractImageTeacher(unittest.TestCase):
@@ -57,5 +60,194 @@ class TestAbstractImageTeacher(unittest.TestCase):
         self._test_display_output('resnet152')
 
 
+class TestCompiledDialogData(unittest.TestCase):
+    """
+    Test that compiled, memory-mapped data matches the in-memory data.
+    """
+
+    def _teachers(self, task, **kwargs):
+        from parlai.core.params import ParlaiParser
+        from parlai.core.teachers import create_task_agent_from_taskname
+
+        with testing_utils.tempdir() as tmpdir:
+            parser = ParlaiParser()
+            parser.set_params(task=task, datatype='valid', datapath=tmpdir, **kwargs)
+            opt = parser.parse_args([], print_args=False)
+            plain = create_task_agent_from_taskname(opt)[0]
+            opt['compiled_data'] = True
+            compiled = create_task_agent_from_taskname(opt)[0]
+            yield plain, compiled
+
+    def _compare(self, task):
+        for plain, compiled in self._teachers(task):
+            self.assertIsInstance(compiled.data, CompiledDialogData)
+            self.assertEqual(plain.num_episodes(), compiled.num_episodes())
+            self.assertEqual(plain.num_examples(), compiled.num_examples())
+            for _ in range(plain.num_examples()):
+                plain_act = plain.act()
+                compiled_act = compiled.act()
+                self.assertEqual(dict(plain_act), dict(compiled_act))
+            self.assertTrue(compiled.epoch_done())
+
+    def test_single_turn(self):
+        self._compare('integration_tests:candidate')
+
+    def test_multiturn(self):
+        self._compare('integration_tests:multiturn')
+
+    def test_shared(self):
+        for _, compiled in self._teachers('integration_tests:multiturn'):
+            copy = type(compiled)(compiled.opt, compiled.share())
+            self.assertEqual(compiled.num_examples(), copy.num_examples())
+            self.assertEqual(compiled.get(3, 2), copy.get(3, 2))
+
+    def test_token_ids(self):
+        from parlai.core.dict import DictionaryAgent
+        from parlai.core.torch_agent import History
+
+        for _, compiled in self._teachers('integration_tests:multiturn'):
+            dict_agent = DictionaryAgent(compiled.opt)
+            for text in ['1 2 3 4 5 6 7 8 9 10', '11 12']:
+                dict_agent.add_to_dict(dict_agent.tokenize(text))
+            compiled.compile_data(dict_agent)
+            # new teachers load the recompiled data
+            compiled = type(compiled)(compiled.opt)
+            example = compiled.get(0, 1)
+            self.assertEqual(
+                list(example['text_token_ids']), dict_agent.txt2vec(example['text'])
+            )
+
+            history = History(compiled.opt, dict_agent=dict_agent)
+            history.update_history(example)
+            self.assertEqual(
+                list(history.get_history_vec()), dict_agent.txt2vec(example['text'])
+            )
+            # ids from a different dictionary are ignored
+            dict_agent.add_token('unseen')
+            history.reset()
+            example['text_token_ids'] = example['text_token_ids'][:0]
+            history.update_history(example)
+            self.assertEqual(
+                list(history.get_history_vec()), dict_agent.txt2vec(example['text'])
+            )
+
+    def test_compiled_data_path(self):
+        for _, compiled in self._teachers('integration_tests:multiturn'):
+            # options of other agents don't change the compiled data
+            path = compiled.compiled_data_path()
+            compiled.opt['batchsize'] = 7
+            self.assertEqual(compiled.compiled_data_path(), path)
+
+            # but those of the teacher do
+            class OptionTeacher(type(compiled)):
+                @classmethod
+                def add_cmdline_args(cls, argparser):
+                    argparser.add_argument('--toy-option', type=int, default=0)
+
+            opt = compiled.opt.copy()
+            opt['toy_option'] = 0
+            teacher = OptionTeacher(opt)
+            self.assertEqual(teacher.compiled_data_opt_keys(), ['toy_option'])
+            path = teacher.compiled_data_path()
+            teacher.opt['toy_option'] = 1
+            self.assertNotEqual(teacher.compiled_data_path(), path)
+
+
+class _ToyChunkTeacher(ChunkTeacher):
+    """
+    Chunk teacher over 8 chunks of 50 samples, some slower to load than others.
+    """
+
+    def __init__(self, opt, shared=None, num_interleave_chunks=1, buffersize=100000):
+        self._num_interleave_chunks = num_interleave_chunks
+        self._buffersize = buffersize
+        super().__init__(opt, shared)
+
+    def get_buffersize(self):
+        return self._buffersize
+
+    def get_num_samples(self, datatype):
+        return 400, 400
+
+    def get_fold_chunks(self, datatype):
+        return list(range(8))
+
+    def get_num_interleave_chunks(self):
+        return self._num_interleave_chunks
+
+    def load_from_chunk(self, chunk_idx):
+        # make later chunks finish loading first
+        time.sleep(0.01 * (8 - chunk_idx))
+        return [(chunk_idx, i) for i in range(50)]
+
+    def create_message(self, queue_output):
+        chunk_idx, i = queue_output
+        return {'text': '{} {}'.format(chunk_idx, i), 'episode_done': True}
+
+
+class TestChunkTeacher(unittest.TestCase):
+    def _samples(self, datatype='valid:stream', num=400, buffersize=100000, **kwargs):
+        from parlai.core.params import ParlaiParser
+
+        parser = ParlaiParser()
+        parser.set_params(datatype=datatype, datafile='unused', **kwargs)
+        opt = parser.parse_args([], print_args=False)
+        teacher = _ToyChunkTeacher(
+            opt,
+            num_interleave_chunks=kwargs.get('num_load_threads', 1),
+            buffersize=buffersize,
+        )
+        return teacher, [teacher.act()['text'] for _ in range(num)]
+
+    def test_parallel_order(self):
+        teacher, serial = self._samples()
+        self.assertEqual(len(set(serial)), 400)
+        # each chunk is loaded in turn
+        self.assertEqual({text.split()[0] for text in serial[:50]}, {'0'})
+        self.assertTrue(teacher.epoch_done())
+
+        teacher, parallel = self._samples(num_load_threads=4)
+        self.assertEqual(sorted(parallel), sorted(serial))
+        # interleaved chunks mix, the same way every time
+        self.assertEqual({text.split()[0] for text in parallel[:50]}, set('0123'))
+        self.assertEqual(self._samples(num_load_threads=4)[1], parallel)
+
+        report = teacher.report()
+        self.assertGreater(report['load_exs_per_sec'].value(), 0)
+        for key in ['chunk_load_ms', 'load_stalls', 'buffer_fill']:
+            self.assertIn(key, report)
+
+    def test_reset(self):
+        teacher, first = self._samples(num=10, num_load_threads=4)
+        teacher.reset()
+        self.assertEqual([teacher.act()['text'] for _ in range(400)][:10], first)
+
+    def test_train(self):
+        teacher, samples = self._samples('train:stream', num=1000, num_load_threads=2)
+        # training loops over the chunks forever
+        self.assertEqual(len(set(samples)), 400)
+
+    def test_report_full_buffer(self):
+        teacher, _ = self._samples(
+            'train:stream', num=5, num_load_threads=2, buffersize=20
+        )
+        # wait for the loader to fill the buffer
+        deadline = time.time() + 10
+        while not teacher.samples._space_requested and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(teacher.samples._space_requested)
+
+        reports = []
+        thread = threading.Thread(
+            target=lambda: reports.append(teacher.report()), daemon=True
+        )
+        thread.start()
+        thread.join(10)
+        self.assertEqual(len(reports), 1, 'report() blocked on the full buffer')
+        self.assertGreater(reports[0]['buffer_fill'].value(), 1)
+        # the loader resumes once samples are consumed
+        self.assertEqual(len({teacher.act()['text'] for _ in range(300)}), 300)
+
+
 if __name__ == '__main__':
     unittest.main()
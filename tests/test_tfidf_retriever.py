@@ -8,8 +8,11 @@ from parlai.core.params import ParlaiParser
 from parlai.core.agents import create_agent
 from parlai.core.worlds import create_task
 from parlai.utils.logging import logger, ERROR
+import parlai.utils.testing as testing_utils
 
+import numpy as np
 import os
+import shutil
 import unittest
 
 SKIP_TESTS = False
@@ -84,6 +87,133 @@ class TestTfidfRetriever(unittest.TestCase):
                 os.remove(DB_PATH)
             if os.path.exists(TFIDF_PATH + '.npz'):
                 os.remove(TFIDF_PATH + '.npz')
+            if os.path.exists(TFIDF_PATH + '.counts'):
+                shutil.rmtree(TFIDF_PATH + '.counts')
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_sharded_build_and_append(self):
+        from parlai.agents.tfidf_retriever import build_tfidf, utils
+
+        # keep things quiet
+        logger.setLevel(ERROR)
+        with testing_utils.tempdir() as tmpdir:
+            parser = ParlaiParser(True, True)
+            parser.set_defaults(
+                model='tfidf_retriever',
+                task='integration_tests',
+                model_file=os.path.join(tmpdir, 'model'),
+                retriever_numworkers=2,
+                retriever_hashsize=2 ** 8,
+                retriever_shard_size=100,
+                datatype='train:ordered',
+                num_epochs=1,
+            )
+            opt = parser.parse_args([], print_args=False)
+            agent = create_agent(opt)
+            train_world = create_task(opt, agent)
+            while not train_world.epoch_done():
+                train_world.parley()
+            agent.save()
+
+            shard_dir = build_tfidf.get_shard_dir(agent.tfidf_path)
+            num_shards = len(os.listdir(shard_dir)) - 1  # minus the manifest
+            self.assertGreater(num_shards, 1)
+
+            # the merged matrix matches the in-memory build
+            tfidf, _ = utils.load_sparse_csr(agent.tfidf_path)
+            count_matrix = build_tfidf.get_count_matrix(
+                agent.tfidf_args, {'db_path': agent.db_path}
+            )
+            expected = build_tfidf.get_tfidf_matrix(count_matrix)
+            expected.sort_indices()
+            self.assertTrue(np.array_equal(tfidf.indptr, expected.indptr))
+            self.assertTrue(np.array_equal(tfidf.indices, expected.indices))
+            self.assertTrue(np.array_equal(tfidf.data, expected.data))
+
+            # new documents are counted in a new shard
+            ANS = 'The one true label.'
+            new_example = {
+                'text': 'A bunch of new words that are not in the other task.',
+                'labels': [ANS],
+                'episode_done': True,
+            }
+            agent.observe(new_example)
+            agent.act()
+            new_example.pop('labels')
+            agent.observe(new_example)
+            reply = agent.act()
+            self.assertEqual(reply['text'], ANS)
+            self.assertEqual(len(os.listdir(shard_dir)) - 1, num_shards + 1)
+            self.assertFalse(os.path.isfile(os.path.join(shard_dir, 'merged.data.npy')))
+
+            # a damaged earlier shard makes the next append count everything again
+            first_shard = os.path.join(shard_dir, 'shard-00000.npz')
+            with open(first_shard, 'rb') as f:
+                intact = f.read()
+            with open(first_shard, 'r+b') as f:
+                f.seek(-4, os.SEEK_END)
+                f.write(b'\0\0\0\0')
+            manifest = build_tfidf.build_count_shards(
+                agent.tfidf_args, {'db_path': agent.db_path}, shard_dir
+            )
+            with open(first_shard, 'rb') as f:
+                self.assertEqual(f.read(), intact)
+            self.assertEqual(
+                sum(shard['num_docs'] for shard in manifest['shards']),
+                manifest['num_docs'],
+            )
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_batch_act(self):
+        # keep things quiet
+        logger.setLevel(ERROR)
+        with testing_utils.tempdir() as tmpdir:
+            parser = ParlaiParser(True, True)
+            parser.set_defaults(
+                model='tfidf_retriever',
+                task='integration_tests',
+                model_file=os.path.join(tmpdir, 'model'),
+                retriever_numworkers=2,
+                retriever_hashsize=2 ** 8,
+                datatype='train:ordered',
+                num_epochs=1,
+            )
+            opt = parser.parse_args([], print_args=False)
+            agent = create_agent(opt)
+            train_world = create_task(opt, agent)
+            while not train_world.epoch_done():
+                train_world.parley()
+            agent.save()
+
+            texts = ['1 2 3 4', '5 6 7 8', '1 2 3 4', '9 8 7 6', 'the of']
+            observations = [{'text': t, 'episode_done': True} for t in texts]
+            observations.append({'episode_done': True})
+            replies = agent.batch_act(observations)
+            self.assertEqual(len(replies), len(observations))
+            self.assertNotIn('text', replies[-1])
+            for obs, reply in zip(observations[:-2], replies):
+                # same docs as one sparse product per query
+                ranker = agent.ranker
+                res = ranker.text2spvec(obs['text']) * ranker.doc_mat
+                doc_ids, scores = ranker._topk(res.data, res.indices, 5)
+                self.assertEqual(
+                    reply['text_candidates'],
+                    [agent.db.get_doc_value(int(d)) for d in doc_ids],
+                )
+                self.assertTrue(np.array_equal(reply['candidate_scores'], scores))
+                # and as acting one observation at a time
+                agent.observe(obs)
+                self.assertEqual(agent.act()['text'], reply['text'])
+            # a query without valid words gets a generic response
+            self.assertIn('text', replies[-2])
+            self.assertNotIn('text_candidates', replies[-2])
+
+            # repeated queries are cached
+            self.assertIn(('1 2 3 4', 5), agent.ranker._cache)
+            # and can't be corrupted by callers
+            doc_ids, _ = agent.ranker.closest_docs('1 2 3 4', k=5)
+            with self.assertRaises(ValueError):
+                doc_ids[0] = -1
 
 
 if __name__ == '__main__':
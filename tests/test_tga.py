@@ -8,10 +8,16 @@ Test TorchGeneratorAgent.
 """
 
 import unittest
+import torch
 from parlai.core.agents import create_agent
 import parlai.utils.testing as testing_utils
 from parlai.core.params import ParlaiParser
-from parlai.core.torch_generator_agent import TorchGeneratorAgent
+from parlai.core.torch_agent import Batch
+from parlai.core.torch_generator_agent import (
+    TorchGeneratorAgent,
+    BeamSearch,
+    GreedySearch,
+)
 
 
 class TestUpgradeOpt(unittest.TestCase):
@@ -79,5 +85,117 @@ class TestUpgradeOpt(unittest.TestCase):
         self.assertEqual(agent.opt['inference'], 'beam')
 
 
+class _LegacyContextAgent(TorchGeneratorAgent):
+    """
+    Agent overriding the per example beam context.
+    """
+
+    NULL_IDX = 0
+
+    def build_model(self):
+        pass
+
+    def _get_context(self, batch, batch_idx):
+        return batch.text_vec[batch_idx][: batch_idx + 1]
+
+
+class TestBatchContext(unittest.TestCase):
+    def test_get_context_override(self):
+        """
+        Overrides of _get_context are still used for context blocking.
+        """
+        batch = Batch(text_vec=torch.LongTensor([[3, 4, 5], [6, 7, 8]]))
+        # skip building a model, only the context is needed
+        agent = _LegacyContextAgent.__new__(_LegacyContextAgent)
+        self.assertEqual(
+            agent._get_batch_context(batch).tolist(), [[3, 0], [6, 7]],
+        )
+
+
+class TestTreeSearch(unittest.TestCase):
+    """
+    Test the batched tree search.
+    """
+
+    def _run(self, search, steps, logprobs_fn):
+        for _ in range(steps):
+            if search.is_done():
+                break
+            prefixes = search.partial_hyps
+            search.advance(logprobs_fn(prefixes))
+        return search.get_rescored_finished()
+
+    def _logprobs(self, prefixes, vocab=10):
+        # deterministic scores which depend on each hypothesis' prefix
+        out = []
+        for prefix in prefixes.view(-1, prefixes.size(-1)).tolist():
+            gen = torch.Generator().manual_seed(hash(tuple(prefix)) % 2 ** 31)
+            out.append(torch.randn(vocab, generator=gen) * 3)
+        out = torch.stack(out).view(*prefixes.shape[:2], vocab)
+        return torch.log_softmax(out, dim=-1)
+
+    def test_batch_matches_single(self):
+        """
+        Searching a batch at once gives the same result as one sample at a time.
+        """
+        context = torch.LongTensor([[3, 4, 5, 6], [7, 8, 3, 4], [5, 5, 5, 5]])
+        kwargs = dict(
+            min_length=2, block_ngram=2, context_block_ngram=2, length_penalty=0.65
+        )
+        batched = self._run(
+            BeamSearch(3, batchsize=3, **kwargs).set_context(context),
+            12,
+            self._logprobs,
+        )
+        for i in range(3):
+            single = self._run(
+                BeamSearch(3, batchsize=1, **kwargs).set_context(context[i : i + 1]),
+                12,
+                self._logprobs,
+            )[0]
+            self.assertEqual(len(single), len(batched[i]))
+            for (pred1, score1), (pred2, score2) in zip(single, batched[i]):
+                self.assertEqual(pred1.tolist(), pred2.tolist())
+                self.assertAlmostEqual(score1.item(), score2.item(), places=4)
+
+    def test_min_length_and_blocking(self):
+        """
+        Predictions respect the minimum length and never repeat blocked ngrams.
+        """
+        context = torch.LongTensor([[3, 4], [6, 7]])
+        search = BeamSearch(
+            4, batchsize=2, min_length=3, block_ngram=1, context_block_ngram=1
+        ).set_context(context)
+        n_best_lists = self._run(search, 8, self._logprobs)
+        for n_best, sample_context in zip(n_best_lists, context.tolist()):
+            for pred, _ in n_best:
+                tokens = pred.tolist()
+                self.assertEqual(tokens[0], 1)
+                self.assertEqual(tokens[-1], 2)
+                self.assertGreaterEqual(len(tokens) - 1, 3)
+                self.assertEqual(len(set(tokens)), len(tokens))
+                self.assertTrue(set(tokens).isdisjoint(sample_context))
+
+    def test_greedy(self):
+        """
+        Greedy search always picks the most likely token.
+        """
+        logprobs = torch.log_softmax(torch.randn(2, 1, 10), dim=-1)
+        logprobs[:, :, 2] = -1e20
+        logprobs[0, 0, 7] = 0.0
+        logprobs[1, 0, 5] = 0.0
+        search = GreedySearch(1, batchsize=2, min_length=0)
+        search.advance(logprobs.clone())
+        self.assertEqual(search.get_output_from_current_step().tolist(), [7, 5])
+        self.assertEqual(search.get_backtrack_from_current_step().tolist(), [0, 1])
+        self.assertFalse(search.is_done())
+        eos = torch.full((2, 1, 10), -1e20)
+        eos[:, :, 2] = 0.0
+        search.advance(eos)
+        self.assertTrue(search.is_done())
+        preds = [n_best[0][0].tolist() for n_best in search.get_rescored_finished()]
+        self.assertEqual(preds, [[1, 7, 2], [1, 5, 2]])
+
+
 if __name__ == '__main__':
     unittest.main()
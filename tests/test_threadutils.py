@@ -3,8 +3,10 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
-from parlai.utils.thread import SharedTable
+from parlai.utils.thread import SharedTable, SharedArrays, memory_usage
 from multiprocessing import Process
+import multiprocessing
+import numpy as np
 import parlai.utils.testing as testing_utils
 import unittest
 import random
@@ -107,5 +109,62 @@ class TestSharedTable(unittest.TestCase):
             assert len(st) == 1
 
 
+def _double(arrays):
+    arrays['matrix'][...] *= 2
+
+
+@testing_utils.skipIfGPU
+class TestSharedArrays(unittest.TestCase):
+    """
+    Check that arrays are shared between processes.
+    """
+
+    def test_numpy(self):
+        arrays = SharedArrays()
+        matrix = arrays.register(
+            'matrix', np.arange(12, dtype=np.float32).reshape(3, 4)
+        )
+        empty = arrays.register('empty', np.zeros((0, 2)))
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertEqual(empty.shape, (0, 2))
+        self.assertEqual(arrays.nbytes, 48)
+        self.assertEqual(set(arrays), {'matrix', 'empty'})
+        with self.assertRaises(KeyError):
+            arrays.register('matrix', np.zeros(1))
+
+        p = Process(target=_double, args=(arrays,))
+        p.start()
+        p.join()
+        # the child wrote to the same memory
+        self.assertEqual(matrix[2, 3], 22)
+
+        # spawned processes get the arrays pickled, and attach to the same buffers
+        p = multiprocessing.get_context('spawn').Process(target=_double, args=(arrays,))
+        p.start()
+        p.join()
+        self.assertEqual(matrix[2, 3], 44)
+
+    def test_torch(self):
+        try:
+            import torch
+        except ImportError:
+            # pass by default if no torch available
+            return
+
+        arrays = SharedArrays()
+        tensor = arrays.register('tensor', torch.zeros(4))
+        self.assertTrue(tensor.is_shared())
+        self.assertIs(arrays['tensor'], tensor)
+        self.assertEqual(arrays.nbytes, 16)
+
+    def test_memory_usage(self):
+        usage = memory_usage()
+        if usage is None:
+            # not available on this platform
+            return
+        self.assertGreater(usage['resident'], 0)
+        self.assertLessEqual(usage['shared'], usage['resident'])
+
+
 if __name__ == '__main__':
     unittest.main()
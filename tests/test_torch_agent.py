@@ -10,6 +10,7 @@ Unit tests for TorchAgent.
 
 import os
 import unittest
+from unittest.mock import patch
 from parlai.core.agents import create_agent_from_shared
 from parlai.utils.testing import tempdir
 from parlai.utils.misc import Message
@@ -741,6 +742,32 @@ class TestTorchAgent(unittest.TestCase):
         text = agent.history.get_history_str()
         self.assertEqual(text, 'I am Groot. Groot! I am Groot.')
 
+    def test_history_tensor(self):
+        """
+        Make sure the history tensor matches the vectorized history, truncated.
+        """
+        for history_size, truncate in [(-1, 10), (-1, 1), (2, 10), (3, 100)]:
+            agent = get_agent(history_size=history_size, text_truncate=truncate)
+            history = agent.history
+            self.assertIsNone(history.get_history_tensor(truncate))
+            tensors = []
+            for i in range(8):
+                history.update_history({'text': 'I am Groot. ' * i})
+                history.add_reply('I am Groot?')
+                vec = list(history.get_history_vec())[-truncate:]
+                tensor = history.get_history_tensor(truncate)
+                self.assertEqual(tensor.tolist(), vec)
+                tensors.append((tensor, vec))
+            # earlier tensors are left untouched
+            for tensor, vec in tensors:
+                self.assertEqual(tensor.tolist(), vec)
+            history.reset()
+            self.assertIsNone(history.get_history_tensor(truncate))
+
+            obs = agent.observe({'text': 'I am Groot.', 'episode_done': False})
+            vec = list(agent.history.get_history_vec())[-truncate:]
+            self.assertEqual(obs['text_vec'].tolist(), vec)
+
     def test_observe(self):
         """
         Make sure agent stores and returns observation.
@@ -1013,3 +1040,86 @@ class TestTorchAgent(unittest.TestCase):
             init_model_file, is_finetune = agent._get_init_model(popt, None)
             self.assertEqual(init_model_file, '{}.checkpoint'.format(mf))
             self.assertFalse(is_finetune)
+
+
+@unittest.skipIf(SKIP_TESTS, "Torch not installed.")
+class TestBatchPrefetch(unittest.TestCase):
+    """
+    Check that prefetched batches match the ones built synchronously.
+    """
+
+    def _run(self, task='integration_tests:multiturn', multitask=False, **kwargs):
+        from parlai.core.teachers import MultiTaskTeacher
+        from parlai.core.worlds import BatchWorld, DialogPartnerWorld, create_task
+
+        agent = get_agent(task=task, datatype='train:ordered', batchsize=4, **kwargs,)
+        text_vecs = []
+        train_step = agent.train_step
+
+        def recording_train_step(batch):
+            text_vecs.append(batch.text_vec.tolist())
+            return train_step(batch)
+
+        agent.train_step = recording_train_step
+        if multitask:
+            # a single world whose teacher switches between tasks
+            teacher = MultiTaskTeacher(agent.opt)
+            world = BatchWorld(
+                agent.opt, DialogPartnerWorld(agent.opt, [teacher, agent])
+            )
+        else:
+            world = create_task(agent.opt, agent)
+        # the replies observed by each copy of the model
+        self_observed = [[] for _ in world.worlds]
+        for i, w in enumerate(world.worlds):
+            copy = w.get_agents()[1]
+            self_observe = copy.self_observe
+
+            def recording_self_observe(msg, i=i, self_observe=self_observe):
+                self_observed[i].append(dict(msg))
+                return self_observe(msg)
+
+            copy.self_observe = recording_self_observe
+        for _ in range(30):
+            world.parley()
+        report = world.report()
+        world.shutdown()
+        self.self_observed = self_observed
+        return world, text_vecs, report
+
+    def test_prefetch_matches(self):
+        _, expected_vecs, expected_report = self._run()
+        expected_self_observed = self.self_observed
+        world, text_vecs, report = self._run(batch_prefetch=3)
+        self.assertIsNotNone(world.prefetcher)
+        self.assertEqual(text_vecs, expected_vecs)
+        # the copies observe the real replies, the last one before the next act
+        for observed, expected in zip(self.self_observed, expected_self_observed):
+            self.assertEqual(observed, expected[: len(observed)])
+            self.assertGreaterEqual(len(observed), len(expected) - 1)
+        for key in ['exs', 'accuracy', 'f1']:
+            self.assertEqual(report[key], expected_report[key])
+        self.assertIn('prefetch_queue_depth', report)
+        self.assertIn('prefetch_stall_secs', report)
+
+    def test_prefetch_multitask(self):
+        task = 'integration_tests:multiturn,integration_tests:candidate'
+        _, expected_vecs, expected_report = self._run(task, multitask=True)
+        world, text_vecs, report = self._run(task, multitask=True, batch_prefetch=3)
+        self.assertIsNotNone(world.prefetcher)
+        self.assertEqual(text_vecs, expected_vecs)
+        # replies are scored by the sub-teacher which asked them
+        for t in task.split(','):
+            for key in ['exs', 'accuracy', 'f1']:
+                self.assertEqual(report[f'{t}/{key}'], expected_report[f'{t}/{key}'])
+
+    def test_prefetch_unsupported(self):
+        from parlai.core.teachers import FixedDialogTeacher
+
+        world, _, _ = self._run(batch_prefetch=3, use_reply='model')
+        self.assertIsNone(world.prefetcher)
+
+        # teachers have to opt in
+        with patch.object(FixedDialogTeacher, 'supports_prefetch', False):
+            world, _, _ = self._run(batch_prefetch=3)
+        self.assertIsNone(world.prefetcher)
@@ -133,6 +133,117 @@ class _AbstractTRATest(unittest.TestCase):
             valid, test = testing_utils.train_model(args)
             self.assertGreaterEqual(valid['hits@100'], 0.1)
 
+    # test eval fixed ecands retrieved from a candidate index
+    @testing_utils.retry(ntries=3)
+    def test_eval_fixed_candidate_index(self):
+        args = self._get_args()
+        args['eval_candidates'] = 'fixed'
+
+        teacher = CandidateTeacher({'datatype': 'train'})
+        all_cands = teacher.train + teacher.val + teacher.test
+        all_cands_str = '\n'.join([' '.join(x) for x in all_cands])
+
+        with testing_utils.tempdir() as tmpdir:
+            tmp_cands_file = os.path.join(tmpdir, 'all_cands.text')
+            with open(tmp_cands_file, 'w') as f:
+                f.write(all_cands_str)
+            args['fixed_candidates_path'] = tmp_cands_file
+            args['encode_candidate_vecs'] = False  # don't encode before training
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['dict_file'] = os.path.join(tmpdir, 'model.dict')
+            testing_utils.train_model(args)
+
+            args['encode_candidate_vecs'] = True
+            args['candidate_index'] = 'none'
+            valid, _ = testing_utils.eval_model(args, skip_test=True)
+
+            # the flat index is exact, up to the order of tied candidates
+            args['candidate_index'] = 'flat'
+            flat_valid, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertTrue(
+                os.path.isfile(os.path.join(tmpdir, 'model.all_cands.flat.index'))
+            )
+            self.assertEqual(valid['hits@100'], flat_valid['hits@100'])
+
+            # probing every cluster is exact too, and the saved index is reused
+            args['candidate_index'] = 'ivf'
+            args['candidate_index_nlist'] = 4
+            args['candidate_index_nprobe'] = 4
+            for _ in range(2):
+                ivf_valid, _ = testing_utils.eval_model(args, skip_test=True)
+                for metric in ['hits@1', 'hits@10', 'hits@100', 'mrr']:
+                    self.assertEqual(flat_valid[metric], ivf_valid[metric])
+
+    # test eval fixed ecands narrowed down by a first stage ranker
+    @testing_utils.retry(ntries=3)
+    def test_eval_fixed_first_stage(self):
+        args = self._get_args()
+        args['eval_candidates'] = 'fixed'
+
+        teacher = CandidateTeacher({'datatype': 'train'})
+        all_cands = teacher.train + teacher.val + teacher.test
+        all_cands_str = '\n'.join([' '.join(x) for x in all_cands])
+
+        with testing_utils.tempdir() as tmpdir:
+            tmp_cands_file = os.path.join(tmpdir, 'all_cands.text')
+            with open(tmp_cands_file, 'w') as f:
+                f.write(all_cands_str)
+            args['fixed_candidates_path'] = tmp_cands_file
+            args['encode_candidate_vecs'] = False  # don't encode before training
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['dict_file'] = os.path.join(tmpdir, 'model.dict')
+            testing_utils.train_model(args)
+            args['encode_candidate_vecs'] = True
+            valid, _ = testing_utils.eval_model(args, skip_test=True)
+
+            # reranking every candidate with the model itself is exact, up to the
+            # order of tied candidates
+            args['first_stage_model_file'] = args['model_file']
+            args['first_stage_top_k'] = len(all_cands)
+            first_stage_valid, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertEqual(first_stage_valid['first_stage_recall'], 1)
+            self.assertEqual(valid['hits@100'], first_stage_valid['hits@100'])
+            self.assertIn('first_stage_ms', first_stage_valid)
+            self.assertIn('rerank_ms', first_stage_valid)
+
+    # test eval fixed ecands narrowed down on the GPU, with labels on the GPU
+    @testing_utils.skipUnlessGPU
+    @testing_utils.retry(ntries=3)
+    def test_eval_fixed_top_k_gpu(self):
+        args = self._get_args()
+        args['eval_candidates'] = 'fixed'
+        args['no_cuda'] = False
+
+        teacher = CandidateTeacher({'datatype': 'train'})
+        all_cands = teacher.train + teacher.val + teacher.test
+        all_cands_str = '\n'.join([' '.join(x) for x in all_cands])
+
+        with testing_utils.tempdir() as tmpdir:
+            tmp_cands_file = os.path.join(tmpdir, 'all_cands.text')
+            with open(tmp_cands_file, 'w') as f:
+                f.write(all_cands_str)
+            args['fixed_candidates_path'] = tmp_cands_file
+            args['encode_candidate_vecs'] = False  # don't encode before training
+            args['model_file'] = os.path.join(tmpdir, 'model')
+            args['dict_file'] = os.path.join(tmpdir, 'model.dict')
+            testing_utils.train_model(args)
+            args['encode_candidate_vecs'] = True
+            valid, _ = testing_utils.eval_model(args, skip_test=True)
+
+            # both ways of ranking only the top candidates rank the labels
+            index_args = dict(args, candidate_index='flat')
+            index_valid, _ = testing_utils.eval_model(index_args, skip_test=True)
+            first_stage_args = dict(
+                args,
+                first_stage_model_file=args['model_file'],
+                first_stage_top_k=len(all_cands),
+            )
+            first_stage_valid, _ = testing_utils.eval_model(
+                first_stage_args, skip_test=True
+            )
+            for top_k_valid in [index_valid, first_stage_valid]:
+                self.assertEqual(valid['hits@100'], top_k_valid['hits@100'])
+
     # test eval vocab ecands
     @testing_utils.retry(ntries=3)
     def test_eval_vocab(self):
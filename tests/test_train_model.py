@@ -8,6 +8,8 @@
 Basic tests that ensure train_model.py behaves in predictable ways.
 """
 
+import json
+import os
 import unittest
 import parlai.utils.testing as testing_utils
 
@@ -61,6 +63,94 @@ class TestTrainModel(unittest.TestCase):
             total_acc, task1_acc + task2_acc, 'Task accuracy is averaged incorrectly',
         )
 
+    def test_async_validation(self):
+        with testing_utils.tempdir() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model')
+            valid, test = testing_utils.train_model(
+                {
+                    'task': 'integration_tests:nocandidate',
+                    'model': 'seq2seq',
+                    'model_file': model_file,
+                    'hiddensize': 16,
+                    'embeddingsize': 16,
+                    'batchsize': 16,
+                    'num_epochs': 1.0,
+                    'validation_every_n_epochs': 0.25,
+                    'validation_metric': 'loss',
+                    'validation_max_exs': 32,
+                    'async_validation': True,
+                    'async_validation_workers': 2,
+                }
+            )
+            self.assertEqual(valid['exs'], 100)
+            self.assertTrue(os.path.isfile(model_file))
+            with open(model_file + '.trainstats') as f:
+                trainstats = json.load(f)
+            # every launched validation was collected, in order
+            reports = trainstats['valid_reports']
+            self.assertGreaterEqual(len(reports), 3)
+            times = [r['train_time'] for r in reports]
+            self.assertEqual(times, sorted(times))
+            self.assertEqual(trainstats['best_valid'], min(r['loss'] for r in reports))
+
+    def test_save_async(self):
+        with testing_utils.tempdir() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model')
+            args = {
+                'task': 'integration_tests:nocandidate',
+                'model': 'seq2seq',
+                'model_file': model_file,
+                'hiddensize': 16,
+                'embeddingsize': 16,
+                'batchsize': 16,
+                'num_epochs': 1.0,
+                'validation_every_n_epochs': 0.25,
+                'validation_max_exs': 32,
+                'save_after_valid': True,
+                'save_async': True,
+                'keep_checkpoints': 2,
+            }
+            valid, test = testing_utils.train_model(args)
+            self.assertEqual(valid['exs'], 100)
+            for fn in ['model', 'model.checkpoint', 'model.checkpoint.1']:
+                self.assertTrue(os.path.isfile(os.path.join(tmpdir, fn)))
+                self.assertTrue(os.path.isfile(os.path.join(tmpdir, fn + '.opt')))
+            # only the last two checkpoints are kept, and no partial file is left
+            self.assertFalse(os.path.isfile(model_file + '.checkpoint.2'))
+            self.assertEqual(
+                [fn for fn in os.listdir(tmpdir) if fn.endswith('.tmp')], []
+            )
+
+            # the saved model can be loaded back
+            args['num_epochs'] = 0
+            valid_async, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertEqual(valid_async['ppl'], valid['ppl'])
+
+    def test_save_mmap(self):
+        with testing_utils.tempdir() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model')
+            args = {
+                'task': 'integration_tests:nocandidate',
+                'model': 'seq2seq',
+                'model_file': model_file,
+                'hiddensize': 16,
+                'embeddingsize': 16,
+                'batchsize': 16,
+                'num_epochs': 0.5,
+                'save_format': 'mmap',
+            }
+            valid, test = testing_utils.train_model(args)
+            self.assertTrue(os.path.isfile(model_file + '.tensors'))
+            self.assertTrue(os.path.isfile(model_file + '.optim'))
+
+            # the memory-mapped model evaluates the same
+            valid_mmap, _ = testing_utils.eval_model(args, skip_test=True)
+            self.assertEqual(valid_mmap['ppl'], valid['ppl'])
+
+            # and training can resume from it
+            args['init_model'] = model_file
+            testing_utils.train_model(args)
+
 
 if __name__ == '__main__':
     unittest.main()
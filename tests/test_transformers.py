@@ -10,6 +10,7 @@ Test many variants of transformers.
 
 import os
 import unittest
+import torch
 import parlai.utils.testing as testing_utils
 from parlai.core.agents import create_agent
 from parlai.core.opt import Opt
@@ -594,6 +595,72 @@ class TestTransformerGenerator(unittest.TestCase):
         self.assertEqual(agent.model.decoder.n_layers, 2)
 
 
+class TestTransformerDecoderCache(unittest.TestCase):
+    """
+    Test the preallocated incremental decoding state.
+    """
+
+    def _decoder(self):
+        from parlai.agents.transformer.modules import TransformerDecoder
+
+        torch.manual_seed(0)
+        decoder = TransformerDecoder(
+            n_heads=2,
+            n_layers=2,
+            embedding_size=16,
+            ffn_size=32,
+            vocabulary_size=20,
+            embedding=torch.nn.Embedding(20, 16),
+            learn_positional_embeddings=True,
+            n_positions=64,
+        )
+        return decoder.eval()
+
+    def test_matches_uncached(self):
+        """
+        Incremental decoding with the cache matches the dict-based state.
+        """
+        from parlai.agents.transformer.modules import TransformerDecoderCache
+
+        decoder = self._decoder()
+        bsz = 6
+        encoder_output = torch.randn(bsz, 5, 16)
+        encoder_mask = torch.ones(bsz, 5, dtype=torch.bool)
+        encoder_mask[0, 3:] = False
+        encoder_state = (encoder_output, encoder_mask)
+        tokens = torch.randint(1, 20, (bsz, 1))
+
+        with torch.no_grad():
+            dict_state = cache = None
+            for step in range(10):
+                dict_out, dict_state = decoder(tokens, encoder_state, dict_state)
+                cache_out, cache = decoder(tokens, encoder_state, cache)
+                self.assertTrue(torch.allclose(dict_out, cache_out, atol=1e-5))
+                if step == 0:
+                    # a small capacity so the cache needs to grow
+                    cache = TransformerDecoderCache.from_incr_state(cache, capacity=2)
+                self.assertIsInstance(cache, TransformerDecoderCache)
+                self.assertEqual(cache.length, step + 1)
+
+                # reorder both states, as beam search would
+                inds = torch.randint(0, bsz, (bsz,))
+                dict_state = {
+                    idx: layer.reorder_incremental_state(dict_state[idx], inds)
+                    for idx, layer in enumerate(decoder.layers)
+                }
+                cache = cache.reorder(inds)
+                encoder_state = (encoder_output[inds], encoder_mask[inds])
+                encoder_output, encoder_mask = encoder_state
+                tokens = torch.cat(
+                    [tokens[inds], torch.randint(1, 20, (bsz, 1))], dim=1
+                )
+
+            # and both match decoding the whole sequence at once
+            full_out, _ = decoder(tokens, encoder_state)
+            cache_out, _ = decoder(tokens, encoder_state, cache)
+            self.assertTrue(torch.allclose(full_out[:, -1:], cache_out, atol=1e-5))
+
+
 class TestLearningRateScheduler(unittest.TestCase):
     """
     Test learning rate scheduler for both generative and ranking transformers.
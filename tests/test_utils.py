@@ -7,7 +7,18 @@
 from parlai.core.opt import Opt
 from parlai.utils.misc import Timer, round_sigfigs, set_namedtuple_defaults
 from parlai.utils.torch import padded_tensor, argsort
+from parlai.utils.candidate_index import build_candidate_index, load_candidate_index
+from parlai.utils.checkpoint import load_checkpoint, save_checkpoint
+from parlai.utils.world_logging import WorldLogger
+from parlai.utils.safety import OffensiveStringMatcher
+from parlai.core.agents import create_agent
+from parlai.core.params import ParlaiParser
+from parlai.core.worlds import create_task
+import parlai.utils.testing as testing_utils
 from copy import deepcopy
+import gzip
+import json
+import os
 import time
 import unittest
 import torch
@@ -134,5 +145,240 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(history[1][1], 10, 'Deepcopy history not set properly')
 
 
+class TestCandidateIndex(unittest.TestCase):
+    def _data(self):
+        torch.manual_seed(0)
+        centers = torch.randn(32, 16)
+        vectors = centers[torch.randint(32, (2000,))] + 0.1 * torch.randn(2000, 16)
+        queries = centers[torch.randint(32, (8,))] + 0.1 * torch.randn(8, 16)
+        return vectors, queries
+
+    def _recall(self, ids, true_ids):
+        found = sum(
+            len(set(a.tolist()) & set(b.tolist())) for a, b in zip(ids, true_ids)
+        )
+        return found / true_ids.numel()
+
+    def test_flat(self):
+        vectors, queries = self._data()
+        true_scores, true_ids = queries.matmul(vectors.t()).topk(10, dim=1)
+        index = build_candidate_index('flat', vectors, chunk_size=300)
+        scores, ids = index.search(queries, 10)
+        assert torch.allclose(scores, true_scores)
+        assert self._recall(ids, true_ids) == 1
+        assert torch.equal(index.get_vectors(ids), vectors[ids])
+
+    def test_ivf(self):
+        vectors, queries = self._data()
+        _, true_ids = queries.matmul(vectors.t()).topk(10, dim=1)
+        index = build_candidate_index('ivf', vectors, nlist=16, nprobe=1)
+        recall = self._recall(index.search(queries, 10)[1], true_ids)
+        # probing more lists can only find more neighbours
+        index.nprobe = 4
+        assert self._recall(index.search(queries, 10)[1], true_ids) >= recall
+        # probing every list is exact
+        index.nprobe = 16
+        _, ids = index.search(queries, 10)
+        assert self._recall(ids, true_ids) == 1
+        assert torch.equal(index.get_vectors(ids), vectors[ids])
+        # always return k results
+        index.nprobe = 1
+        assert index.search(queries, 500)[1].shape == (8, 500)
+
+    def test_save_load(self):
+        vectors, queries = self._data()
+        with testing_utils.tempdir() as tmpdir:
+            for index_type in ['flat', 'ivf']:
+                path = os.path.join(tmpdir, 'cands.' + index_type)
+                index = build_candidate_index(index_type, vectors)
+                index.save(path)
+                loaded = load_candidate_index(path)
+                assert type(loaded) is type(index)
+                assert len(loaded) == len(index)
+                for x, y in zip(index.search(queries, 5), loaded.search(queries, 5)):
+                    assert torch.equal(x, y)
+            assert load_candidate_index(path, nprobe=3).nprobe == 3
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_mmap(self):
+        model = torch.nn.Sequential(torch.nn.Embedding(10, 4), torch.nn.Linear(4, 3))
+        optimizer = torch.optim.Adam(model.parameters())
+        model(torch.LongTensor([1, 2])).sum().backward()
+        optimizer.step()
+        states = {
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'number_training_updates': 1,
+        }
+        states['model']['empty'] = torch.zeros(0, 2)
+        states['model']['half'] = torch.arange(3).half()
+
+        with testing_utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'model')
+            save_checkpoint(path, states, '{}\n', keep=2, save_format='mmap')
+            save_checkpoint(path, states, '{}\n', keep=2, save_format='mmap')
+            for suffix in ['', '.tensors', '.optim', '.opt']:
+                assert os.path.isfile(path + suffix)
+                assert os.path.isfile(path + '.1' + suffix)
+
+            loaded = load_checkpoint(path)
+            assert loaded['number_training_updates'] == 1
+            assert loaded['model'].keys() == states['model'].keys()
+            for k, v in states['model'].items():
+                assert loaded['model'][k].dtype == v.dtype
+                assert torch.equal(loaded['model'][k], v)
+            exp_avg = loaded['optimizer']['state'][0]['exp_avg']
+            assert torch.equal(exp_avg, optimizer.state_dict()['state'][0]['exp_avg'])
+
+            assert 'optimizer' not in load_checkpoint(path, load_optimizer=False)
+            # the regular format loads the same
+            save_checkpoint(path, states)
+            assert torch.equal(
+                load_checkpoint(path)['model']['1.weight'], model[1].weight
+            )
+
+
+class TestWorldLogger(unittest.TestCase):
+    """
+    Test streaming world logs.
+    """
+
+    def _log(self, world_logger, batchsize=4):
+        parser = ParlaiParser(True, True)
+        WorldLogger.add_cmdline_args(parser)
+        opt = parser.parse_args(
+            [
+                '--task',
+                'integration_tests:multiturn',
+                '--model',
+                'repeat_label',
+                '--datatype',
+                'valid',
+                '--batchsize',
+                str(batchsize),
+            ],
+            print_args=False,
+        )
+        world = create_task(opt, create_agent(opt))
+        while not world.epoch_done():
+            world.parley()
+            world_logger.log(world)
+        world_logger.close()
+
+    def _opt(self, **kwargs):
+        opt = {'log_keep_fields': 'all'}
+        opt.update(kwargs)
+        return opt
+
+    def test_streaming(self):
+        with testing_utils.tempdir() as tmpdir:
+            buffered = WorldLogger(self._opt())
+            self._log(buffered)
+            for file_format in ['parlai', 'jsonl']:
+                path = os.path.join(tmpdir, file_format)
+                buffered.write(path, file_format)
+                with open(path) as f:
+                    expected = f.read()
+
+                streamed = os.path.join(tmpdir, 'streamed')
+                world_logger = WorldLogger(
+                    self._opt(), outfile=streamed, file_format=file_format
+                )
+                self._log(world_logger)
+                # nothing is kept in memory
+                self.assertEqual(world_logger._logs, [])
+                with open(streamed) as f:
+                    self.assertEqual(f.read(), expected)
+
+            # jsonl has one episode per line
+            lines = expected.splitlines()
+            self.assertEqual(len(lines), 100)
+            self.assertEqual(len(json.loads(lines[0])['dialog']), 4)
+
+    def test_compression_and_rotation(self):
+        with testing_utils.tempdir() as tmpdir:
+            buffered = WorldLogger(self._opt())
+            self._log(buffered)
+            path = os.path.join(tmpdir, 'buffered')
+            buffered.write_parlai_format(path)
+            with open(path) as f:
+                expected = f.read()
+
+            # compressed
+            streamed = os.path.join(tmpdir, 'streamed.txt')
+            world_logger = WorldLogger(
+                self._opt(log_compression='gzip'), outfile=streamed
+            )
+            self._log(world_logger)
+            with gzip.open(streamed + '.gz', 'rt') as f:
+                self.assertEqual(f.read(), expected)
+
+            # rotated
+            world_logger = WorldLogger(self._opt(log_rotate_mb=0.01), outfile=streamed)
+            paths = world_logger._writer.paths
+            self._log(world_logger)
+            self.assertGreater(len(paths), 1)
+            self.assertEqual(paths[0], streamed)
+            self.assertEqual(paths[1], os.path.join(tmpdir, 'streamed.1.txt'))
+            contents = []
+            for p in paths:
+                with open(p) as f:
+                    contents.append(f.read())
+                # files only hold whole episodes
+                self.assertTrue(contents[-1].endswith('\n\n'))
+            self.assertEqual(''.join(contents), expected)
+
+
+class TestOffensiveStringMatcher(unittest.TestCase):
+    """
+    Test the automaton of the string matcher, on a custom phrase list.
+    """
+
+    def test_matcher(self):
+        with testing_utils.tempdir() as tmpdir:
+            datafile = os.path.join(tmpdir, 'phrases.txt')
+            with open(datafile, 'w') as f:
+                f.write('heck\ngolly gosh\ngosh darn it\nspice\n')
+            sm = OffensiveStringMatcher(datafile)
+            self.assertTrue(os.path.isfile(sm.automaton_file))
+            self.assertIn('oh heck', sm)
+            # prefix and suffix variants
+            self.assertIn('unheck that', sm)
+            self.assertIn('so hecking much', sm)
+            # but not white-listed ones
+            self.assertNotIn('spicy food', sm)
+            self.assertNotIn('gosh darn', sm)
+            # the phrase starting first is found, and the shortest of those
+            self.assertEqual(
+                sm.contains_offensive_language('gosh darn it golly gosh'),
+                'gosh darn it',
+            )
+            self.assertEqual(
+                sm.contains_offensive_language(['golly', 'gosh', 'darn', 'it']),
+                'golly gosh',
+            )
+            self.assertEqual(
+                sm.batch_contains(['hello', 'oh heck', 'golly gosh', '']),
+                [False, True, True, False],
+            )
+
+            # loaded from the cache, and still extensible
+            sm = OffensiveStringMatcher(datafile)
+            self.assertIn('oh heck', sm)
+            self.assertNotIn('what the', sm)
+            sm.add_words(['what the'])
+            self.assertIn('so what the heck', sm)
+            self.assertEqual(
+                sm.contains_offensive_language('so what the heck'), 'what the'
+            )
+
+            # the cache is rebuilt when the list changes
+            with open(datafile, 'a') as f:
+                f.write('fiddlesticks\n')
+            sm = OffensiveStringMatcher(datafile)
+            self.assertIn('oh fiddlesticks', sm)
+
+
 if __name__ == '__main__':
     unittest.main()